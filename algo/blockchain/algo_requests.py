@@ -1,10 +1,41 @@
 import logging
-from typing import Optional
+from typing import Optional, Callable, Any
+from concurrent.futures import Executor
 import datetime
 import aiohttp
 from dataclasses import dataclass
 import requests
 import aiohttp.client_exceptions
+import asyncio
+import gzip
+import heapq
+import itertools
+import json
+import orjson
+import os
+import shutil
+import threading
+import time
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from algo.blockchain.merge import prefetched
+
+# Can be pointed to a different endpoint, e.g. a local stand-in replaying recorded transactions
+INDEXER_URL = os.environ.get('ALGO_INDEXER_URL', 'https://algoindexer.algoexplorerapi.io')
+
+# Default budget of the shared scheduler, just under the limits of the public indexer
+DEFAULT_REQUESTS_PER_SECOND = 5.0
+DEFAULT_BURST = 10
+DEFAULT_MAX_IN_FLIGHT = 8
+MAX_THROTTLED_RETRIES = 5
+# Retries of failed requests, with exponential backoff starting from RETRY_BACKOFF_SECONDS
+MAX_RETRIES = 6
+RETRY_BACKOFF_SECONDS = 1.0
+# Pages of a query fetched ahead of its consumer, for the callers reading the whole query: a caller stopping early
+# would have fetched them for nothing
+DEFAULT_PREFETCH = 2
+# Page size of the queries that do not set a limit, None leaves the default of the indexer
+PAGE_LIMIT = int(os.environ['ALGO_INDEXER_PAGE_LIMIT']) if 'ALGO_INDEXER_PAGE_LIMIT' in os.environ else None
 
 
 @dataclass
@@ -22,13 +53,31 @@ class QueryParams:
             params['after-time'] = self.after_time.strftime('%Y-%m-%dT%H:%M:%SZ')
         if self.min_block is not None:
             params['min-round'] = self.min_block
-        if self.min_block is not None:
+        if self.max_block is not None:
             params['max-round'] = self.max_block
         return params
 
 
+def set_indexer_url(url: str):
+    global INDEXER_URL
+    INDEXER_URL = url.rstrip('/')
+
+
+def set_page_limit(limit: Optional[int]):
+    global PAGE_LIMIT
+    PAGE_LIMIT = limit
+
+
+def get_indexer_url() -> str:
+    return INDEXER_URL
+
+
+def transactions_url() -> str:
+    return f'{INDEXER_URL}/v2/transactions'
+
+
 def get_current_round():
-    url = f'https://algoindexer.algoexplorerapi.io/v2/transactions'
+    url = transactions_url()
     req = requests.get(url=url).json()
     return int(req['current-round'])
 
@@ -38,37 +87,284 @@ class QueryError(Exception):
         super().__init__(msg)
 
 
-async def query_transactions(session: aiohttp.ClientSession,
-                             params: dict,
-                             num_queries: Optional[int],
-                             query_params: QueryParams):
+class RequestPriority(IntEnum):
+    # Lower values are served first
+    LIVE = 0
+    TAIL = 1
+    BACKFILL = 2
+
+
+class RequestScheduler:
+    """ Token bucket with a bound on the requests in flight, shared by all the indexer clients of the process.
+    Waiting requests are granted by priority and then in arrival order. The state is guarded by a thread lock,
+    so that clients running on different event loops draw from the same budget. """
+
+    def __init__(self,
+                 requests_per_second: float = DEFAULT_REQUESTS_PER_SECOND,
+                 burst: int = DEFAULT_BURST,
+                 max_in_flight: int = DEFAULT_MAX_IN_FLIGHT):
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._in_flight = 0
+        self._waiters: list[tuple[int, int, asyncio.AbstractEventLoop, asyncio.Future]] = []
+        self._counter = itertools.count()
+        self._timer: Optional[threading.Timer] = None
+
+        self.logger = logging.getLogger(__name__)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.requests_per_second)
+        self._last_refill = now
+
+    def _grant(self, future: asyncio.Future):
+        # Runs on the loop of the waiter
+        if future.done():
+            # The waiter was cancelled in the meantime
+            self.release()
+        else:
+            future.set_result(None)
+
+    def _dispatch(self):
+        # Must be called with the lock held
+        self._refill()
+        while self._waiters and self._in_flight < self.max_in_flight and self._tokens >= 1:
+            _, _, loop, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self._tokens -= 1
+            self._in_flight += 1
+            loop.call_soon_threadsafe(self._grant, future)
+
+        if self._waiters and self._in_flight < self.max_in_flight and self._timer is None:
+            delay = (1 - self._tokens) / self.requests_per_second
+            self._timer = threading.Timer(delay, self._on_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+            self._dispatch()
+
+    async def acquire(self, priority: RequestPriority):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            heapq.heappush(self._waiters, (int(priority), next(self._counter), loop, future))
+            self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Cancelled after the slot was granted but before we resumed, nobody else will release it
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+            self._dispatch()
+
+    def throttled(self, backoff_seconds: float = 1.0):
+        """ Called when the provider rejects a request: stop granting new requests for backoff_seconds """
+        self.logger.warning(f'Indexer is throttling requests, backing off for {backoff_seconds} seconds')
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0) - backoff_seconds * self.requests_per_second
+
+    @asynccontextmanager
+    async def slot(self, priority: RequestPriority):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+_request_scheduler: Optional[RequestScheduler] = None
+
+
+def get_request_scheduler() -> RequestScheduler:
+    global _request_scheduler
+    if _request_scheduler is None:
+        _request_scheduler = RequestScheduler()
+    return _request_scheduler
+
+
+def set_request_scheduler(scheduler: RequestScheduler):
+    global _request_scheduler
+    _request_scheduler = scheduler
+
+
+async def get_body(session: aiohttp.ClientSession, url: str, params: dict, priority: RequestPriority,
+                   max_retries: int = MAX_RETRIES) -> bytes:
+    """ GET through the shared scheduler, returning the undecoded body. Requests rejected because of throttling are
+    retried as soon as the scheduler allows, transient failures are retried with exponential backoff """
     logger = logging.getLogger(__name__)
+    scheduler = get_request_scheduler()
 
-    query = f'https://algoindexer.algoexplorerapi.io/v2/transactions'
+    n_throttled = 0
+    n_failed = 0
+    while True:
+        try:
+            async with scheduler.slot(priority):
+                async with session.get(url, params=params) as resp:
+                    if resp.status == 429:
+                        scheduler.throttled()
+                        n_throttled += 1
+                        if n_throttled > MAX_THROTTLED_RETRIES:
+                            raise QueryError(f'Throttled {n_throttled} times, query = {url}, params = {params}')
+                        continue
+                    if resp.status >= 500:
+                        raise aiohttp.client_exceptions.ClientResponseError(resp.request_info, resp.history,
+                                                                            status=resp.status)
+                    if not resp.ok:
+                        msg = f'Session response not OK:, query = {url}, params = {params}'
+                        raise QueryError(msg)
+                    return await resp.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            n_failed += 1
+            if n_failed > max_retries:
+                raise QueryError(f'Failed {n_failed} times, query = {url}, params = {params}') from e
+            backoff = RETRY_BACKOFF_SECONDS * 2 ** (n_failed - 1)
+            logger.warning(f'Request failed with {type(e).__name__}: {e}, retrying in {backoff} seconds')
+            await asyncio.sleep(backoff)
 
-    params = {**params, **query_params.make_params()}
 
-    async with session.get(query, params=params) as resp:
-        ok = resp.ok
-        if not ok:
-            msg = f'Session response not OK:, query = {query}, params = {params}'
-            raise QueryError(msg)
+async def get_json(session: aiohttp.ClientSession, url: str, params: dict, priority: RequestPriority,
+                   max_retries: int = MAX_RETRIES) -> dict:
+    return orjson.loads(await get_body(session, url, params, priority, max_retries))
+
+
+async def aget_current_round(session: aiohttp.ClientSession,
+                             priority: RequestPriority = RequestPriority.LIVE) -> int:
+    resp = await get_json(session, transactions_url(), {'limit': 1}, priority)
+    return int(resp['current-round'])
+
+
+def decode_transactions(body: bytes) -> tuple[Optional[str], list[dict]]:
+    """ Page decoder returning the transactions as dicts """
+    resp = orjson.loads(body)
+    return resp.get('next-token'), resp['transactions']
+
 
+class PageJournal:
+    """ On-disk checkpoint of a paginated query: the bodies of the pages received so far and the next-token to
+    resume from. The pages are kept until the caller has persisted what it derived from them, and calls clear() """
+
+    def __init__(self, journal_dir: str):
+        self.journal_dir = journal_dir
+
+    def _state_file(self):
+        return os.path.join(self.journal_dir, 'state.json')
+
+    def _page_file(self, i: int):
+        return os.path.join(self.journal_dir, f'page_{i:06d}.json.gz')
+
+    def _replace(self, fname: str, data: bytes):
+        tmp = f'{fname}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, fname)
+
+    def load(self) -> tuple[list[bytes], Optional[str], bool]:
+        """ Returns the journaled page bodies, the next-token and whether the query was complete """
         try:
-            resp = await resp.json()
-        except aiohttp.client_exceptions.ContentTypeError as e:
-            logger.critical("resp.json failed"
-                            f"\n{resp} = resp")
-            raise e
+            with open(self._state_file()) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return [], None, False
+
+        pages = []
+        for i in range(state['pages']):
+            with gzip.open(self._page_file(i), 'rb') as f:
+                pages.append(f.read())
+        return pages, state['next_token'], state['next_token'] is None
+
+    def append_page(self, i: int, body: bytes, next_token: Optional[str]):
+        os.makedirs(self.journal_dir, exist_ok=True)
+        self._replace(self._page_file(i), gzip.compress(body, compresslevel=1))
+        self._replace(self._state_file(), json.dumps({'pages': i + 1, 'next_token': next_token}).encode())
+
+    def clear(self):
+        shutil.rmtree(self.journal_dir, ignore_errors=True)
+
+
+async def query_transaction_pages(session: aiohttp.ClientSession,
+                                  params: dict,
+                                  num_queries: Optional[int],
+                                  query_params: QueryParams,
+                                  decode: Callable[[bytes], tuple[Optional[str], Any]] = decode_transactions,
+                                  priority: RequestPriority = RequestPriority.BACKFILL,
+                                  journal: Optional[PageJournal] = None,
+                                  executor: Optional[Executor] = None,
+                                  prefetch: int = 0):
+    """ Yields the decoded pages of a query. decode maps the body of a page to its next-token and the decoded page,
+    with an executor it runs there instead of on the event loop. Up to prefetch pages are fetched and decoded
+    while the caller processes the current one, which is worth it only if the caller reads the whole query """
+    logger = logging.getLogger(__name__)
+
+    query = transactions_url()
+
+    params = {**params, **query_params.make_params()}
+    if PAGE_LIMIT is not None and 'limit' not in params:
+        params['limit'] = PAGE_LIMIT
+
+    async def decode_body(body: bytes):
+        if executor is None:
+            return decode(body)
+        return await asyncio.get_running_loop().run_in_executor(executor, decode, body)
 
     i = 0
-    while resp and (num_queries is None or i < num_queries):
-        for tx in resp['transactions']:
-            yield tx
+    next_token = None
+    if journal is not None:
+        bodies, next_token, complete = journal.load()
+        if bodies:
+            logger.info(f'Resuming query from page {len(bodies)} of journal {journal.journal_dir}')
+        for body in bodies:
+            if num_queries is not None and i >= num_queries:
+                return
+            _, page = await decode_body(body)
+            yield page
+            i += 1
+        if complete:
+            return
 
-        if 'next-token' in resp:
-            async with session.get(query, params={**params, **{'next': resp['next-token']}}) as resp:
-                resp = await resp.json()
-        else:
-            resp = None
-        i += 1
+    async def fetch_pages(i: int, next_token: Optional[str]):
+        while num_queries is None or i < num_queries:
+            if next_token is None:
+                body = await get_body(session, query, params, priority)
+            else:
+                body = await get_body(session, query, {**params, **{'next': next_token}}, priority)
+            next_token, page = await decode_body(body)
+
+            if journal is not None:
+                journal.append_page(i, body, next_token)
+
+            yield page
+
+            if next_token is None:
+                break
+            i += 1
+
+    async for page in prefetched(fetch_pages(i, next_token), prefetch):
+        yield page
+
+
+async def query_transactions(session: aiohttp.ClientSession,
+                             params: dict,
+                             num_queries: Optional[int],
+                             query_params: QueryParams,
+                             priority: RequestPriority = RequestPriority.BACKFILL,
+                             journal: Optional[PageJournal] = None,
+                             prefetch: int = 0):
+    async for page in query_transaction_pages(session, params, num_queries, query_params,
+                                              priority=priority, journal=journal, prefetch=prefetch):
+        for tx in page:
+            yield tx
@@ -0,0 +1,77 @@
+import datetime
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+import pandas as pd
+from algo.blockchain.cache import DateValidator, records_to_day_df, write_day_file
+from algo.blockchain.compaction import read_pool_day
+from algo.blockchain.manifest import DayFile
+from algo.blockchain.process_prices import PoolState, PRICE_CACHES_BASEDIR
+from algo.blockchain.process_volumes import Swap, VOLUME_CACHES_BASEDIR
+from algo.blockchain.process_pricevolumes import PriceVolumeParser, RAW_CACHES_BASEDIR
+from algo.universe.pools import PoolIdStore
+
+
+def rederive_pool_day(raw_dir: str, address: str, asset1_id: int, asset2_id: int,
+                      date: datetime.datetime, price_dir: str, volume_dir: str,
+                      dry_run: bool) -> tuple[datetime.datetime, list[Optional[DayFile]]]:
+    """ Derives the price and volume cache files of a pool and day from its archived raw transactions,
+    returning the files written for the prices and the volumes """
+    # The raw cache may be compacted into monthly files
+    df = read_pool_day(raw_dir, date.date(), columns=['block', 'intra_round_offset', 'raw'])
+    if df is None:
+        return date, [None, None]
+
+    # Replay the transactions latest first, as returned by the indexer
+    df = df.sort_values(by=['block', 'intra_round_offset'], ascending=False)
+
+    parser = PriceVolumeParser(address, asset1_id, asset2_id)
+    records = [parser.push(json.loads(raw)) for raw in df['raw']] + [parser.flush()]
+
+    day_files = []
+    for record_type, dest_dir in ((PoolState, price_dir), (Swap, volume_dir)):
+        type_records = [x for x in records if isinstance(x, record_type)]
+        if type_records and not dry_run:
+            df = records_to_day_df(type_records, date)
+            day_files.append(write_day_file(df, date.date(), os.path.join(dest_dir, f'{date.date()}.parquet')))
+        else:
+            day_files.append(None)
+
+    return date, day_files
+
+
+def rederive_caches(raw_cache_name: str, dest_cache: str, pool_id_store: PoolIdStore,
+                    n_workers: Optional[int] = None, dry_run: bool = False):
+    """ Rebuilds the price and volume caches dest_cache from the raw transactions archived by PriceVolumeCacher,
+    processing the pools and days in parallel on n_workers processes (all the cores by default) """
+    logger = logging.getLogger(__name__)
+
+    tasks = []
+    validators = {}
+    for pool in pool_id_store.pools:
+        assets = list(sorted((pool.asset1_id, pool.asset2_id), reverse=True))
+
+        raw_dv = DateValidator(RAW_CACHES_BASEDIR, raw_cache_name, raw_cache_name, assets)
+        price_dv = DateValidator(PRICE_CACHES_BASEDIR, dest_cache, dest_cache, assets)
+        volume_dv = DateValidator(VOLUME_CACHES_BASEDIR, dest_cache, dest_cache, assets)
+        validators[tuple(assets)] = (price_dv, volume_dv)
+
+        for date in sorted(raw_dv.get_existing_dates()):
+            date = datetime.datetime(year=date.year, month=date.month, day=date.day)
+            tasks.append((tuple(assets), (raw_dv.cache_dir, pool.address, assets[0], assets[1], date,
+                                          price_dv.destcache_dir, volume_dv.destcache_dir, dry_run)))
+
+    logger.info(f'Deriving {len(tasks)} pool days from the raw cache {raw_cache_name}')
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [(assets, executor.submit(rederive_pool_day, *args)) for assets, args in tasks]
+        for assets, future in futures:
+            date, day_files = future.result()
+            if not dry_run:
+                for dv, day_file in zip(validators[assets], day_files):
+                    dv.add_fetched_date(date, day_file)
+            logger.debug(f'Derived date {date.date()} for assets {assets}')
+
+    logger.info(f'Derived the caches {dest_cache} from the raw cache {raw_cache_name}')
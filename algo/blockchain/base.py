@@ -1,7 +1,10 @@
 from abc import ABC, abstractmethod
+from concurrent.futures import Executor
 from typing import Optional
 import datetime
 import aiohttp
+import pandas as pd
+from algo.blockchain.algo_requests import QueryParams, RequestPriority, PageJournal
 
 
 class NotExistentPoolError(Exception):
@@ -17,3 +20,16 @@ class DataScraper(ABC):
                      before_time: Optional[datetime.datetime],
                      num_queries: Optional[int] = None):
         pass
+
+    async def scrape_frames(self, session: aiohttp.ClientSession,
+                            query_params: QueryParams,
+                            priority: RequestPriority = RequestPriority.BACKFILL,
+                            journal: Optional[PageJournal] = None,
+                            executor: Optional[Executor] = None) -> dict[type, pd.DataFrame]:
+        """ The records of a whole query as one DataFrame per type of record, in the order they were scraped.
+        Scrapers able to decode the pages straight into columns override this """
+        records: dict[type, list] = {}
+        async for x in self.scrape(session=session, timestamp_min=None, query_params=query_params,
+                                   num_queries=None, priority=priority, journal=journal):
+            records.setdefault(type(x), []).append(x)
+        return {record_type: pd.DataFrame(xs) for record_type, xs in records.items()}
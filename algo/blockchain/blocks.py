@@ -0,0 +1,306 @@
+import base64
+import datetime
+import glob
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional, Iterator
+import msgpack
+import pandas as pd
+from algosdk.encoding import encode_address, decode_address
+from algo.blockchain.cache import DateValidator, records_to_day_df, write_day_file
+from algo.blockchain.compaction import read_pool_cache
+from algo.blockchain.indexer_replay import tx_addresses
+from algo.blockchain.process_prices import PoolState, PRICE_CACHES_BASEDIR
+from algo.blockchain.process_volumes import Swap, VOLUME_CACHES_BASEDIR
+from algo.blockchain.process_pricevolumes import PriceVolumeParser
+from algo.universe.pools import PoolIdStore
+
+BLOCK_FILE_PATTERN = '*.msgpack'
+# Block files read by each worker task
+FILES_PER_TASK = 16
+
+# Action of the state deltas in the blocks and in the indexer
+SET_BYTES = 1
+SET_UINT = 2
+
+
+def _key_bytes(key) -> bytes:
+    # Keys are msgpack strings that need not be valid utf-8, they are decoded with surrogateescape
+    return key.encode('utf-8', 'surrogateescape') if isinstance(key, str) else key
+
+
+def read_block_file(fname: str) -> Iterator[dict]:
+    """ Blocks of a file of concatenated msgpack objects, either blocks or algod responses {'block': ..., 'cert': ...} """
+    with open(fname, 'rb') as f:
+        for obj in msgpack.Unpacker(f, raw=False, strict_map_key=False, unicode_errors='surrogateescape'):
+            yield obj.get('block', obj)
+
+
+def encode_local_deltas(local_deltas: dict, sender: str, accounts: list[str]) -> list[dict]:
+    """ Local state deltas of a block, keyed by account index, in the format of the indexer """
+    deltas = []
+    for idx, kvs in sorted(local_deltas.items()):
+        address = sender if idx == 0 else accounts[idx - 1]
+        delta = []
+        for key, value in kvs.items():
+            action = value.get('at', 0)
+            encoded = {'action': action}
+            if action == SET_UINT:
+                encoded['uint'] = value.get('ui', 0)
+            elif action == SET_BYTES:
+                encoded['bytes'] = base64.b64encode(_key_bytes(value.get('bs', b''))).decode()
+            delta.append({'key': base64.b64encode(_key_bytes(key)).decode(), 'value': encoded})
+        deltas.append({'address': address, 'delta': delta})
+    return deltas
+
+
+def _count_inner(stxn: dict) -> int:
+    inner = stxn.get('dt', {}).get('itx', [])
+    return len(inner) + sum(_count_inner(x) for x in inner)
+
+
+def block_transactions(block: dict) -> list[dict]:
+    """ Top level transactions of a block in the format of the indexer, with the fields used by the parsers """
+    rnd = block.get('rnd', 0)
+    ts = block.get('ts', 0)
+    txs = []
+    offset = 0
+    for stxn in block.get('txns', []):
+        txn = stxn['txn']
+        tx_type = txn['type']
+        sender = encode_address(txn['snd'])
+        tx = {'tx-type': tx_type, 'sender': sender, 'fee': txn.get('fee', 0), 'confirmed-round': rnd,
+              'intra-round-offset': offset, 'round-time': ts}
+        if 'grp' in txn:
+            tx['group'] = base64.b64encode(txn['grp']).decode()
+        if tx_type == 'pay':
+            tx['payment-transaction'] = {'receiver': encode_address(txn['rcv']) if 'rcv' in txn else None,
+                                         'amount': txn.get('amt', 0),
+                                         'close-to': encode_address(txn['close']) if 'close' in txn else None}
+        elif tx_type == 'axfer':
+            tx['asset-transfer-transaction'] = {'asset-id': txn.get('xaid', 0),
+                                                'receiver': encode_address(txn['arcv']) if 'arcv' in txn else None,
+                                                'amount': txn.get('aamt', 0),
+                                                'close-to': encode_address(txn['aclose']) if 'aclose' in txn
+                                                else None}
+        elif tx_type == 'appl':
+            accounts = [encode_address(x) for x in txn.get('apat', [])]
+            tx['application-transaction'] = {'application-id': txn.get('apid', 0), 'accounts': accounts}
+            local_deltas = stxn.get('dt', {}).get('ld')
+            if local_deltas:
+                tx['local-state-delta'] = encode_local_deltas(local_deltas, sender, accounts)
+        txs.append(tx)
+        # As in the indexer, the offsets also count the inner transactions
+        offset += 1 + _count_inner(stxn)
+    return txs
+
+
+def _encode_block_txn(tx: dict) -> dict:
+    txn = {'type': tx['tx-type'], 'snd': decode_address(tx['sender'])}
+    if tx.get('fee'):
+        txn['fee'] = tx['fee']
+    if tx.get('group'):
+        txn['grp'] = base64.b64decode(tx['group'])
+    if 'payment-transaction' in tx:
+        pay = tx['payment-transaction']
+        txn.update({'rcv': decode_address(pay['receiver']), 'amt': pay['amount']})
+        if pay.get('close-to'):
+            txn['close'] = decode_address(pay['close-to'])
+    if 'asset-transfer-transaction' in tx:
+        axfer = tx['asset-transfer-transaction']
+        txn.update({'xaid': axfer['asset-id'], 'arcv': decode_address(axfer['receiver']), 'aamt': axfer['amount']})
+        if axfer.get('close-to'):
+            txn['aclose'] = decode_address(axfer['close-to'])
+    stxn = {'txn': txn}
+    if 'application-transaction' in tx:
+        app = tx['application-transaction']
+        accounts = app.get('accounts', [])
+        txn.update({'apid': app['application-id'], 'apat': [decode_address(x) for x in accounts]})
+        ld = {}
+        for delta in tx.get('local-state-delta', []):
+            idx = 0 if delta['address'] == tx['sender'] else accounts.index(delta['address']) + 1
+            ld[idx] = {base64.b64decode(kv['key']): {'at': kv['value']['action'], 'ui': kv['value'].get('uint', 0)}
+                       for kv in delta['delta']}
+        if ld:
+            stxn['dt'] = {'ld': ld}
+    return stxn
+
+
+def write_block_files(transactions: list[dict], dirname: str, rounds_per_file: int = 1000):
+    """ Writes transactions in the format of the indexer, such as the recordings of IndexerStandIn, as block
+    files in chain order. As in the archives of the node, every round between the first and the last one has a
+    block: the rounds without transactions get empty blocks with the time of the previous block """
+    os.makedirs(dirname, exist_ok=True)
+    by_round: dict[int, list[dict]] = {}
+    for tx in sorted(transactions, key=lambda x: (x['confirmed-round'], x.get('intra-round-offset', 0))):
+        by_round.setdefault(tx['confirmed-round'], []).append(tx)
+    if not by_round:
+        return
+
+    files: dict[int, list[dict]] = {}
+    ts = None
+    for rnd in range(min(by_round), max(by_round) + 1):
+        txs = by_round.get(rnd, [])
+        if txs:
+            ts = txs[0]['round-time']
+        block = {'rnd': rnd, 'ts': ts, 'txns': [_encode_block_txn(tx) for tx in txs]}
+        files.setdefault(rnd // rounds_per_file, []).append({'block': block})
+
+    for i, blocks in files.items():
+        with open(os.path.join(dirname, f'{i * rounds_per_file:012d}.msgpack'), 'wb') as f:
+            for block in blocks:
+                f.write(msgpack.packb(block, use_bin_type=True))
+
+
+def utc_date(timestamp: int) -> datetime.date:
+    return datetime.datetime.utcfromtimestamp(timestamp).date()
+
+
+def dates_between(date_min: datetime.date, date_max: datetime.date) -> list[datetime.date]:
+    """ Dates from date_min to date_max included """
+    return [date_min + datetime.timedelta(days=i) for i in range((date_max - date_min).days + 1)]
+
+
+@dataclass
+class DerivedBlocks:
+    """ Records of a sequence of block files by pool and day, latest first as derived from the indexer """
+    first_round: Optional[int] = None
+    first_date: Optional[datetime.date] = None
+    last_round: Optional[int] = None
+    last_date: Optional[datetime.date] = None
+    # Days with missing rounds between two consecutive blocks of the files
+    gap_dates: set[datetime.date] = field(default_factory=set)
+    records: dict[tuple[tuple[int, int], datetime.date], list] = field(default_factory=dict)
+
+
+def derive_block_files(fnames: list[str], pools: dict[str, tuple[int, int]]) -> DerivedBlocks:
+    """ Pool states and swaps of the pools in a sequence of block files, with the rounds and dates of the first and
+    the last block and the days spanned by missing rounds """
+    derived = DerivedBlocks()
+    pool_day_txs: dict[tuple[str, datetime.date], list[dict]] = {}
+    for fname in fnames:
+        for block in read_block_file(fname):
+            rnd = block.get('rnd', 0)
+            date = utc_date(block.get('ts', 0))
+            if derived.first_round is None:
+                derived.first_round, derived.first_date = rnd, date
+            elif rnd != derived.last_round + 1:
+                derived.gap_dates.update(dates_between(derived.last_date, date))
+            derived.last_round, derived.last_date = rnd, date
+            for tx in block_transactions(block):
+                for address in tx_addresses(tx) & pools.keys():
+                    pool_day_txs.setdefault((address, date), []).append(tx)
+
+    for (address, date), txs in pool_day_txs.items():
+        parser = PriceVolumeParser(address, *pools[address])
+        day_records = [x for x in [*map(parser.push, reversed(txs)), parser.flush()] if x]
+        if day_records:
+            derived.records[(pools[address], date)] = day_records
+    return derived
+
+
+def ingest_blocks(block_dir: str, dest_cache: str, pool_id_store: PoolIdStore,
+                  n_workers: Optional[int] = None, dry_run: bool = False):
+    """ Builds the price and volume caches dest_cache from the blocks in the files of block_dir, whose names must
+    sort in chain order. The files are derived in parallel on n_workers processes and the days are written with
+    the same writers as DataCacher. The first and the last day of the blocks may be partial and are not cached,
+    nor the days with rounds missing from the files """
+    logger = logging.getLogger(__name__)
+
+    fnames = sorted(glob.glob(os.path.join(block_dir, BLOCK_FILE_PATTERN)))
+    tasks = [fnames[i:i + FILES_PER_TASK] for i in range(0, len(fnames), FILES_PER_TASK)]
+
+    pools = {}
+    validators = {}
+    for pool in pool_id_store.pools:
+        assets = tuple(sorted((pool.asset1_id, pool.asset2_id), reverse=True))
+        pools[pool.address] = assets
+        validators[assets] = {record_type: DateValidator(cache_basedir, dest_cache, dest_cache, assets)
+                              for record_type, cache_basedir in ((PoolState, PRICE_CACHES_BASEDIR),
+                                                                 (Swap, VOLUME_CACHES_BASEDIR))}
+
+    logger.info(f'Deriving {len(pools)} pools from {len(fnames)} block files in {block_dir}')
+
+    def cache_day(date: datetime.date, day_records: dict[tuple[int, int], list[list]]):
+        for assets, record_type_dvs in validators.items():
+            # Records of the later tasks first
+            records = [x for task_records in reversed(day_records.get(assets, [])) for x in task_records]
+            for record_type, dv in record_type_dvs.items():
+                type_records = [x for x in records if isinstance(x, record_type)]
+                day_file = None
+                if type_records and not dry_run:
+                    df = records_to_day_df(type_records, datetime.datetime(date.year, date.month, date.day))
+                    day_file = write_day_file(df, date, os.path.join(dv.destcache_dir, f'{date}.parquet'))
+                if not dry_run:
+                    dv.add_fetched_date(date, day_file)
+        logger.debug(f'Cached date {date} from the blocks')
+
+    next_date = None
+    prev_derived = None
+    gap_dates: set[datetime.date] = set()
+    pending: dict[datetime.date, dict[tuple[int, int], list[list]]] = {}
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for derived in executor.map(derive_block_files, tasks, [pools] * len(tasks)):
+            if derived.first_round is None:
+                continue
+            gap_dates.update(derived.gap_dates)
+            if prev_derived is not None and derived.first_round != prev_derived.last_round + 1:
+                gap_dates.update(dates_between(prev_derived.last_date, derived.first_date))
+            prev_derived = derived
+            if next_date is None:
+                # The first day is partial
+                next_date = derived.first_date + datetime.timedelta(days=1)
+            for (assets, date), x in derived.records.items():
+                pending.setdefault(date, {}).setdefault(assets, []).append(x)
+            # The days before the last day of the task are complete, including the days without records, unless
+            # rounds are missing from the files
+            while next_date < derived.last_date:
+                day_records = pending.pop(next_date, {})
+                if next_date in gap_dates:
+                    logger.warning(f'Skipping date {next_date}, rounds are missing from the block files')
+                else:
+                    cache_day(next_date, day_records)
+                next_date = next_date + datetime.timedelta(days=1)
+            for date in [date for date in pending if date < next_date]:
+                del pending[date]
+
+    logger.info(f'Derived the caches {dest_cache} from {block_dir}')
+
+
+def compare_caches(cache_name: str, reference_cache: str, pool_id_store: PoolIdStore) -> list[tuple]:
+    """ Differences between the price and volume caches of the days cached in both cache_name and reference_cache,
+    such as the caches derived from the blocks and from the indexer, as (record type, pool, date, reason) """
+    differences = []
+    for pool in pool_id_store.pools:
+        assets = tuple(sorted((pool.asset1_id, pool.asset2_id), reverse=True))
+        pool_name = "_".join(str(x) for x in assets)
+        for record_type, cache_basedir in ((PoolState, PRICE_CACHES_BASEDIR), (Swap, VOLUME_CACHES_BASEDIR)):
+            dv = DateValidator(cache_basedir, cache_name, cache_name, assets)
+            ref_dv = DateValidator(cache_basedir, reference_cache, reference_cache, assets)
+            dates = dv.get_existing_dates() & ref_dv.get_existing_dates()
+
+            def day_frames(pool_dir: str) -> dict[datetime.date, pd.DataFrame]:
+                df = read_pool_cache(pool_dir)
+                if df.empty:
+                    return {}
+                # Daily files are latest first and monthly files are sorted by time, compare the sorted rows
+                columns = [col for col in df.columns if col != 'issued_liquidity']
+                df['date'] = pd.to_datetime(df['time'], unit='s').dt.date
+                return {date: x.drop(columns='date').sort_values(by=columns).reset_index(drop=True)
+                        for date, x in df[df['date'].isin(dates)].groupby('date')}
+
+            frames = day_frames(dv.cache_dir)
+            ref_frames = day_frames(ref_dv.cache_dir)
+            for date in sorted(dates):
+                df, ref_df = frames.get(date), ref_frames.get(date)
+                if df is None and ref_df is None:
+                    continue
+                if df is None or ref_df is None:
+                    differences.append((record_type.__name__, pool_name, date, 'missing'))
+                elif len(df) != len(ref_df):
+                    differences.append((record_type.__name__, pool_name, date, f'rows {len(df)} != {len(ref_df)}'))
+                elif not df.astype(object).equals(ref_df[df.columns].astype(object)):
+                    differences.append((record_type.__name__, pool_name, date, 'values'))
+    return differences
@@ -1,24 +1,29 @@
 import logging
 import aiohttp
-from algo.blockchain.algo_requests import QueryParams
+from algo.blockchain.algo_requests import QueryParams, PageJournal
 from algo.universe.pools import PoolIdStore
 from tinyman.v1.client import TinymanClient
-from algo.blockchain.utils import datetime_to_int, generator_to_df
+from algo.blockchain.utils import datetime_to_int
+from algo.blockchain.manifest import CacheManifest, DayFile
+from algo.blockchain.rounds import RoundIndex, split_rounds, sample_transactions
 import pyarrow as pa
 import pyarrow.parquet as pq
-import numpy as np
+import hashlib
 import os
-import json
 import pandas as pd
 import datetime
 from datetime import timezone
-from typing import Optional, Iterable, AsyncGenerator
+from typing import Optional, Iterable, AsyncGenerator, Callable
 from abc import ABC, abstractmethod
 import asyncio
 import uvloop
+from concurrent.futures import Executor, ProcessPoolExecutor
 
 pd.options.mode.chained_assignment = None  # default='warn'
 
+# Directory under the cache basedir holding the pagination checkpoints of the in-progress shards
+JOURNAL_DIRNAME = '_journal'
+
 
 def assert_date(date):
     if isinstance(date, datetime.datetime):
@@ -56,51 +61,119 @@ class DateScheduler:
 
         return needed_dates
 
+    @staticmethod
+    def get_windows(dates: Iterable[datetime.datetime]) -> list[tuple[datetime.datetime, datetime.datetime]]:
+        """ Split a set of dates into contiguous [start, end) windows of whole days """
+        windows = []
+        for date in sorted(dates):
+            if windows and windows[-1][1] == date:
+                windows[-1] = (windows[-1][0], date + datetime.timedelta(days=1))
+            else:
+                windows.append((date, date + datetime.timedelta(days=1)))
+        return windows
+
+
+def make_shards(window_min: datetime.datetime,
+                window_max: datetime.datetime,
+                shard_length: datetime.timedelta) -> list[tuple[datetime.datetime, datetime.datetime]]:
+    shards = []
+    shard_min = window_min
+    while shard_min < window_max:
+        shard_max = min(shard_min + shard_length, window_max)
+        shards.append((shard_min, shard_max))
+        shard_min = shard_max
+    return shards
+
+
+def shard_query_params(shard_min: datetime.datetime, shard_max: datetime.datetime) -> QueryParams:
+    """ Query of the transactions in [shard_min, shard_max). after-time is strict, so it is moved back by a second
+    to include the transactions at shard_min """
+    return QueryParams(after_time=shard_min - datetime.timedelta(seconds=1), before_time=shard_max)
+
+
+def time_shard(shard_min: datetime.datetime, shard_max: datetime.datetime) -> tuple[str, QueryParams]:
+    """ Name of the journal of a shard of time, with its query """
+    return f'{shard_min:%Y%m%dT%H}_{shard_max:%Y%m%dT%H}', shard_query_params(shard_min, shard_max)
+
 
 class DateValidator:
     def __init__(self, cache_basedir: str, cache_name: str, dest_cache: str, assets):
         self.assets = assets
 
         assets = list(sorted(assets, reverse=True))
+        self.pool = "_".join([str(x) for x in assets])
 
         basedir = os.path.join(cache_basedir, cache_name)
-        self.cache_dir = os.path.join(basedir, "_".join([str(x) for x in assets]))
+        self.cache_dir = os.path.join(basedir, self.pool)
         os.makedirs(self.cache_dir, exist_ok=True)
+        self.manifest = CacheManifest(basedir)
 
         if dest_cache is not None:
             destbasedir = os.path.join(cache_basedir, dest_cache)
-            self.destcache_dir = os.path.join(destbasedir, "_".join([str(x) for x in assets]))
+            self.destcache_dir = os.path.join(destbasedir, self.pool)
             os.makedirs(self.destcache_dir, exist_ok=True)
+            self.dest_manifest = CacheManifest(destbasedir)
+            # The days of the source cache are copied to the destination on the first added day
+            self.dest_extended = self.destcache_dir == self.cache_dir
 
-    def get_existing_dates(self):
-        try:
-            with open(f'{self.cache_dir}.json') as json_file:
-                return eval(json.load(json_file))
-        except FileNotFoundError:
-            return set()
+    def get_existing_dates(self) -> set[datetime.date]:
+        return self.manifest.existing_dates(self.pool)
 
-    def add_fetched_date(self, date):
+    def add_fetched_date(self, date, day_file: Optional[DayFile] = None):
         if isinstance(date, datetime.datetime):
             assert_date(date)
             date = date.date()
-        existing_dates = self.get_existing_dates()
-        with open(f'{self.destcache_dir}.json', 'w') as json_file:
-            existing_dates.add(date)
-            json.dump(existing_dates, json_file, default=str)
+        if day_file is None:
+            day_file = DayFile(date)
+        assert day_file.date == date
+        if not self.dest_extended:
+            # The destination cache extends the dates of the source cache
+            self.dest_manifest.add_days(self.pool, self.manifest.days(self.pool), replace=False)
+            self.dest_extended = True
+        self.dest_manifest.add_days(self.pool, [day_file])
+
+        # Imported here as compaction depends on this module
+        from algo.blockchain.compaction import merge_compacted_day
+        merge_compacted_day(self.destcache_dir, self.dest_manifest, self.pool, date)
 
     def has_gaps(self) -> bool:
-        existing_dates = self.get_existing_dates()
-        try:
-            date = min(existing_dates)
-        except TypeError as e:
-            print(existing_dates, self.assets)
-            raise e
-        date_max = max(existing_dates)
-        while date < date_max:
-            if date not in existing_dates:
-                return True
-            date = date + datetime.timedelta(days=1)
-        return False
+        existing_dates = sorted(self.get_existing_dates())
+        if not existing_dates:
+            return False
+        return (existing_dates[-1] - existing_dates[0]).days + 1 != len(existing_dates)
+
+
+def write_parquet_file(df: pd.DataFrame, fname: str, **write_options) -> tuple[int, str]:
+    """ Writes a parquet file atomically, returning its size and checksum """
+    sink = pa.BufferOutputStream()
+    pq.write_table(pa.Table.from_pandas(df), sink, **write_options)
+    data = sink.getvalue().to_pybytes()
+    # Files starting with a dot are ignored by the parquet readers
+    tmp = os.path.join(os.path.dirname(fname), f'.{os.path.basename(fname)}.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, fname)
+    return len(data), hashlib.sha256(data).hexdigest()
+
+
+def write_day_file(df: pd.DataFrame, date: datetime.date, fname: str, **write_options) -> DayFile:
+    """ Writes the parquet file of a day atomically, returning its statistics for the manifest """
+    nbytes, checksum = write_parquet_file(df, fname, **write_options)
+    return DayFile(date, len(df), nbytes, checksum)
+
+
+def assert_day_df(df: pd.DataFrame, date: datetime.datetime):
+    """ Checks that the times in seconds of df all fall on date """
+    day_min = datetime_to_int(date.replace(tzinfo=timezone.utc))
+    assert ((df['time'] >= day_min) & (df['time'] < day_min + 24 * 3600)).all(), \
+        f"{pd.to_datetime(df['time'].unique(), unit='s')}, {date}"
+
+
+def records_to_day_df(records: list, date: datetime.datetime) -> pd.DataFrame:
+    """ DataFrame of the records of one day, in the format of the daily cache files """
+    df = pd.DataFrame(records)
+    assert_day_df(df, date)
+    return df
 
 
 async def groupby_days(gen: AsyncGenerator):
@@ -118,6 +191,59 @@ async def groupby_days(gen: AsyncGenerator):
         yield prev_data
 
 
+class DayStore:
+    """ Writes the days of the pools of a cache from the frames of their shards, and checkpoints the pages of the
+    shards in progress """
+
+    def __init__(self, cache_basedir: str, journal_name: str, dry_run: bool,
+                 write_options: Callable[[type], dict] = lambda record_type: {}):
+        self.cache_basedir = cache_basedir
+        self.journal_name = journal_name
+        self.dry_run = dry_run
+        self.write_options = write_options
+        self.logger = logging.getLogger(journal_name)
+
+    def make_journal(self, dest_cache: str, pool_name: str, shard_name: str) -> Optional[PageJournal]:
+        """ Pages are checkpointed per (pool, shard), so that a restart resumes from the last fetched page """
+        if self.dry_run:
+            return None
+        return PageJournal(os.path.join(self.cache_basedir, JOURNAL_DIRNAME, self.journal_name, dest_cache,
+                                        pool_name, shard_name))
+
+    def clear_journals(self, dest_cache: str, pool_name: str, shard_names: Iterable[str]):
+        if not self.dry_run:
+            for shard_name in shard_names:
+                self.make_journal(dest_cache, pool_name, shard_name).clear()
+
+    def cache_day_df(self, dv: DateValidator, daydf: pd.DataFrame, date: datetime.date, record_type: type) -> DayFile:
+        fname = os.path.join(dv.destcache_dir, f'{date}.parquet')
+        if self.dry_run:
+            return DayFile(date, len(daydf))
+        return write_day_file(daydf, date, fname, **self.write_options(record_type))
+
+    def store_day(self, record_dvs: dict[type, DateValidator], shard_data: list[dict[type, pd.DataFrame]],
+                  date: datetime.datetime):
+        """ Writes the records of a day of a pool from its shards, in chain order, and marks the day as fetched """
+
+        def shard_frames_of_type(shard: dict[type, pd.DataFrame], record_type: type) -> list[pd.DataFrame]:
+            return [df for shard_type, df in shard.items() if issubclass(shard_type, record_type)]
+
+        # The indexer returns the transactions of an address latest first, keep the same order in the cache
+        day_files = {}
+        for record_type, dv in record_dvs.items():
+            dfs = [df for shard in reversed(shard_data) for df in shard_frames_of_type(shard, record_type)]
+            if dfs:
+                daydf = pd.concat(dfs, ignore_index=True)
+                assert_day_df(daydf, date)
+                day_files[record_type] = self.cache_day_df(dv, daydf, date.date(), record_type)
+                self.logger.info(f'Cached date {date.date()} for pool {dv.pool} in {dv.destcache_dir}')
+
+        # Days without data are also marked as fetched
+        if not self.dry_run:
+            for record_type, dv in record_dvs.items():
+                dv.add_fetched_date(date, day_files.get(record_type))
+
+
 class DataCacher(ABC):
     def __init__(self,
                  pool_id_store: PoolIdStore,
@@ -125,10 +251,19 @@ class DataCacher(ABC):
                  client: TinymanClient,
                  date_min: datetime.datetime,
                  date_max: Optional[datetime.datetime],
-                 dry_run: bool):
+                 dry_run: bool,
+                 shard_hours: int = 24,
+                 max_shards_in_flight: int = 8,
+                 shard_rows: Optional[int] = None):
 
         self.dry_run = dry_run
 
+        assert 24 % shard_hours == 0, f"shard_hours = {shard_hours} must divide a day"
+        self.shard_length = datetime.timedelta(hours=shard_hours)
+        self.max_shards_in_flight = max_shards_in_flight
+        # With shard_rows, days are fetched by round ranges of about shard_rows expected rows instead of by time
+        self.shard_rows = shard_rows
+
         self.client = client
         self.pools = [(x.asset1_id, x.asset2_id) for x in pool_id_store.pools]
 
@@ -136,79 +271,108 @@ class DataCacher(ABC):
 
         self.cache_basedir = cache_basedir
         self.logger = logging.getLogger('DataCacher')
+        self.day_store = DayStore(cache_basedir, type(self).__name__, dry_run, self.write_options)
 
     @abstractmethod
     def make_scraper(self, asset1_id: int, asset2_id: int):
         pass
 
+    def record_basedirs(self) -> dict[type, str]:
+        """ Cache basedir of each type of record produced by the scraper """
+        return {object: self.cache_basedir}
+
+    def write_options(self, record_type: type) -> dict:
+        """ Keyword arguments of pq.write_table for each type of record """
+        return {}
+
     def cache(self, cache_name: str, dest_cache: str):
-        basedir = os.path.join(self.cache_basedir, cache_name)
-        dest_basedir = os.path.join(self.cache_basedir, dest_cache)
+        for cache_basedir in self.record_basedirs().values():
+            basedir = os.path.join(cache_basedir, cache_name)
+            dest_basedir = os.path.join(cache_basedir, dest_cache)
 
-        os.makedirs(basedir, exist_ok=True)
-        os.makedirs(dest_basedir, exist_ok=True)
+            os.makedirs(basedir, exist_ok=True)
+            os.makedirs(dest_basedir, exist_ok=True)
 
         async def main():
-            async with aiohttp.ClientSession() as session:
-                await asyncio.gather(*[self._cache_pool(session, assets, cache_name, dest_cache) for assets in self.pools])
+            # Pages are decoded on worker processes, to keep the event loop free for the requests
+            round_index = RoundIndex() if self.shard_rows else None
+            with ProcessPoolExecutor() as executor:
+                async with aiohttp.ClientSession() as session:
+                    await asyncio.gather(*[self._cache_pool(session, executor, round_index, assets, cache_name,
+                                                            dest_cache)
+                                           for assets in self.pools])
 
         uvloop.install()
 
         asyncio.run(main())
 
-    async def _cache_pool(self, session, assets, cache_name, dest_cache):
+    async def _cache_pool(self, session, executor: Executor, round_index: Optional[RoundIndex], assets, cache_name,
+                          dest_cache):
         assets = list(sorted(assets, reverse=True))
 
-        dv = DateValidator(self.cache_basedir, cache_name, dest_cache, assets)
+        record_dvs = {record_type: DateValidator(cache_basedir, cache_name, dest_cache, assets)
+                      for record_type, cache_basedir in self.record_basedirs().items()}
+        dvs = list(record_dvs.values())
 
-        def file_name(date):
-            return os.path.join(dv.destcache_dir, f'{date}.parquet')
-
-        existing_dates = dv.get_existing_dates()
+        # A day is fetched again if it is missing from any of the caches, which keeps them at the same watermark
+        existing_dates = set.intersection(*[dv.get_existing_dates() for dv in dvs])
 
         dates_to_fetch = self.dateScheduler.get_dates_to_fetch(existing_dates)
         if len(dates_to_fetch) == 0:
             self.logger.info(f'Skipping assets {assets[0], assets[1]} because all data is present in the cache')
             return
 
-        # Not optimal if there are non-contiguous day windows to fetch, should rather separate the single query into
-        # multiple queries for each contiguous window. However, if we just update the cache forward it does not matter.
-        date_min = min(dates_to_fetch)
-        date_max = max(dates_to_fetch) + datetime.timedelta(days=1)
+        windows = self.dateScheduler.get_windows(dates_to_fetch)
 
         self.logger.info(
-            f'Found min,max dates to scrape for assets {assets[0], assets[1]} = {date_min}, {date_max}')
+            f'Found {len(windows)} contiguous windows to scrape for assets {assets[0], assets[1]} = {windows}')
 
         scraper = self.make_scraper(assets[0], assets[1])
         if scraper is None:
             self.logger.warning(f'Pool for assets {assets[0], assets[1]} does not exist')
             return
 
-        def cache_day_df(daydf: pd.DataFrame, date):
-            fname = file_name(date)
-            table = pa.Table.from_pandas(daydf)
-            if not self.dry_run:
-                pq.write_table(table, fname)
-
-        async for data in groupby_days(scraper.scrape(session=session,
-                                                      num_queries=None,
-                                                      timestamp_min=None,
-                                                      query_params=QueryParams(after_time=date_min, before_time=date_max))
-                                       ):
-            df = generator_to_df(data)
-            dates = df['time'].dt.date.unique()
-            df['time'] = df['time'].view(dtype=np.int64) // 1000000000
-            assert len(dates) == 1, f"{dates}"
-            date = dates[0]
-            cache_day_df(df, date)
-            dv.add_fetched_date(date)
-            self.logger.info(f'Cached date {date} for assets {assets}')
-
-        # Assume previous operation was successful, fill the missing dates even if there is no data
-        existing_dates = dv.get_existing_dates()
-        for date in dates_to_fetch:
-            if date not in existing_dates:
-                if not self.dry_run:
-                    dv.add_fetched_date(date)
-
+        # Shards of a pool are fetched concurrently, bounded by max_shards_in_flight
+        semaphore = asyncio.Semaphore(self.max_shards_in_flight)
+        pool_name = os.path.basename(dvs[0].destcache_dir)
+
+        async def fetch_shard(shard_name: str, query_params: QueryParams) -> dict[type, pd.DataFrame]:
+            async with semaphore:
+                journal = self.day_store.make_journal(dest_cache, pool_name, shard_name)
+                return await scraper.scrape_frames(session=session,
+                                                   query_params=query_params,
+                                                   journal=journal,
+                                                   executor=executor)
+
+        async def cache_day(date: datetime.datetime, day_shards: list[tuple[str, QueryParams]]):
+            shard_data = await asyncio.gather(*[fetch_shard(*shard) for shard in day_shards])
+            self.day_store.store_day(record_dvs, shard_data, date)
+            self.day_store.clear_journals(dest_cache, pool_name, [shard_name for shard_name, _ in day_shards])
+
+        async def round_shards(date: datetime.datetime) -> list[tuple[str, QueryParams]]:
+            day_min = datetime_to_int(date.replace(tzinfo=timezone.utc))
+            round_min, round_max = await asyncio.gather(round_index.first_round_at(session, day_min),
+                                                        round_index.first_round_at(session, day_min + 24 * 3600))
+            expected_rows = rows_per_day
+            if expected_rows is None:
+                # Without history, e.g. on the first backfill of a pool, the day is sampled
+                expected_rows = await sample_transactions(session, scraper.address, round_min, round_max)
+            return [(f'r{start}_{end}', QueryParams(min_block=start, max_block=end - 1))
+                    for start, end in split_rounds(round_min, round_max, expected_rows, self.shard_rows)]
+
+        shards_by_day: dict[datetime.datetime, list[tuple[str, QueryParams]]] = {}
+        if round_index is not None:
+            # Expected rows of a day from the last days cached for the pool, the largest across the record types
+            rows_per_day = max([x for x in (dv.dest_manifest.rows_per_day(dv.pool) for dv in dvs) if x is not None],
+                               default=None)
+            days = [date for window_min, window_max in windows for date, _ in
+                    make_shards(window_min, window_max, datetime.timedelta(days=1))]
+            for date, day_shards in zip(days, await asyncio.gather(*[round_shards(date) for date in days])):
+                shards_by_day[date] = day_shards
+        else:
+            for window_min, window_max in windows:
+                for shard_min, shard_max in make_shards(window_min, window_max, self.shard_length):
+                    day = shard_min.replace(hour=0, minute=0, second=0, microsecond=0)
+                    shards_by_day.setdefault(day, []).append(time_shard(shard_min, shard_max))
 
+        await asyncio.gather(*[cache_day(date, day_shards) for date, day_shards in shards_by_day.items()])
@@ -0,0 +1,76 @@
+from __future__ import annotations
+from typing import Optional
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+DEFAULT_CAPACITY = 1024
+
+
+class ColumnarBuffer:
+    """ Growable typed columns, doubling their capacity when full so that appends are amortised O(1).
+    Rows are only ever written past the current length, so the frames and tables returned are zero-copy views
+    of the rows appended so far that stay valid after further appends. The views are read-only, so that they
+    cannot be modified in place """
+
+    def __init__(self, dtypes: dict[str, type], capacity: int = DEFAULT_CAPACITY):
+        self.dtypes = dtypes
+        self.n = 0
+        self.columns = {key: np.empty(max(capacity, 1), dtype=dtype) for key, dtype in dtypes.items()}
+
+    def __len__(self) -> int:
+        return self.n
+
+    @property
+    def capacity(self) -> int:
+        return len(next(iter(self.columns.values())))
+
+    def _reserve(self, n: int):
+        capacity = self.capacity
+        if n <= capacity:
+            return
+        while capacity < n:
+            capacity *= 2
+        for key, col in self.columns.items():
+            grown = np.empty(capacity, dtype=col.dtype)
+            grown[:self.n] = col[:self.n]
+            self.columns[key] = grown
+
+    def append(self, row: dict):
+        self._reserve(self.n + 1)
+        for key, col in self.columns.items():
+            col[self.n] = row[key]
+        self.n += 1
+
+    def extend_frame(self, df: pd.DataFrame):
+        """ Appends the rows of a DataFrame, missing float columns are filled with nan """
+        n = len(df)
+        self._reserve(self.n + n)
+        for key, col in self.columns.items():
+            if key in df.columns:
+                col[self.n:self.n + n] = np.asarray(df[key], dtype=col.dtype)
+            elif col.dtype.kind == 'f':
+                col[self.n:self.n + n] = np.nan
+            else:
+                raise KeyError(f'Missing column {key}')
+        self.n += n
+
+    @staticmethod
+    def from_frame(df: pd.DataFrame, dtypes: dict[str, type], capacity: Optional[int] = None) -> ColumnarBuffer:
+        buffer = ColumnarBuffer(dtypes, max(capacity or DEFAULT_CAPACITY, 2 * len(df)))
+        buffer.extend_frame(df)
+        return buffer
+
+    def _views(self) -> dict[str, np.ndarray]:
+        views = {}
+        for key, col in self.columns.items():
+            view = col[:self.n]
+            view.flags.writeable = False
+            views[key] = view
+        return views
+
+    def frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self._views(), copy=False)
+
+    def table(self) -> pa.Table:
+        return pa.table(self._views())
@@ -0,0 +1,178 @@
+import calendar
+import datetime
+import glob
+import logging
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Iterable
+import pandas as pd
+import pyarrow.parquet as pq
+from algo.blockchain.cache import write_parquet_file
+from algo.blockchain.manifest import CacheManifest, MonthFile
+
+POOL_DIR_RE = re.compile(r'[0-9]+_[0-9]+$')
+DAY_FILE_RE = re.compile(r'(\d{4}-\d{2})-\d{2}\.parquet$')
+MONTH_FILE_RE = re.compile(r'(\d{4}-\d{2})\.parquet$')
+# Intraday partitions written by the tail cacher, named after the date and the last round they contain
+INTRADAY_FILE_RE = re.compile(r'((\d{4}-\d{2})-\d{2})\.(\d+)\.parquet$')
+
+# Integer columns that change slowly from one row to the next once sorted by time
+DELTA_COLUMNS = ('time', 'block', 'asset1_reserves', 'asset2_reserves', 'issued_liquidity')
+ROW_GROUP_SIZE = 1 << 20
+
+
+def pool_cache_files(pool_dir: str) -> list[str]:
+    """ Files of the cache of a pool, where a compacted month replaces the files of its days,
+    and a daily file replaces the intraday partitions of its day """
+    try:
+        names = sorted(os.listdir(pool_dir))
+    except FileNotFoundError:
+        return []
+    months = {m.group(1) for m in map(MONTH_FILE_RE.match, names) if m}
+    days = {name[:-len('.parquet')] for name in names if DAY_FILE_RE.match(name)}
+    files = []
+    for name in names:
+        day_match = DAY_FILE_RE.match(name)
+        intraday_match = INTRADAY_FILE_RE.match(name)
+        if MONTH_FILE_RE.match(name) \
+                or (day_match and day_match.group(1) not in months) \
+                or (intraday_match and intraday_match.group(1) not in days and intraday_match.group(2) not in months):
+            files.append(os.path.join(pool_dir, name))
+    return files
+
+
+def read_pool_cache(pool_dir: str, columns: Optional[list[str]] = None) -> pd.DataFrame:
+    """ Reads the cache of a pool, made of daily files, compacted monthly files or both """
+    dfs = [pq.read_table(fname, columns=columns).to_pandas() for fname in pool_cache_files(pool_dir)]
+    if not dfs:
+        return pd.DataFrame()
+    return pd.concat(dfs, ignore_index=True)
+
+
+def read_pool_day(pool_dir: str, date: datetime.date, columns: Optional[list[str]] = None) -> Optional[pd.DataFrame]:
+    """ Reads the rows of a day from the cache of a pool, whether the day is in a daily file, a compacted month
+    or intraday partitions, None if no file holds the day. The rows keep the order of the file they are read from """
+    day_min = int(datetime.datetime(date.year, date.month, date.day, tzinfo=datetime.timezone.utc).timestamp())
+    names = {f'{date}.parquet', f'{date:%Y-%m}.parquet'}
+    fnames = [fname for fname in pool_cache_files(pool_dir)
+              if os.path.basename(fname) in names or os.path.basename(fname).startswith(f'{date}.')]
+    if not fnames:
+        return None
+    read_columns = None if columns is None else list(dict.fromkeys(columns + ['time']))
+    df = pd.concat([pq.read_table(fname, columns=read_columns).to_pandas() for fname in fnames], ignore_index=True)
+    df = df[(df['time'] >= day_min) & (df['time'] < day_min + 24 * 3600)].reset_index(drop=True)
+    return df if columns is None else df[columns]
+
+
+def month_write_options(df: pd.DataFrame) -> dict:
+    delta_columns = [col for col in DELTA_COLUMNS if col in df.columns and pd.api.types.is_integer_dtype(df[col])]
+    return {'compression': 'zstd',
+            'row_group_size': ROW_GROUP_SIZE,
+            'use_dictionary': [col for col in df.columns if col not in delta_columns],
+            'column_encoding': {col: 'DELTA_BINARY_PACKED' for col in delta_columns},
+            'write_statistics': True}
+
+
+def day_number(date: datetime.date) -> int:
+    return (date - datetime.date(1970, 1, 1)).days
+
+
+def compact_month(pool_dir: str, month: str, cleared_dates: Iterable[datetime.date] = ()) -> Optional[MonthFile]:
+    """ Writes the days of a month of a pool into one file sorted by time, None if the month has no data.
+    If the month was already compacted, its daily files replace the days they cover in the monthly file,
+    and the rows of cleared_dates are dropped from it """
+    day_files = sorted(glob.glob(os.path.join(pool_dir, f'{month}-??.parquet')))
+    # The daily files are latest first, as returned by the indexer
+    dfs = [pq.read_table(fname).to_pandas().iloc[::-1] for fname in day_files]
+
+    month_file = os.path.join(pool_dir, f'{month}.parquet')
+    if os.path.exists(month_file):
+        month_df = pq.read_table(month_file).to_pandas()
+        day_numbers = [day_number(datetime.date.fromisoformat(os.path.basename(fname)[:-len('.parquet')]))
+                       for fname in day_files]
+        day_numbers += [day_number(date) for date in cleared_dates]
+        dfs.insert(0, month_df[~(month_df['time'] // (24 * 3600)).isin(day_numbers)])
+
+    if not dfs:
+        return None
+    df = pd.concat(dfs, ignore_index=True).sort_values(by='time', kind='stable', ignore_index=True)
+    nbytes, checksum = write_parquet_file(df, os.path.join(pool_dir, f'{month}.parquet'), **month_write_options(df))
+    return MonthFile(month, len(df), nbytes, checksum)
+
+
+def compact_pool(pool_dir: str, months: list[str]) -> list[MonthFile]:
+    return [x for x in (compact_month(pool_dir, month) for month in months) if x is not None]
+
+
+def remove_day_files(pool_dir: str, months: list[str]):
+    for month in months:
+        for fname in glob.glob(os.path.join(pool_dir, f'{month}-??.parquet')):
+            os.remove(fname)
+
+
+def merge_compacted_day(pool_dir: str, manifest: CacheManifest, pool: str, date: datetime.date):
+    """ Merges a day cached after its month was compacted into the monthly file, which readers prefer to the daily
+    files, so that the day is not hidden until the next compaction. A day cached again without data drops its rows
+    from the monthly file """
+    month = f'{date:%Y-%m}'
+    if month not in {x.month for x in manifest.compacted_months(pool)}:
+        return
+    month_file = compact_month(pool_dir, month, cleared_dates=[date])
+    if month_file is not None:
+        manifest.add_month_files(pool, [month_file])
+    remove_day_files(pool_dir, [month])
+
+
+def complete_months(dates: set[datetime.date], month_max: str) -> list[str]:
+    """ Months before month_max whose days are all cached """
+    months = sorted({f'{date:%Y-%m}' for date in dates if f'{date:%Y-%m}' < month_max})
+    complete = []
+    for month in months:
+        year, mon = int(month[:4]), int(month[5:])
+        n_days = calendar.monthrange(year, mon)[1]
+        if all(datetime.date(year, mon, day) in dates for day in range(1, n_days + 1)):
+            complete.append(month)
+    return complete
+
+
+def compact_cache(cache_basedir: str, cache_name: str, n_workers: Optional[int] = None, dry_run: bool = False):
+    """ Rewrites the daily files of the complete past months of every pool of a cache into monthly files.
+    The month is recorded in the manifest before its daily files are removed, and readers prefer the monthly
+    files, so that the cache can be read at any point of the compaction. Daily files of months already compacted,
+    left behind by an interrupted compaction or written again since, are merged into their monthly file """
+    logger = logging.getLogger(__name__)
+
+    basedir = os.path.join(cache_basedir, cache_name)
+    manifest = CacheManifest(basedir)
+    month_max = f'{datetime.datetime.utcnow():%Y-%m}'
+
+    tasks = {}
+    for pool_dir in sorted(glob.glob(os.path.join(basedir, '*'))):
+        pool = os.path.basename(pool_dir)
+        if not POOL_DIR_RE.match(pool) or not os.path.isdir(pool_dir):
+            continue
+
+        compacted = {x.month for x in manifest.compacted_months(pool)}
+        day_months = {m.group(1) for m in map(DAY_FILE_RE.match, os.listdir(pool_dir)) if m}
+
+        months = sorted(compacted & day_months)
+        months += [month for month in complete_months(manifest.existing_dates(pool), month_max)
+                   if month in day_months and month not in compacted]
+        if months:
+            tasks[pool] = (pool_dir, months)
+
+    logger.info(f'Compacting {sum(len(x[1]) for x in tasks.values())} months of {len(tasks)} pools in {basedir}')
+    if dry_run:
+        return
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {pool: executor.submit(compact_pool, pool_dir, months) for pool, (pool_dir, months) in tasks.items()}
+        for pool, future in futures.items():
+            pool_dir, months = tasks[pool]
+            month_files = future.result()
+            manifest.add_month_files(pool, month_files)
+            remove_day_files(pool_dir, months)
+            logger.debug(f'Compacted months {months} of pool {pool}')
+
+    logger.info(f'Compacted {basedir}')
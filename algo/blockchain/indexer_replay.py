@@ -0,0 +1,266 @@
+from __future__ import annotations
+import asyncio
+import base64
+import bisect
+import datetime
+import gzip
+import json
+import logging
+import os
+import time
+from typing import Optional, Iterable
+import aiohttp
+from aiohttp import web
+from algo.blockchain.algo_requests import query_transactions, QueryParams, RequestPriority, set_indexer_url, \
+    get_indexer_url, set_request_scheduler, RequestScheduler
+from definitions import ROOT_DIR
+
+INDEXER_RECORDINGS_BASEDIR = f'{ROOT_DIR}/caches/indexer_recordings'
+
+# Page size of the indexer when the query does not specify a limit, and largest page size allowed
+DEFAULT_PAGE_LIMIT = 1000
+MAX_PAGE_LIMIT = 10000
+
+# Port of the stand-in served by run_against
+STANDIN_PORT = 8987
+
+
+def tx_position(tx: dict) -> tuple[int, int]:
+    return tx['confirmed-round'], tx.get('intra-round-offset', 0)
+
+
+def tx_addresses(tx: dict) -> set[str]:
+    """ Addresses taking part in a transaction, which the indexer matches against the address parameter """
+    addresses = {tx['sender']}
+    for key, fields in (('payment-transaction', ('receiver', 'close-to')),
+                        ('asset-transfer-transaction', ('receiver', 'close-to', 'sender'))):
+        if key in tx:
+            addresses.update(tx[key].get(field) for field in fields)
+    if 'application-transaction' in tx:
+        addresses.update(tx['application-transaction'].get('accounts', []))
+    addresses.discard(None)
+    return addresses
+
+
+def encode_next_token(position: tuple[int, int]) -> str:
+    return base64.urlsafe_b64encode(f'{position[0]}:{position[1]}'.encode()).decode()
+
+
+def decode_next_token(token: str) -> tuple[int, int]:
+    rnd, offset = base64.urlsafe_b64decode(token.encode()).decode().split(':')
+    return int(rnd), int(offset)
+
+
+def parse_time(value: str) -> int:
+    return int(datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp())
+
+
+def recording_file(recording_name: str) -> str:
+    return os.path.join(INDEXER_RECORDINGS_BASEDIR, recording_name, 'transactions.jsonl.gz')
+
+
+def load_recording(recording_name: str) -> list[dict]:
+    try:
+        with gzip.open(recording_file(recording_name), 'rt') as f:
+            return [json.loads(line) for line in f]
+    except FileNotFoundError:
+        return []
+
+
+class TransactionRecorder:
+    """ Records the raw transactions returned by the indexer for a set of addresses, so that they can be served
+    again by IndexerStandIn. Transactions are deduplicated by id and stored in chain order. """
+
+    def __init__(self, recording_name: str):
+        self.recording_name = recording_name
+        self.logger = logging.getLogger(__name__)
+
+    async def record(self, session: aiohttp.ClientSession, addresses: Iterable[str], query_params: QueryParams):
+        transactions = {tx['id']: tx for tx in load_recording(self.recording_name)}
+        n_existing = len(transactions)
+
+        async def record_address(address: str):
+            async for tx in query_transactions(session=session,
+                                               params={'address': address},
+                                               num_queries=None,
+                                               query_params=query_params,
+                                               priority=RequestPriority.BACKFILL):
+                transactions[tx['id']] = tx
+            self.logger.info(f'Recorded transactions of {address}')
+
+        await asyncio.gather(*[record_address(address) for address in addresses])
+
+        fname = recording_file(self.recording_name)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        tmp = f'{fname}.tmp'
+        with gzip.open(tmp, 'wt') as f:
+            for tx in sorted(transactions.values(), key=tx_position):
+                f.write(json.dumps(tx) + '\n')
+        os.replace(tmp, fname)
+
+        self.logger.info(f'Recorded {len(transactions) - n_existing} new transactions in {fname}')
+
+
+class IndexerStandIn:
+    """ Local HTTP server replaying recorded transactions with the semantics of the indexer /v2/transactions
+    endpoint: address, tx-type, application-id, min-round, max-round, after-time, before-time, limit and next.
+    As for the indexer, queries by address are returned latest first and the other queries in chain order.
+
+    latency_seconds delays every response, max_requests_per_second rejects the requests exceeding the rate
+    with HTTP 429, and rounds_per_second reveals the transactions progressively as if the chain were advancing
+    from the first recorded round, to benchmark streams following the tip of the chain.
+    assets are served by /v2/assets/{asset-id}, as the 'asset' field of the response. """
+
+    def __init__(self, transactions: list[dict],
+                 latency_seconds: float = 0.0,
+                 max_requests_per_second: Optional[float] = None,
+                 rounds_per_second: Optional[float] = None,
+                 assets: Optional[dict[int, dict]] = None):
+
+        self.transactions = sorted(transactions, key=tx_position)
+        self.positions = [tx_position(tx) for tx in self.transactions]
+
+        self.address_idx: dict[str, list[int]] = {}
+        for i, tx in enumerate(self.transactions):
+            for address in tx_addresses(tx):
+                self.address_idx.setdefault(address, []).append(i)
+        self.address_positions = {address: [self.positions[i] for i in idx]
+                                  for address, idx in self.address_idx.items()}
+
+        self.latency_seconds = latency_seconds
+        self.max_requests_per_second = max_requests_per_second
+        self.rounds_per_second = rounds_per_second
+        self.assets = assets or {}
+
+        self._tokens = max_requests_per_second
+        self._last_refill = time.monotonic()
+        self._start_time = time.monotonic()
+        self._first_round = self.positions[0][0] if self.positions else 0
+
+        self.n_requests = 0
+        self.n_throttled = 0
+
+    @staticmethod
+    def from_recording(recording_name: str, **kwargs) -> IndexerStandIn:
+        return IndexerStandIn(load_recording(recording_name), **kwargs)
+
+    def current_round(self) -> int:
+        last_round = self.positions[-1][0] if self.positions else 0
+        if self.rounds_per_second is None:
+            return last_round
+        elapsed = time.monotonic() - self._start_time
+        return min(last_round, self._first_round + int(elapsed * self.rounds_per_second))
+
+    def _throttle(self) -> bool:
+        if self.max_requests_per_second is None:
+            return False
+        now = time.monotonic()
+        self._tokens = min(self.max_requests_per_second,
+                           self._tokens + (now - self._last_refill) * self.max_requests_per_second)
+        self._last_refill = now
+        if self._tokens < 1:
+            return True
+        self._tokens -= 1
+        return False
+
+    def query(self, query: dict) -> dict:
+        address = query.get('address')
+        if address is not None:
+            idx = self.address_idx.get(address, [])
+            positions = self.address_positions.get(address, [])
+        else:
+            idx = range(len(self.transactions))
+            positions = self.positions
+
+        current_round = self.current_round()
+        min_round = int(query['min-round']) if 'min-round' in query else 0
+        max_round = min(int(query['max-round']), current_round) if 'max-round' in query else current_round
+
+        lo = bisect.bisect_left(positions, (min_round, 0))
+        hi = bisect.bisect_left(positions, (max_round + 1, 0))
+
+        descending = address is not None
+        if 'next' in query:
+            token_position = decode_next_token(query['next'])
+            if descending:
+                hi = min(hi, bisect.bisect_left(positions, token_position))
+            else:
+                lo = max(lo, bisect.bisect_right(positions, token_position))
+
+        tx_type = query.get('tx-type')
+        app_id = int(query['application-id']) if 'application-id' in query else None
+        after_time = parse_time(query['after-time']) if 'after-time' in query else None
+        before_time = parse_time(query['before-time']) if 'before-time' in query else None
+        limit = min(int(query.get('limit', DEFAULT_PAGE_LIMIT)), MAX_PAGE_LIMIT)
+
+        def matches(tx: dict) -> bool:
+            if tx_type is not None and tx['tx-type'] != tx_type:
+                return False
+            if app_id is not None and tx.get('application-transaction', {}).get('application-id') != app_id:
+                return False
+            if after_time is not None and not tx['round-time'] > after_time:
+                return False
+            if before_time is not None and not tx['round-time'] < before_time:
+                return False
+            return True
+
+        page = []
+        for j in (range(hi - 1, lo - 1, -1) if descending else range(lo, hi)):
+            tx = self.transactions[idx[j]]
+            if matches(tx):
+                page.append(tx)
+                if len(page) == limit:
+                    break
+
+        resp = {'current-round': current_round, 'transactions': page}
+        if page:
+            resp['next-token'] = encode_next_token(tx_position(page[-1]))
+        return resp
+
+    async def handle_transactions(self, request: web.Request) -> web.Response:
+        self.n_requests += 1
+        if self.latency_seconds:
+            await asyncio.sleep(self.latency_seconds)
+        if self._throttle():
+            self.n_throttled += 1
+            return web.json_response({'message': 'Too many requests'}, status=429)
+        return web.json_response(self.query(dict(request.query)))
+
+    async def handle_asset(self, request: web.Request) -> web.Response:
+        self.n_requests += 1
+        asset = self.assets.get(int(request.match_info['asset_id']))
+        if asset is None:
+            return web.json_response({'message': 'no assets found for asset-id'}, status=404)
+        return web.json_response({'asset': asset, 'current-round': self.current_round()})
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/v2/transactions', self.handle_transactions)
+        app.router.add_get('/v2/assets/{asset_id}', self.handle_asset)
+        return app
+
+    async def start(self, host: str = '127.0.0.1', port: int = 8980) -> web.AppRunner:
+        """ Starts serving on the running loop, the caller is responsible for runner.cleanup() """
+        runner = web.AppRunner(self.make_app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+def run_against(standin: IndexerStandIn, query, port: int = STANDIN_PORT):
+    """ Runs the coroutine function query with a session, against standin serving as the indexer """
+    async def main():
+        runner = await standin.start(port=port)
+        try:
+            async with aiohttp.ClientSession() as session:
+                return await query(session)
+        finally:
+            await runner.cleanup()
+
+    url = get_indexer_url()
+    set_indexer_url(f'http://127.0.0.1:{port}')
+    try:
+        return asyncio.run(main())
+    finally:
+        set_indexer_url(url)
+        set_request_scheduler(RequestScheduler())
@@ -0,0 +1,158 @@
+import datetime
+import glob
+import os
+import re
+import sqlite3
+from contextlib import closing
+from dataclasses import dataclass
+from typing import Optional, Iterable
+import pandas as pd
+
+MANIFEST_FNAME = 'manifest.sqlite'
+
+
+@dataclass
+class DayFile:
+    """ Cached day of a pool, with the statistics of its file. Days without data have no file and zero rows """
+    date: datetime.date
+    rows: int = 0
+    nbytes: int = 0
+    checksum: Optional[str] = None
+
+
+@dataclass
+class MonthFile:
+    """ Compacted month of a pool, replacing the files of its days """
+    month: str
+    rows: int
+    nbytes: int
+    checksum: str
+
+
+def parse_legacy_dates(content: str) -> set[datetime.date]:
+    """ Dates of the per-pool json files written before the manifest, the repr of a set of dates """
+    return {datetime.date(int(y), int(m), int(d))
+            for y, m, d in re.findall(r'datetime\.date\((\d+), (\d+), (\d+)\)', content)}
+
+
+class CacheManifest:
+    """ Index of the days cached for each pool of a cache, stored in a SQLite database at the root of the cache.
+    Every write is a single transaction, so that readers never see a partially updated manifest.
+    A summary per pool is kept up to date on writes, so that coverage and gap queries do not scan the days """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.dbfile = os.path.join(cache_dir, MANIFEST_FNAME)
+        os.makedirs(cache_dir, exist_ok=True)
+        with closing(self._connect()) as con, con:
+            con.execute("""
+                create table if not exists days
+                (pool TEXT NOT NULL, date TEXT NOT NULL, rows INTEGER NOT NULL, bytes INTEGER NOT NULL,
+                 checksum TEXT, PRIMARY KEY (pool, date))
+                """)
+            con.execute("""
+                create table if not exists pools
+                (pool TEXT PRIMARY KEY, date_min TEXT NOT NULL, date_max TEXT NOT NULL, n_days INTEGER NOT NULL,
+                 rows INTEGER NOT NULL, bytes INTEGER NOT NULL)
+                """)
+            con.execute("""
+                create table if not exists months
+                (pool TEXT NOT NULL, month TEXT NOT NULL, rows INTEGER NOT NULL, bytes INTEGER NOT NULL,
+                 checksum TEXT NOT NULL, PRIMARY KEY (pool, month))
+                """)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.dbfile, timeout=60)
+
+    @staticmethod
+    def _update_summary(con: sqlite3.Connection, pool: str):
+        con.execute("""
+            insert or replace into pools
+            select pool, min(date), max(date), count(*), sum(rows), sum(bytes) from days where pool = ? group by pool
+            """, (pool,))
+
+    def _import_legacy(self, con: sqlite3.Connection, pool: str):
+        legacy_file = os.path.join(self.cache_dir, f'{pool}.json')
+        try:
+            with open(legacy_file) as f:
+                dates = parse_legacy_dates(f.read())
+        except FileNotFoundError:
+            return
+        con.executemany("insert or ignore into days values (?, ?, 0, 0, NULL)",
+                        [(pool, str(date)) for date in dates])
+        self._update_summary(con, pool)
+
+    def import_legacy_files(self):
+        """ Imports the json files of all the pools missing from the manifest """
+        with closing(self._connect()) as con, con:
+            pools = {x[0] for x in con.execute("select pool from pools").fetchall()}
+            for legacy_file in glob.glob(os.path.join(self.cache_dir, '*.json')):
+                pool = os.path.basename(legacy_file)[:-len('.json')]
+                if pool not in pools:
+                    self._import_legacy(con, pool)
+
+    def days(self, pool: str) -> list[DayFile]:
+        query = "select date, rows, bytes, checksum from days where pool = ? order by date"
+        with closing(self._connect()) as con, con:
+            rows = con.execute(query, (pool,)).fetchall()
+            if not rows:
+                # Pools cached before the manifest existed are imported on first access
+                self._import_legacy(con, pool)
+                rows = con.execute(query, (pool,)).fetchall()
+        return [DayFile(datetime.date.fromisoformat(date), n, nbytes, checksum) for date, n, nbytes, checksum in rows]
+
+    def existing_dates(self, pool: str) -> set[datetime.date]:
+        return {x.date for x in self.days(pool)}
+
+    def add_days(self, pool: str, day_files: Iterable[DayFile], replace: bool = True):
+        verb = 'replace' if replace else 'ignore'
+        with closing(self._connect()) as con, con:
+            con.executemany(f"insert or {verb} into days values (?, ?, ?, ?, ?)",
+                            [(pool, str(x.date), x.rows, x.nbytes, x.checksum) for x in day_files])
+            self._update_summary(con, pool)
+
+    def rows_per_day(self, pool: str, n_days: int = 30) -> Optional[float]:
+        """ Mean rows of the last n_days cached days of a pool with a file, None if there are none """
+        with closing(self._connect()) as con:
+            row = con.execute("""
+                select avg(rows) from (select rows from days where pool = ? and checksum is not null
+                                       order by date desc limit ?)
+                """, (pool, n_days)).fetchone()
+        return row[0]
+
+    def covered_dates(self) -> pd.DataFrame:
+        """ Pool and date of every cached day, with or without data """
+        self.import_legacy_files()
+        with closing(self._connect()) as con:
+            return pd.read_sql_query("select pool, date from days order by pool, date", con)
+
+    def compacted_months(self, pool: str) -> list[MonthFile]:
+        with closing(self._connect()) as con:
+            rows = con.execute("select month, rows, bytes, checksum from months where pool = ? order by month",
+                               (pool,)).fetchall()
+        return [MonthFile(*row) for row in rows]
+
+    def add_month_files(self, pool: str, month_files: Iterable[MonthFile]):
+        with closing(self._connect()) as con, con:
+            con.executemany("insert or replace into months values (?, ?, ?, ?, ?)",
+                            [(pool, x.month, x.rows, x.nbytes, x.checksum) for x in month_files])
+
+    def gaps(self) -> pd.DataFrame:
+        """ Missing days between the first and the last cached day of each pool, as one row per gap with the
+        cached days around it """
+        self.import_legacy_files()
+        with closing(self._connect()) as con:
+            return pd.read_sql_query("""
+                select pool, prev_date as date_before, date as date_after,
+                       cast(julianday(date) - julianday(prev_date) - 1 as integer) as n_missing
+                from (select pool, date, lag(date) over (partition by pool order by date) as prev_date from days
+                      where pool in (select pool from pools
+                                     where julianday(date_max) - julianday(date_min) + 1 != n_days))
+                where julianday(date) - julianday(prev_date) > 1
+                """, con)
+
+    def coverage(self) -> pd.DataFrame:
+        """ First and last cached day, number of days, rows and bytes of each pool """
+        self.import_legacy_files()
+        with closing(self._connect()) as con:
+            return pd.read_sql_query("select * from pools", con)
@@ -0,0 +1,113 @@
+import asyncio
+import heapq
+from typing import AsyncIterator, AsyncGenerator, Any, TypeVar
+
+T = TypeVar('T')
+
+# Items buffered ahead of the merge for each source
+DEFAULT_LOOKAHEAD = 1000
+
+
+class _SourceError:
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+# Returned by SourceQueue once the source is exhausted
+DONE = object()
+
+
+class SourceQueue:
+    """ Consumes an async source on its own task into a queue of at most maxsize items, so that the source runs
+    ahead of its consumer. The exceptions of the source are raised to the consumer after the items before them """
+
+    def __init__(self, source: AsyncIterator[T], maxsize: int):
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.task = asyncio.ensure_future(self._produce(source))
+
+    async def _produce(self, source: AsyncIterator[T]):
+        try:
+            async for x in source:
+                await self.queue.put(x)
+        except Exception as e:
+            await self.queue.put(_SourceError(e))
+        else:
+            await self.queue.put(DONE)
+        finally:
+            if hasattr(source, 'aclose'):
+                await source.aclose()
+
+    @staticmethod
+    def _unwrap(x):
+        if isinstance(x, _SourceError):
+            raise x.exception
+        return x
+
+    async def get(self):
+        """ Next item of the source, or DONE """
+        return self._unwrap(await self.queue.get())
+
+    def get_nowait(self):
+        return self._unwrap(self.queue.get_nowait())
+
+    def empty(self) -> bool:
+        return self.queue.empty()
+
+    def cancel(self):
+        self.task.cancel()
+
+    async def stop(self):
+        """ Cancels the producer and waits for the source to be closed """
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+
+async def merge_sorted(sources: list[AsyncIterator[tuple[Any, T]]],
+                       lookahead: int = DEFAULT_LOOKAHEAD) -> AsyncGenerator[T, Any]:
+    """ k-way merge of async sources of (key, item), each sorted by key, yielding the items sorted by key.
+    Each source is consumed by its own task into a queue of at most lookahead items, so that the sources are
+    fetched concurrently while the memory stays proportional to the number of sources """
+
+    queues = [SourceQueue(source, lookahead) for source in sources]
+    try:
+        heap = []
+        for i, x in enumerate(await asyncio.gather(*[queue.get() for queue in queues])):
+            if x is not DONE:
+                heap.append((x[0], i, x[1]))
+        heapq.heapify(heap)
+
+        while heap:
+            key, i, item = heap[0]
+            yield item
+            x = await queues[i].get()
+            if x is DONE:
+                heapq.heappop(heap)
+            else:
+                assert x[0] >= key, f'Source {i} is not sorted: {x[0]} after {key}'
+                heapq.heapreplace(heap, (x[0], i, x[1]))
+    finally:
+        for queue in queues:
+            queue.cancel()
+
+
+async def prefetched(source: AsyncIterator[T], depth: int) -> AsyncGenerator[T, Any]:
+    """ Yields the items of source, consumed by a task up to depth items ahead of the caller, so that producing the
+    next items overlaps with processing the current one. The bounded queue applies backpressure to the source.
+    A caller stopping early has fetched up to depth items for nothing """
+    if depth <= 0:
+        async for x in source:
+            yield x
+        return
+
+    queue = SourceQueue(source, depth)
+    try:
+        while True:
+            x = await queue.get()
+            if x is DONE:
+                break
+            yield x
+    finally:
+        queue.cancel()
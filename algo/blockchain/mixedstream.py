@@ -2,15 +2,18 @@ from __future__ import annotations
 
 import unittest
 
-from algo.blockchain.stream import DataStream, PriceVolumeStream, only_price
+from algo.blockchain.stream import AsyncDataStream, PriceVolumeStream, aonly_price, iterate_in_background, \
+    background_loop, batch_updates, abatch_updates, PriceUpdateBatch
 from algo.blockchain.process_prices import PriceScraper
+from algo.blockchain.base import NotExistentPoolError
 from algo.blockchain.stream import PriceUpdate
 import aiohttp
 from tinyman.v1.client import TinymanClient, TinymanMainnetClient
 import asyncio
 import logging
 from algo.blockchain.process_prices import PoolState
-from algo.blockchain.algo_requests import QueryParams
+from algo.blockchain.algo_requests import QueryParams, RequestPriority, aget_current_round
+from algo.blockchain.merge import merge_sorted, DEFAULT_LOOKAHEAD
 from algo.universe.universe import SimpleUniverse
 from algo.universe.pools import PoolId, PoolIdStore
 from algo.dataloading.caching import make_filter_from_universe, load_algo_pools
@@ -18,50 +21,67 @@ import datetime
 import uvloop
 from dataclasses import asdict
 import pandas as pd
+from typing import AsyncGenerator, Generator, Any, Optional
 
 
 class PriceStreamer:
+    """ Price updates of a universe since date_min, merged across the pools in chain order """
+
     def __init__(self,
                  universe: SimpleUniverse,
                  client: TinymanClient,
                  date_min: datetime.datetime,
-                 filter_tx_type: bool = True):
+                 filter_tx_type: bool = True,
+                 lookahead: int = DEFAULT_LOOKAHEAD):
         self.client = client
         self.pools = [(x.asset1_id, x.asset2_id) for x in universe.pools]
         self.date_min = date_min
 
         self.filter_tx_type = filter_tx_type
+        self.lookahead = lookahead
+
+        # Last round of the history, fixed when the stream starts so that all the pools end at the same round
+        self.max_round: Optional[int] = None
 
         self.data: list[PriceUpdate] = []
 
         self.logger = logging.getLogger(__name__)
 
     def load(self) -> list[PriceUpdate]:
-        async def main():
-            async with aiohttp.ClientSession() as session:
-                await asyncio.gather(*[self._load_pool(session, assets) for assets in self.pools])
-
         uvloop.install()
-        asyncio.run(main())
+        return asyncio.run(self.aload())
 
-        self.data.sort(key=lambda x: x.price_update.time)
+    async def aload(self) -> list[PriceUpdate]:
+        self.data = [x async for x in self.astream()]
         return self.data
 
-    async def _load_pool(self, session, assets) -> None:
-        assets = list(sorted(assets, reverse=True))
+    async def astream(self) -> AsyncGenerator[PriceUpdate, Any]:
+        async with aiohttp.ClientSession() as session:
+            if self.max_round is None:
+                self.max_round = await aget_current_round(session, RequestPriority.LIVE)
 
-        scraper = PriceScraper(self.client, assets[0], assets[1], skip_same_time=False)
+            sources = [self._pool_updates(session, assets) for assets in self.pools]
+            async for x in merge_sorted([x for x in sources if x is not None], self.lookahead):
+                yield x
 
-        if scraper is None:
+    def _pool_updates(self, session, assets) -> Optional[AsyncGenerator[tuple[tuple[int, int], PriceUpdate], Any]]:
+        assets = list(sorted(assets, reverse=True))
+
+        try:
+            scraper = PriceScraper(self.client, assets[0], assets[1], skip_same_time=False)
+        except NotExistentPoolError:
             self.logger.error(f'Pool for assets {assets[0], assets[1]} does not exist')
-            return
+            return None
 
-        async for pool_state in scraper.scrape(session=session,
-                                               num_queries=None,
-                                               timestamp_min=None,
-                                               query_params=QueryParams(after_time=self.date_min),
-                                               filter_tx_type=self.filter_tx_type):
-            self.data.append(PriceUpdate(asset_ids=(max(assets), min(assets)), price_update=pool_state))
+        async def gen():
+            async for key, pool_state in scraper.scrape_forward(session=session,
+                                                                time_min=self.date_min,
+                                                                max_round=self.max_round,
+                                                                filter_tx_type=self.filter_tx_type,
+                                                                priority=RequestPriority.LIVE):
+                yield key, PriceUpdate(asset_ids=(max(assets), min(assets)), price_update=pool_state)
+
+        return gen()
 
 
 class TotalDataLoader:
@@ -117,7 +137,8 @@ class TotalDataLoader:
                                                num_queries=None,
                                                timestamp_min=None,
                                                query_params=QueryParams(after_time=date_min),
-                                               filter_tx_type=self.filter_tx_type):
+                                               filter_tx_type=self.filter_tx_type,
+                                               priority=RequestPriority.TAIL):
             self.new_data.append(PriceUpdate(asset_ids=(max(assets), min(assets)), price_update=pool_state))
 
 
@@ -137,16 +158,42 @@ class MixedPriceStreamer:
         self.client = client
         self.filter_tx_type = filter_tx_type
 
+    def _price_streamer(self) -> PriceStreamer:
+        return PriceStreamer(self.universe, self.client, date_min=self.date_min, filter_tx_type=self.filter_tx_type)
+
     def scrape(self):
+        """ Same as ascrape, from synchronous code. The stream runs on the background loop, so that the indexer
+        requests of the live tail are made by the async stream as well """
+        yield from iterate_in_background(self.ascrape())
+
+    def close(self):
+        """ Closes the session of the live stream opened by scrape """
+        asyncio.run_coroutine_threadsafe(self.aclose(), background_loop()).result()
+
+    async def aclose(self):
+        """ Closes the session of the live stream opened by ascrape """
+        if self.pvs and isinstance(self.pvs.data_stream, AsyncDataStream):
+            await self.pvs.data_stream.close()
+
+    async def ascrape(self) -> AsyncGenerator[PriceUpdate, Any]:
+        """ The history since date_min is yielded as it is merged across the pools, then the live tail continues
+        from the round following the last round of the history, without blocking the event loop on the indexer
+        requests """
         if not self.pvs:
-            max_block = -1
-            ps = PriceStreamer(self.universe, self.client, date_min=self.date_min, filter_tx_type=self.filter_tx_type)
-            for x in ps.load():
+            ps = self._price_streamer()
+            async for x in ps.astream():
                 yield x
-                assert x.price_update.block >= max_block
-                max_block = x.price_update.block
-            query_params = QueryParams(min_block=max_block + 1)
-            ds = DataStream(self.universe, query_params)
+            ds = AsyncDataStream(self.universe, QueryParams(min_block=ps.max_round + 1))
             self.pvs = PriceVolumeStream(ds)
         else:
-            yield from only_price(self.pvs.scrape())
+            async for x in aonly_price(self.pvs.ascrape()):
+                yield x
+
+    def scrape_batches(self, batch_size: int = 1000) -> Generator[PriceUpdateBatch, Any, Any]:
+        """ Same as scrape, grouping the updates into batches of up to batch_size updates """
+        yield from batch_updates(self.scrape(), batch_size)
+
+    async def ascrape_batches(self, batch_size: int = 1000) -> AsyncGenerator[PriceUpdateBatch, Any]:
+        """ Same as ascrape, grouping the updates into batches of up to batch_size updates """
+        async for x in abatch_updates(self.ascrape(), batch_size):
+            yield x
@@ -1,28 +1,42 @@
 from __future__ import annotations
+import asyncio
 import requests
-from dataclasses import dataclass
-from algo.blockchain.algo_requests import query_transactions
+from dataclasses import dataclass, replace
+from algo.blockchain.algo_requests import query_transactions, query_transaction_pages, DEFAULT_PREFETCH
 from base64 import b64decode, b64encode
+from concurrent.futures import Executor
+import numpy as np
+import orjson
+import pandas as pd
 import warnings
 import time
 from algo.blockchain.base import DataScraper, NotExistentPoolError
-from algo.blockchain.cache import DataCacher
+from algo.blockchain.cache import DataCacher, DateValidator, DateScheduler, DayStore, make_shards, time_shard
 from definitions import ROOT_DIR
 import logging
 import aiohttp
-from algo.blockchain.algo_requests import QueryParams
+import uvloop
+from algo.blockchain.algo_requests import QueryParams, RequestPriority, PageJournal, get_indexer_url
 from algo.universe.pools import PoolIdStore
 from tinyman.v1.client import TinymanClient
 import datetime
-from typing import Optional
+from typing import Optional, AsyncGenerator, Any
 
 PRICE_CACHES_BASEDIR = f'{ROOT_DIR}/caches/prices'
 
+# Keys of the local state of the pools, as they appear base64-encoded in the state deltas
+S1_KEY = b64encode(b's1').decode()
+S2_KEY = b64encode(b's2').decode()
+ILT_KEY = b64encode(b'ilt').decode()
+STATE_KEYS = {'s1': S1_KEY, 's2': S2_KEY, 'ilt': ILT_KEY}
+
 
 def get_state_int(state, key):
     if type(key) == str:
-        key = b64encode(key.encode())
-    return state.get(key.decode(), {'uint': None})['uint']
+        key = STATE_KEYS.get(key) or b64encode(key.encode()).decode()
+    else:
+        key = key.decode()
+    return state.get(key, {'uint': None})['uint']
 
 
 @dataclass
@@ -35,11 +49,11 @@ class PoolState:
     reverse_order_in_block: int
 
     def with_reverse_order(self, reverse_order_in_block: int) -> PoolState:
-        return PoolState(self.time, self.asset1_reserves, self.asset2_reserves, self.block, reverse_order_in_block)
+        return replace(self, reverse_order_in_block=reverse_order_in_block)
 
 
 def get_pool_state(pool_address: str):
-    query = f'https://algoindexer.algoexplorerapi.io/v2/accounts/{pool_address}'
+    query = f'{get_indexer_url()}/v2/accounts/{pool_address}'
     resp = requests.get(query).json()['account']['apps-local-state'][0]
     state = {y['key']: y['value'] for y in resp['key-value']}
     return PoolState(int(time.time()), get_state_int(state, 's1'), get_state_int(state, 's2'))
@@ -76,6 +90,99 @@ def get_pool_state_txn(tx: dict, prev_time: Optional[int] = None, prev_reverse_o
                      )
 
 
+def pool_state_columns(transactions: list[dict]) -> dict[str, np.ndarray]:
+    """ Pool states of the transactions of a page as columns, in the order of the page.
+    Missing issued liquidity is marked with -1 """
+    n = len(transactions)
+    times = np.empty(n, dtype=np.int64)
+    block = np.empty(n, dtype=np.int64)
+    s1 = np.empty(n, dtype=np.int64)
+    s2 = np.empty(n, dtype=np.int64)
+    ilt = np.empty(n, dtype=np.int64)
+
+    j = 0
+    for tx in transactions:
+        if tx['tx-type'] != 'appl':
+            continue
+        try:
+            delta = tx['local-state-delta'][0]['delta']
+        except KeyError:
+            continue
+        x1 = x2 = None
+        xl = -1
+        for kv in delta:
+            key = kv['key']
+            if key == S1_KEY:
+                x1 = kv['value'].get('uint')
+            elif key == S2_KEY:
+                x2 = kv['value'].get('uint')
+            elif key == ILT_KEY:
+                xl = kv['value'].get('uint', -1)
+        if x1 is None or x2 is None:
+            continue
+        times[j] = tx['round-time']
+        block[j] = tx['confirmed-round']
+        s1[j] = x1
+        s2[j] = x2
+        ilt[j] = xl
+        j += 1
+
+    return {'time': times[:j], 'asset1_reserves': s1[:j], 'asset2_reserves': s2[:j],
+            'issued_liquidity': ilt[:j], 'block': block[:j]}
+
+
+def decode_pool_state_page(body: bytes) -> tuple[Optional[str], dict[str, np.ndarray]]:
+    """ Page decoder extracting the pool states of a page straight into columns """
+    resp = orjson.loads(body)
+    return resp.get('next-token'), pool_state_columns(resp['transactions'])
+
+
+def pool_states_frame(pages: list[dict[str, np.ndarray]], skip_same_time: bool = False) -> pd.DataFrame:
+    """ DataFrame of the pool states decoded by decode_pool_state_page from consecutive pages, received latest
+    first, with the same content as the PoolState records produced by PoolStateParser """
+    columns = {key: np.concatenate([page[key] for page in pages]) if pages else np.empty(0, dtype=np.int64)
+               for key in ('time', 'asset1_reserves', 'asset2_reserves', 'issued_liquidity', 'block')}
+
+    times = columns['time']
+    n = len(times)
+    new_time = np.ones(n, dtype=bool)
+    new_time[1:] = times[1:] != times[:-1]
+    if skip_same_time:
+        columns = {key: value[new_time] for key, value in columns.items()}
+        reverse_order_in_block = np.zeros(len(columns['time']), dtype=np.int64)
+    else:
+        idx = np.arange(n)
+        reverse_order_in_block = idx - np.maximum.accumulate(np.where(new_time, idx, 0))
+
+    df = pd.DataFrame(columns)
+    missing = df['issued_liquidity'] == -1
+    if missing.all() and n > 0:
+        df['issued_liquidity'] = None
+    elif missing.any():
+        df['issued_liquidity'] = df['issued_liquidity'].where(~missing)
+    df['reverse_order_in_block'] = reverse_order_in_block
+    return df
+
+
+class PoolStateParser:
+    """ Extracts the pool states from the transactions of a pool, received latest first as returned by the indexer """
+
+    def __init__(self, skip_same_time: bool = False):
+        self.skip_same_time = skip_same_time
+        self.prev_time = None
+        self.prev_reverse_order_in_block = None
+
+    def push(self, tx: dict) -> Optional[PoolState]:
+        if tx['tx-type'] != 'appl':
+            return None
+        ps = get_pool_state_txn(tx, self.prev_time, self.prev_reverse_order_in_block)
+        if not ps or (self.skip_same_time and self.prev_time and self.prev_time == ps.time):
+            return None
+        self.prev_time = ps.time
+        self.prev_reverse_order_in_block = ps.reverse_order_in_block
+        return ps
+
+
 class PriceScraper(DataScraper):
     def __init__(self, client: TinymanClient, asset1_id: int, asset2_id: int,
                  skip_same_time: bool = False):
@@ -96,9 +203,10 @@ class PriceScraper(DataScraper):
                      timestamp_min: Optional[int],
                      query_params: QueryParams,
                      num_queries: Optional[int] = None,
-                     filter_tx_type: bool = True):
-        prev_time = None
-        prev_reverse_order_in_block = None
+                     filter_tx_type: bool = True,
+                     priority: RequestPriority = RequestPriority.BACKFILL,
+                     journal: Optional[PageJournal] = None):
+        parser = PoolStateParser(self.skip_same_time)
 
         self.logger.debug(f'Started scraping price for assets {self.assets}')
 
@@ -110,7 +218,9 @@ class PriceScraper(DataScraper):
         async for tx in query_transactions(session=session,
                                            params=params,
                                            num_queries=num_queries,
-                                           query_params=query_params):
+                                           query_params=query_params,
+                                           priority=priority,
+                                           journal=journal):
 
             self.logger.debug(f'Received transaction for assets {self.assets}, '
                               f'block_time={datetime.datetime.fromtimestamp(tx["round-time"])}')
@@ -119,15 +229,68 @@ class PriceScraper(DataScraper):
                 continue
             if timestamp_min and tx['round-time'] < timestamp_min:
                 break
-            ps = get_pool_state_txn(tx, prev_time, prev_reverse_order_in_block)
-            if not ps or (self.skip_same_time and prev_time and prev_time == ps.time):
-                continue
-            prev_time = ps.time
-            prev_reverse_order_in_block = ps.reverse_order_in_block
-            yield ps
+            ps = parser.push(tx)
+            if ps:
+                yield ps
 
         self.logger.debug(f'Stopped scraping price for assets {self.assets}')
 
+    async def scrape_forward(self, session: aiohttp.ClientSession,
+                             time_min: datetime.datetime,
+                             max_round: int,
+                             window: datetime.timedelta = datetime.timedelta(hours=6),
+                             filter_tx_type: bool = True,
+                             priority: RequestPriority = RequestPriority.BACKFILL
+                             ) -> AsyncGenerator[tuple[tuple[int, int], PoolState], Any]:
+        """ Pool states from time_min up to max_round in chain order, keyed by (round, intra-round offset).
+        The indexer returns the transactions of an address latest first, so the history is fetched in windows
+        moving forward in time and each window is reversed locally: the lookahead is bounded by one window """
+        params = {'address': self.address}
+        if filter_tx_type:
+            params['tx-type'] = 'appl'
+
+        time_max = datetime.datetime.utcnow()
+        window_min = time_min
+        while window_min <= time_max:
+            # after-time is strict, include the transactions at window_min
+            query_params = QueryParams(after_time=window_min - datetime.timedelta(seconds=1),
+                                       before_time=window_min + window,
+                                       max_block=max_round)
+            parser = PoolStateParser(self.skip_same_time)
+            states = []
+            async for tx in query_transactions(session=session,
+                                               params=params,
+                                               num_queries=None,
+                                               query_params=query_params,
+                                               priority=priority):
+                ps = parser.push(tx)
+                if ps:
+                    states.append(((tx['confirmed-round'], tx.get('intra-round-offset', 0)), ps))
+
+            for x in reversed(states):
+                yield x
+            window_min = window_min + window
+
+    async def scrape_frames(self, session: aiohttp.ClientSession,
+                            query_params: QueryParams,
+                            priority: RequestPriority = RequestPriority.BACKFILL,
+                            journal: Optional[PageJournal] = None,
+                            executor: Optional[Executor] = None) -> dict[type, pd.DataFrame]:
+        """ Columnar counterpart of scrape, decoding the pages into columns on the executor """
+        pages = [page async for page in query_transaction_pages(session=session,
+                                                                params={'address': self.address, 'tx-type': 'appl'},
+                                                                num_queries=None,
+                                                                query_params=query_params,
+                                                                decode=decode_pool_state_page,
+                                                                priority=priority,
+                                                                journal=journal,
+                                                                executor=executor,
+                                                                prefetch=DEFAULT_PREFETCH)]
+        df = pool_states_frame(pages, self.skip_same_time)
+        if df.empty:
+            return {}
+        return {PoolState: df}
+
 
 class PriceCacher(DataCacher):
 
@@ -135,14 +298,20 @@ class PriceCacher(DataCacher):
                  pool_id_store: PoolIdStore,
                  date_min: datetime.datetime,
                  date_max: Optional[datetime.datetime],
-                 dry_run: bool):
+                 dry_run: bool,
+                 shard_hours: int = 24,
+                 max_shards_in_flight: int = 8,
+                 shard_rows: Optional[int] = None):
 
         super().__init__(pool_id_store,
                          PRICE_CACHES_BASEDIR,
                          client,
                          date_min,
                          date_max,
-                         dry_run)
+                         dry_run,
+                         shard_hours,
+                         max_shards_in_flight,
+                         shard_rows)
 
     def make_scraper(self, asset1_id: int, asset2_id: int):
         try:
@@ -151,3 +320,129 @@ class PriceCacher(DataCacher):
             self.logger.critical(f'Pool does not exist: {e}')
             return None
 
+def pool_delta_transaction(tx: dict, addresses) -> Optional[tuple[str, dict]]:
+    """ Pool address of an application call among addresses, with the call restricted to the local state delta
+    of that pool, as returned by the queries by address """
+    for delta in tx.get('local-state-delta', []):
+        if delta.get('address') in addresses:
+            return delta['address'], {**tx, 'local-state-delta': [delta]}
+    return None
+
+
+class AppPriceScraper:
+    """ Pool states of many pools from one stream of the calls to the Tinyman validator app, instead of one
+    stream per pool address. The calls are demultiplexed by the address of their local state delta and parsed
+    latest first, so that each pool gets the same states as from PriceScraper """
+
+    def __init__(self, client: TinymanClient, pools: list[tuple[int, int]], skip_same_time: bool = False):
+        self.logger = logging.getLogger("AppPriceScraper")
+
+        self.app_id = client.validator_app_id
+        self.skip_same_time = skip_same_time
+
+        self.pool_assets: dict[str, tuple[int, int]] = {}
+        for asset1_id, asset2_id in pools:
+            pool = client.fetch_pool(asset1_id, asset2_id)
+            if not pool.exists:
+                self.logger.critical(f'Pool does not exist: {asset1_id}, {asset2_id}')
+                continue
+            self.pool_assets[pool.address] = (asset1_id, asset2_id)
+
+    async def scrape(self, session: aiohttp.ClientSession,
+                     query_params: QueryParams,
+                     priority: RequestPriority = RequestPriority.BACKFILL,
+                     journal: Optional[PageJournal] = None) -> dict[tuple[int, int], list[PoolState]]:
+        """ Pool states of each pool in the range of query_params, latest first """
+        pool_txs: dict[str, list[dict]] = {address: [] for address in self.pool_assets}
+
+        # Queries without an address are returned in chain order
+        async for tx in query_transactions(session=session,
+                                           params={'application-id': self.app_id, 'tx-type': 'appl'},
+                                           num_queries=None,
+                                           query_params=query_params,
+                                           priority=priority,
+                                           journal=journal,
+                                           prefetch=DEFAULT_PREFETCH):
+            match = pool_delta_transaction(tx, pool_txs)
+            if match:
+                pool_txs[match[0]].append(match[1])
+
+        states = {}
+        for address, txs in pool_txs.items():
+            parser = PoolStateParser(self.skip_same_time)
+            states[self.pool_assets[address]] = [ps for ps in map(parser.push, reversed(txs)) if ps]
+        return states
+
+
+class AppPriceCacher:
+    """ Builds the price cache of a universe from one stream of the validator app calls per shard of time,
+    rather than one stream per pool. A day is fetched once for all the pools missing it """
+
+    def __init__(self, client: TinymanClient,
+                 pool_id_store: PoolIdStore,
+                 date_min: datetime.datetime,
+                 date_max: Optional[datetime.datetime],
+                 dry_run: bool,
+                 shard_hours: int = 24,
+                 max_shards_in_flight: int = 8,
+                 max_days_in_flight: int = 2):
+
+        self.dry_run = dry_run
+
+        assert 24 % shard_hours == 0, f"shard_hours = {shard_hours} must divide a day"
+        self.shard_length = datetime.timedelta(hours=shard_hours)
+        self.max_shards_in_flight = max_shards_in_flight
+        # The states of all the pools of a day are held in memory until the day is written
+        self.max_days_in_flight = max_days_in_flight
+
+        self.scraper = AppPriceScraper(client, [(x.asset1_id, x.asset2_id) for x in pool_id_store.pools])
+        self.dateScheduler = DateScheduler(date_min, date_max)
+
+        self.cache_basedir = PRICE_CACHES_BASEDIR
+        # Days are written and journaled as by the DataCacher of each pool
+        self.day_store = DayStore(self.cache_basedir, type(self).__name__, dry_run)
+        self.logger = logging.getLogger('AppPriceCacher')
+
+    def cache(self, cache_name: str, dest_cache: str):
+        # Cache directories are named after the assets in decreasing order
+        pools = [tuple(sorted(assets, reverse=True)) for assets in self.scraper.pool_assets.values()]
+        record_dvs = {assets: {PoolState: DateValidator(self.cache_basedir, cache_name, dest_cache, assets)}
+                      for assets in pools}
+        dates_to_fetch = {assets: self.dateScheduler.get_dates_to_fetch(
+            set.intersection(*[dv.get_existing_dates() for dv in dvs.values()])) for assets, dvs in record_dvs.items()}
+        dates = sorted(set().union(*dates_to_fetch.values()))
+        self.logger.info(f'Found {len(dates)} days to scrape for {len(pools)} pools')
+
+        journal_name = f'app_{self.scraper.app_id}'
+
+        async def main():
+            shard_semaphore = asyncio.Semaphore(self.max_shards_in_flight)
+            day_semaphore = asyncio.Semaphore(self.max_days_in_flight)
+
+            async with aiohttp.ClientSession() as session:
+                async def fetch_shard(shard_name: str, query_params: QueryParams) -> dict[tuple, list[PoolState]]:
+                    async with shard_semaphore:
+                        return await self.scraper.scrape(session=session,
+                                                         query_params=query_params,
+                                                         journal=self.day_store.make_journal(dest_cache, journal_name,
+                                                                                             shard_name))
+
+                async def cache_day(date: datetime.datetime):
+                    async with day_semaphore:
+                        day_shards = [time_shard(*shard) for shard in
+                                      make_shards(date, date + datetime.timedelta(days=1), self.shard_length)]
+                        shard_states = await asyncio.gather(*[fetch_shard(*shard) for shard in day_shards])
+
+                        for assets in pools:
+                            if date in dates_to_fetch[assets]:
+                                shard_data = [{PoolState: pd.DataFrame(shard[assets])} if shard[assets] else {}
+                                              for shard in shard_states]
+                                self.day_store.store_day(record_dvs[assets], shard_data, date)
+                        self.day_store.clear_journals(dest_cache, journal_name,
+                                                      [shard_name for shard_name, _ in day_shards])
+
+                await asyncio.gather(*[cache_day(date) for date in dates])
+
+        uvloop.install()
+
+        asyncio.run(main())
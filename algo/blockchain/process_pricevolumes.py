@@ -0,0 +1,192 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import Optional, Union, AsyncGenerator, Any
+from algo.blockchain.algo_requests import query_transactions, query_transaction_pages, QueryParams, RequestPriority, PageJournal, \
+    DEFAULT_PREFETCH
+from algo.blockchain.base import DataScraper, NotExistentPoolError
+from algo.blockchain.cache import DataCacher
+from algo.blockchain.process_prices import PoolState, PoolStateParser, PRICE_CACHES_BASEDIR, pool_state_columns, \
+    pool_states_frame
+from algo.blockchain.process_volumes import Swap, SwapMatcher, get_pool_transaction, VOLUME_CACHES_BASEDIR, \
+    pool_transfer_columns, swaps_frame
+from concurrent.futures import Executor
+from functools import partial
+from algo.universe.pools import PoolIdStore
+from tinyman.v1.client import TinymanClient
+from definitions import ROOT_DIR
+import datetime
+import logging
+import aiohttp
+import json
+import numpy as np
+import orjson
+import pandas as pd
+
+RAW_CACHES_BASEDIR = f'{ROOT_DIR}/caches/raw'
+
+
+@dataclass
+class RawTransaction:
+    time: int
+    block: int
+    intra_round_offset: int
+    tx_type: str
+    id: str
+    # The transaction as returned by the indexer, serialised to json
+    raw: str
+
+    @staticmethod
+    def from_txn(tx: dict) -> RawTransaction:
+        return RawTransaction(time=tx['round-time'],
+                              block=tx['confirmed-round'],
+                              intra_round_offset=tx.get('intra-round-offset', 0),
+                              tx_type=tx['tx-type'],
+                              id=tx['id'],
+                              raw=json.dumps(tx))
+
+
+class PriceVolumeParser:
+    """ Extracts the pool states and the swaps from the transactions of a pool, received latest first """
+
+    def __init__(self, address: str, asset1_id: int, asset2_id: int):
+        self.address = address
+        self.pool_state_parser = PoolStateParser()
+        self.swap_matcher = SwapMatcher(asset1_id, asset2_id)
+
+    def push(self, tx: dict) -> Optional[Union[PoolState, Swap]]:
+        if tx['tx-type'] == 'appl':
+            return self.pool_state_parser.push(tx)
+        pt = get_pool_transaction(tx, self.address)
+        if pt:
+            return self.swap_matcher.push(pt)
+        return None
+
+    def flush(self) -> Optional[Swap]:
+        """ Swap of the last group of transactions pushed """
+        return self.swap_matcher.flush()
+
+
+def decode_pool_page(body: bytes, pool_address: str) -> tuple[Optional[str],
+                                                              tuple[dict[str, np.ndarray], dict[str, np.ndarray]]]:
+    """ Page decoder extracting both the pool states and the transfers of a pool straight into columns """
+    resp = orjson.loads(body)
+    return resp.get('next-token'), (pool_state_columns(resp['transactions']),
+                                    pool_transfer_columns(resp['transactions'], pool_address))
+
+
+class PriceVolumeScraper(DataScraper):
+    """ Extracts both the pool states and the swaps of a pool from a single pass over its transactions.
+    With archive_raw it also yields the raw transactions """
+
+    def __init__(self, client: TinymanClient, asset1_id: int, asset2_id: int, archive_raw: bool = False):
+
+        self.logger = logging.getLogger("PriceVolumeScraper")
+
+        pool = client.fetch_pool(asset1_id, asset2_id)
+
+        if not pool.exists:
+            raise NotExistentPoolError(f"{asset1_id}, {asset2_id}")
+        self.liquidity_asset = pool.liquidity_asset.id
+
+        self.asset1_id = asset1_id
+        self.asset2_id = asset2_id
+        self.address = pool.address
+        self.archive_raw = archive_raw
+
+    async def scrape(self, session: aiohttp.ClientSession,
+                     timestamp_min: Optional[int],
+                     query_params: QueryParams,
+                     num_queries: Optional[int] = None,
+                     priority: RequestPriority = RequestPriority.BACKFILL,
+                     journal: Optional[PageJournal] = None) -> AsyncGenerator[Union[PoolState, Swap, RawTransaction], Any]:
+
+        parser = PriceVolumeParser(self.address, self.asset1_id, self.asset2_id)
+
+        async for tx in query_transactions(session=session,
+                                           params={'address': self.address},
+                                           num_queries=num_queries,
+                                           query_params=query_params,
+                                           priority=priority,
+                                           journal=journal):
+
+            if timestamp_min is not None and tx['round-time'] < timestamp_min:
+                break
+
+            if self.archive_raw:
+                yield RawTransaction.from_txn(tx)
+
+            x = parser.push(tx)
+            if x:
+                yield x
+
+        swap = parser.flush()
+        if swap:
+            yield swap
+
+    async def scrape_frames(self, session: aiohttp.ClientSession,
+                            query_params: QueryParams,
+                            priority: RequestPriority = RequestPriority.BACKFILL,
+                            journal: Optional[PageJournal] = None,
+                            executor: Optional[Executor] = None) -> dict[type, pd.DataFrame]:
+        """ Columnar counterpart of scrape, the raw transactions can only be archived by scrape """
+        if self.archive_raw:
+            return await super().scrape_frames(session, query_params, priority, journal, executor)
+
+        pages = [page async for page in query_transaction_pages(session=session,
+                                                                params={'address': self.address},
+                                                                num_queries=None,
+                                                                query_params=query_params,
+                                                                decode=partial(decode_pool_page,
+                                                                               pool_address=self.address),
+                                                                priority=priority,
+                                                                journal=journal,
+                                                                executor=executor,
+                                                                prefetch=DEFAULT_PREFETCH)]
+        frames = {PoolState: pool_states_frame([states for states, _ in pages]),
+                  Swap: swaps_frame([transfers for _, transfers in pages], self.asset1_id, self.asset2_id)}
+        return {record_type: df for record_type, df in frames.items() if not df.empty}
+
+
+class PriceVolumeCacher(DataCacher):
+    """ Builds the price and the volume caches with one indexer stream per pool. With archive_raw the raw
+    transactions are also archived, so that the caches can be derived again offline with rederive_caches """
+
+    def __init__(self, client: TinymanClient,
+                 pool_id_store: PoolIdStore,
+                 date_min: datetime.datetime,
+                 date_max: Optional[datetime.datetime],
+                 dry_run: bool,
+                 shard_hours: int = 24,
+                 max_shards_in_flight: int = 8,
+                 archive_raw: bool = False,
+                 shard_rows: Optional[int] = None):
+
+        self.archive_raw = archive_raw
+
+        super().__init__(pool_id_store,
+                         PRICE_CACHES_BASEDIR,
+                         client,
+                         date_min,
+                         date_max,
+                         dry_run,
+                         shard_hours,
+                         max_shards_in_flight,
+                         shard_rows)
+
+    def record_basedirs(self) -> dict[type, str]:
+        basedirs = {PoolState: PRICE_CACHES_BASEDIR, Swap: VOLUME_CACHES_BASEDIR}
+        if self.archive_raw:
+            basedirs[RawTransaction] = RAW_CACHES_BASEDIR
+        return basedirs
+
+    def write_options(self, record_type: type) -> dict:
+        if record_type is RawTransaction:
+            return {'compression': 'zstd'}
+        return super().write_options(record_type)
+
+    def make_scraper(self, asset1_id: int, asset2_id: int):
+        try:
+            return PriceVolumeScraper(self.client, asset1_id, asset2_id, archive_raw=self.archive_raw)
+        except NotExistentPoolError as e:
+            self.logger.critical(f'Pool does not exist: {e}')
+            return None
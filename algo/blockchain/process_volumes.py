@@ -1,7 +1,13 @@
 import json
+from concurrent.futures import Executor
+from functools import partial
+import numpy as np
+import orjson
+import pandas as pd
 from dataclasses import dataclass
 from typing import Optional
-from algo.blockchain.algo_requests import query_transactions, QueryParams
+from algo.blockchain.algo_requests import query_transactions, query_transaction_pages, QueryParams, RequestPriority, PageJournal, \
+    DEFAULT_PREFETCH
 from tinyman.v1.client import TinymanClient
 from algo.blockchain.base import DataScraper, NotExistentPoolError
 from algo.blockchain.cache import DataCacher
@@ -21,52 +27,64 @@ class PoolTransaction:
     counterparty: str
     tx_type: str
     time: int
+    # Atomic group of the transaction, None outside of groups
+    group: Optional[str] = None
+
+
+def get_pool_transaction(tx: dict, pool_address: str) -> Optional[PoolTransaction]:
+    """ Signed transfer of Algo or ASA into the pool, None for other transactions """
+    try:
+        if tx['tx-type'] == 'axfer':
+            # ASA
+            key = 'asset-transfer-transaction'
+            asset_id = tx[key]['asset-id']
+
+        elif tx['tx-type'] == 'pay':
+            # Algo
+            key = 'payment-transaction'
+            asset_id = 0
+        else:
+            return None
+
+        receiver, sender = tx[key]['receiver'], tx['sender']
+
+        if pool_address == receiver:
+            counterparty = sender
+            sign = +1
+        elif pool_address == sender:
+            counterparty = receiver
+            sign = -1
+        elif pool_address == tx[key]['close-to']:
+            # I haven't understood this case but hopefully it's not too important
+            return None
+        else:
+            raise ValueError(f'pool_address {pool_address} neither in sender nor receiver')
+
+        amount = sign * tx[key]['amount']
+        block = tx['confirmed-round']
+        return PoolTransaction(amount, asset_id, block, counterparty, tx['tx-type'], tx['round-time'], tx.get('group'))
+
+    except Exception as e:
+        raise Exception(json.dumps(tx, indent=4)) from e
 
 
 async def query_transactions_for_pool(session: aiohttp.ClientSession,
                                       pool_address: str,
                                       num_queries: int,
-                                      query_params: QueryParams
+                                      query_params: QueryParams,
+                                      priority: RequestPriority = RequestPriority.BACKFILL,
+                                      journal: Optional[PageJournal] = None
                                       ):
     async for tx in query_transactions(session=session,
                                        params={'address': pool_address},
                                        num_queries=num_queries,
-                                       query_params=query_params
+                                       query_params=query_params,
+                                       priority=priority,
+                                       journal=journal
                                        ):
-
-        try:
-            if tx['tx-type'] == 'axfer':
-                # ASA
-                key = 'asset-transfer-transaction'
-                asset_id = tx[key]['asset-id']
-
-            elif tx['tx-type'] == 'pay':
-                # Algo
-                key = 'payment-transaction'
-                asset_id = 0
-            else:
-                continue
-
-            receiver, sender = tx[key]['receiver'], tx['sender']
-
-            if pool_address == receiver:
-                counterparty = sender
-                sign = +1
-            elif pool_address == sender:
-                counterparty = receiver
-                sign = -1
-            elif pool_address == tx[key]['close-to']:
-                # I haven't understood this case but hopefully it's not too important
-                continue
-            else:
-                raise ValueError(f'pool_address {pool_address} neither in sender nor receiver')
-
-            amount = sign * tx[key]['amount']
-            block = tx['confirmed-round']
-            yield PoolTransaction(amount, asset_id, block, counterparty, tx['tx-type'], tx['round-time'])
-
-        except Exception as e:
-            raise Exception(json.dumps(tx, indent=4)) from e
+        pt = get_pool_transaction(tx, pool_address)
+        if pt is not None:
+            yield pt
 
 
 # Logged swap for a pool, excluding redeeming amounts
@@ -81,9 +99,118 @@ class Swap:
     time: int
 
 
-# TODO Check this is valid, does it also hold for pools without Algo?
-def is_fee_payment(tx: PoolTransaction):
-    return tx.asset_id == 0 and tx.amount == 2000 and tx.tx_type == 'pay'
+TRANSFER_COLUMNS = {'group': object, 'block': np.int64, 'intra_round_offset': np.int64, 'time': np.int64,
+                    'asset_id': np.int64, 'amount': np.int64, 'counterparty': object, 'is_pay': bool}
+
+
+def pool_transfer_columns(transactions: list[dict], pool_address: str) -> dict[str, np.ndarray]:
+    """ Transfers of Algo and ASA in and out of a pool among the transactions of a page as columns, in the order
+    of the page, with the amounts signed as in get_pool_transaction """
+    rows = []
+    for tx in transactions:
+        tx_type = tx['tx-type']
+        if tx_type == 'axfer':
+            transfer = tx['asset-transfer-transaction']
+            asset_id = transfer['asset-id']
+        elif tx_type == 'pay':
+            transfer = tx['payment-transaction']
+            asset_id = 0
+        else:
+            continue
+        receiver, sender = transfer.get('receiver'), tx['sender']
+        if receiver == pool_address:
+            counterparty, amount = sender, transfer['amount']
+        elif sender == pool_address:
+            counterparty, amount = receiver, -transfer['amount']
+        else:
+            continue
+        rows.append((tx.get('group'), tx['confirmed-round'], tx.get('intra-round-offset', 0), tx['round-time'],
+                     asset_id, amount, counterparty, tx_type == 'pay'))
+
+    columns = list(zip(*rows)) if rows else [()] * len(TRANSFER_COLUMNS)
+    return {key: np.array(col, dtype=dtype) for (key, dtype), col in zip(TRANSFER_COLUMNS.items(), columns)}
+
+
+def decode_pool_transfers_page(body: bytes, pool_address: str) -> tuple[Optional[str], dict[str, np.ndarray]]:
+    """ Page decoder extracting the transfers of a pool straight into columns """
+    resp = orjson.loads(body)
+    return resp.get('next-token'), pool_transfer_columns(resp['transactions'], pool_address)
+
+
+def swaps_frame(pages: list[dict[str, np.ndarray]], asset1_id: int, asset2_id: int) -> pd.DataFrame:
+    """ Swaps of a pool from its transfers decoded by pool_transfer_columns, with the columns of Swap, latest first.
+    The transfers are grouped by their atomic group id: the transfers of a swap group are the fee paid in Algo
+    into the pool first, then one transfer in and one transfer out of the two assets of the pool, all with the
+    same counterparty. The groups of the other operations (mint, burn, redeem) have a different shape """
+    columns = {key: np.concatenate([page[key] for page in pages]) if pages else np.empty(0, dtype=dtype)
+               for key, dtype in TRANSFER_COLUMNS.items()}
+
+    group = columns['group']
+    grouped = np.flatnonzero(pd.notna(group))
+    codes = pd.factorize(group[grouped])[0]
+    # Transfers of the same group next to each other, in chain order
+    sort = np.lexsort((columns['intra_round_offset'][grouped], columns['block'][grouped], codes))
+    rows = grouped[sort][np.bincount(codes)[codes[sort]] == 3].reshape(-1, 3)
+    fee, x, y = rows.T
+
+    asset_id, amount, counterparty = columns['asset_id'], columns['amount'], columns['counterparty']
+    is_swap = columns['is_pay'][fee] & (asset_id[fee] == 0) & (amount[fee] > 0) \
+        & (counterparty[x] == counterparty[fee]) & (counterparty[y] == counterparty[fee]) \
+        & np.isin(asset_id[x], [asset1_id, asset2_id]) & np.isin(asset_id[y], [asset1_id, asset2_id]) \
+        & (asset_id[x] != asset_id[y]) & (np.sign(amount[x]) * np.sign(amount[y]) == -1)
+    fee, x, y = fee[is_swap], x[is_swap], y[is_swap]
+
+    df = pd.DataFrame({'asset1_amount': np.where(asset_id[x] == asset1_id, amount[x], amount[y]),
+                       'asset2_amount': np.where(asset_id[x] == asset2_id, amount[x], amount[y]),
+                       'counterparty': counterparty[fee],
+                       'block': columns['block'][fee],
+                       'time': columns['time'][fee]})
+    latest_first = np.lexsort((-columns['intra_round_offset'][fee], -columns['block'][fee]))
+    return df.iloc[latest_first].reset_index(drop=True)
+
+
+def match_swap_group(transfers: list[PoolTransaction], asset1_id: int, asset2_id: int) -> Optional[Swap]:
+    """ Swap of the transfers of a pool in an atomic group, in chain order, with the same rules as swaps_frame """
+    if len(transfers) != 3:
+        return None
+    fee, x, y = transfers
+    assets = [asset1_id, asset2_id]
+    if not (fee.tx_type == 'pay' and fee.asset_id == 0 and fee.amount > 0
+            and x.counterparty == fee.counterparty and y.counterparty == fee.counterparty
+            and x.asset_id in assets and y.asset_id in assets and x.asset_id != y.asset_id
+            and np.sign(x.amount) * np.sign(y.amount) == -1):
+        return None
+    amounts = {x.asset_id: x.amount, y.asset_id: y.amount}
+    return Swap(asset1_amount=amounts[asset1_id],
+                asset2_amount=amounts[asset2_id],
+                counterparty=fee.counterparty,
+                block=fee.block,
+                time=fee.time)
+
+
+class SwapMatcher:
+    """ Reconstructs the swaps of a pool from its transactions, received latest first as returned by the indexer.
+    The transfers of a group are matched together once the group is complete, as in swaps_frame, so the swap of
+    the last group is only returned by flush """
+
+    def __init__(self, asset1_id: int, asset2_id: int):
+        self.asset1_id = asset1_id
+        self.asset2_id = asset2_id
+        # Transfers of the current group, latest first
+        self.group_transfers: list[PoolTransaction] = []
+
+    def flush(self) -> Optional[Swap]:
+        transfers = self.group_transfers[::-1]
+        self.group_transfers = []
+        return match_swap_group(transfers, self.asset1_id, self.asset2_id)
+
+    def push(self, tx: PoolTransaction) -> Optional[Swap]:
+        swap = None
+        if self.group_transfers and tx.group != self.group_transfers[0].group:
+            swap = self.flush()
+        if tx.group is not None:
+            self.group_transfers.append(tx)
+        return swap
 
 
 class SwapScraper(DataScraper):
@@ -102,55 +229,46 @@ class SwapScraper(DataScraper):
     async def scrape(self, session: aiohttp.ClientSession,
                      timestamp_min: Optional[int],
                      query_params: QueryParams,
-                     num_queries: Optional[int] = None):
-
-        def is_transaction_in(tx: PoolTransaction, transaction_out: PoolTransaction):
-            return tx.counterparty == transaction_out.counterparty \
-                   and tx.asset_id != transaction_out.asset_id \
-                   and tx.asset_id in [self.asset1_id, self.asset2_id] \
-                   and not is_fee_payment(tx)
+                     num_queries: Optional[int] = None,
+                     priority: RequestPriority = RequestPriority.BACKFILL,
+                     journal: Optional[PageJournal] = None):
 
-        transaction_out: Optional[PoolTransaction] = None
-        transaction_in: Optional[PoolTransaction] = None
+        matcher = SwapMatcher(self.asset1_id, self.asset2_id)
 
-        async for tx in query_transactions_for_pool(session, self.address, num_queries, query_params=query_params):
+        async for tx in query_transactions_for_pool(session, self.address, num_queries, query_params=query_params,
+                                                    priority=priority, journal=journal):
 
             if timestamp_min is not None and tx.time < timestamp_min:
                 break
 
-            if transaction_out:
-                # We recorded a transaction out and in, looking for a fee payment
-                if transaction_in:
-                    if is_fee_payment(tx) and tx.counterparty == transaction_in.counterparty:
-                        if transaction_in.asset_id == self.asset1_id and transaction_out.asset_id == self.asset2_id:
-                            asset1_amount = transaction_in.amount
-                            asset2_amount = transaction_out.amount
-                        elif transaction_in.asset_id == self.asset2_id and transaction_out.asset_id == self.asset1_id:
-                            asset2_amount = transaction_in.amount
-                            asset1_amount = transaction_out.amount
-                        else:
-                            raise ValueError
-                        assert transaction_in.amount > 0 > transaction_out.amount
-
-                        yield Swap(asset1_amount=asset1_amount,
-                                   asset2_amount=asset2_amount,
-                                   counterparty=tx.counterparty,
-                                   block=tx.block,
-                                   time=tx.time
-                                   )
-                    transaction_out = None
-                    transaction_in = None
-
-                # We recorded a transaction out, looking for a transaction in
-                else:
-                    # TODO We should account for redeeming excess funds from the pool?
-                    if is_transaction_in(tx, transaction_out):
-                        transaction_in = tx
-                    else:
-                        transaction_out = None
-            else:
-                if tx.amount < 0 and tx.asset_id in [self.asset1_id, self.asset2_id]:
-                    transaction_out = tx
+            swap = matcher.push(tx)
+            if swap:
+                yield swap
+
+        swap = matcher.flush()
+        if swap:
+            yield swap
+
+    async def scrape_frames(self, session: aiohttp.ClientSession,
+                            query_params: QueryParams,
+                            priority: RequestPriority = RequestPriority.BACKFILL,
+                            journal: Optional[PageJournal] = None,
+                            executor: Optional[Executor] = None) -> dict[type, pd.DataFrame]:
+        """ Columnar counterpart of scrape, matching the swaps by transaction group """
+        pages = [page async for page in query_transaction_pages(session=session,
+                                                                params={'address': self.address},
+                                                                num_queries=None,
+                                                                query_params=query_params,
+                                                                decode=partial(decode_pool_transfers_page,
+                                                                               pool_address=self.address),
+                                                                priority=priority,
+                                                                journal=journal,
+                                                                executor=executor,
+                                                                prefetch=DEFAULT_PREFETCH)]
+        df = swaps_frame(pages, self.asset1_id, self.asset2_id)
+        if df.empty:
+            return {}
+        return {Swap: df}
 
 
 class VolumeCacher(DataCacher):
@@ -158,8 +276,12 @@ class VolumeCacher(DataCacher):
     def __init__(self, client: TinymanClient, pool_id_store: PoolIdStore,
                  date_min: datetime.datetime,
                  date_max: Optional[datetime.datetime],
-                 dry_run:bool):
-        super().__init__(pool_id_store, VOLUME_CACHES_BASEDIR, client, date_min, date_max, dry_run)
+                 dry_run: bool,
+                 shard_hours: int = 24,
+                 max_shards_in_flight: int = 8,
+                 shard_rows: Optional[int] = None):
+        super().__init__(pool_id_store, VOLUME_CACHES_BASEDIR, client, date_min, date_max, dry_run,
+                         shard_hours, max_shards_in_flight, shard_rows)
 
     def make_scraper(self, asset1_id: int, asset2_id: int):
         try:
@@ -0,0 +1,103 @@
+import asyncio
+import math
+import os
+import sqlite3
+from contextlib import closing
+from typing import Optional
+import aiohttp
+from algo.blockchain.algo_requests import RequestPriority, get_json, transactions_url, aget_current_round
+from definitions import ROOT_DIR
+
+ROUND_INDEX_FILE = f'{ROOT_DIR}/caches/rounds.sqlite'
+# Transactions of the page sampled to estimate the size of a round range
+SAMPLE_LIMIT = 1000
+
+
+class RoundIndex:
+    """ Samples of the round -> timestamp mapping of the chain, persisted in SQLite, used to find the first round
+    at a given time by binary search. Every sample fetched is kept, so that later searches start from a narrower
+    range and repeated searches need no request at all """
+
+    def __init__(self, dbfile: str = ROUND_INDEX_FILE):
+        self.dbfile = dbfile
+        os.makedirs(os.path.dirname(dbfile), exist_ok=True)
+        with closing(self._connect()) as con, con:
+            con.execute("create table if not exists rounds (round INTEGER PRIMARY KEY, time INTEGER NOT NULL)")
+            con.execute("create index if not exists rounds_time on rounds (time)")
+        # Searches in progress, shared by the concurrent callers looking for the same time
+        self._searches: dict[int, asyncio.Task] = {}
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.dbfile, timeout=60)
+
+    def _bounds(self, timestamp: int) -> tuple[int, Optional[int]]:
+        """ Last known round before timestamp and first known round at or after it """
+        with closing(self._connect()) as con:
+            lo = con.execute("select round from rounds where time < ? order by time desc, round desc limit 1",
+                             (timestamp,)).fetchone()
+            hi = con.execute("select round from rounds where time >= ? order by time, round limit 1",
+                             (timestamp,)).fetchone()
+        return (lo[0] if lo else 0), (hi[0] if hi else None)
+
+    def _add(self, rnd: int, timestamp: int):
+        with closing(self._connect()) as con, con:
+            con.execute("insert or replace into rounds values (?, ?)", (rnd, timestamp))
+
+    async def round_time(self, session: aiohttp.ClientSession, rnd: int,
+                         priority: RequestPriority = RequestPriority.BACKFILL) -> Optional[int]:
+        """ Time of the first transaction at or after round rnd, None past the last transaction of the chain.
+        Rounds without transactions take the time of the next one, which keeps the mapping monotonic """
+        resp = await get_json(session, transactions_url(), {'min-round': rnd, 'limit': 1}, priority)
+        if not resp['transactions']:
+            return None
+        timestamp = resp['transactions'][0]['round-time']
+        self._add(rnd, timestamp)
+        return timestamp
+
+    async def _search(self, session: aiohttp.ClientSession, timestamp: int, priority: RequestPriority) -> int:
+        lo, hi = self._bounds(timestamp)
+        if hi is None:
+            hi = await aget_current_round(session, priority) + 1
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            mid_time = await self.round_time(session, mid, priority)
+            if mid_time is not None and mid_time < timestamp:
+                lo = mid
+            else:
+                hi = mid
+        return hi
+
+    async def first_round_at(self, session: aiohttp.ClientSession, timestamp: int,
+                             priority: RequestPriority = RequestPriority.BACKFILL) -> int:
+        """ First round whose transactions are at or after timestamp """
+        if timestamp not in self._searches:
+            self._searches[timestamp] = asyncio.ensure_future(self._search(session, timestamp, priority))
+        return await self._searches[timestamp]
+
+
+async def sample_transactions(session: aiohttp.ClientSession, address: str, round_min: int, round_max: int,
+                              limit: int = SAMPLE_LIMIT,
+                              priority: RequestPriority = RequestPriority.BACKFILL) -> float:
+    """ Expected transactions of address in the rounds [round_min, round_max), from one page of the latest ones.
+    A full page is extrapolated to the whole range from the rounds it spans """
+    if round_max <= round_min:
+        return 0
+    params = {'address': address, 'min-round': round_min, 'max-round': round_max - 1, 'limit': limit}
+    txs = (await get_json(session, transactions_url(), params, priority))['transactions']
+    if len(txs) < limit:
+        return len(txs)
+    # Queries by address are returned latest first
+    sampled_rounds = round_max - txs[-1]['confirmed-round']
+    return len(txs) * (round_max - round_min) / sampled_rounds
+
+
+def split_rounds(round_min: int, round_max: int, expected_rows: Optional[float],
+                 rows_per_shard: int) -> list[tuple[int, int]]:
+    """ Splits the rounds [round_min, round_max) into [start, end) shards of about rows_per_shard expected rows
+    each, assuming the rows are spread uniformly over the rounds """
+    n_rounds = round_max - round_min
+    if n_rounds <= 0:
+        return []
+    n_shards = min(n_rounds, max(1, math.ceil((expected_rows or 0) / rows_per_shard)))
+    bounds = [round_min + (n_rounds * i) // n_shards for i in range(n_shards + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
@@ -1,17 +1,21 @@
 from __future__ import annotations
 import logging
-from algo.blockchain.process_volumes import PoolTransaction, Swap, is_fee_payment
+from algo.blockchain.process_volumes import PoolTransaction, Swap, match_swap_group
 from algo.blockchain.process_prices import PoolState, get_pool_state_txn
-from algo.blockchain.algo_requests import QueryParams
+from algo.blockchain.algo_requests import QueryParams, RequestPriority, transactions_url, get_request_scheduler, \
+    MAX_THROTTLED_RETRIES
+from algo.blockchain.columnar import ColumnarBuffer
+from algo.blockchain.merge import SourceQueue, DONE
 from algo.universe.universe import SimpleUniverse
-from typing import Optional, Union, Generator, Any
+from typing import Optional, Union, Generator, AsyncGenerator, Any
 import pandas as pd
-import requests
+import aiohttp
+import asyncio
+import threading
 from dataclasses import dataclass
 import datetime
 from datetime import timezone
 import numpy as np
-from algo.blockchain.utils import int_to_tzaware_utc_datetime
 import json
 
 
@@ -31,7 +35,7 @@ def get_pool_transaction_txn(tx: dict, pool_address: str, key: str, asset_id: in
 
     amount = sign * tx[key]['amount']
     block = tx['confirmed-round']
-    return PoolTransaction(amount, asset_id, block, counterparty, tx['tx-type'], tx['round-time'])
+    return PoolTransaction(amount, asset_id, block, counterparty, tx['tx-type'], tx['round-time'], tx.get('group'))
 
 
 class StreamException(Exception):
@@ -39,70 +43,232 @@ class StreamException(Exception):
         super().__init__(msg)
 
 
-class DataStream:
-    def __init__(self, universe: SimpleUniverse, query_params: QueryParams, next_token: Optional[str] = None):
+def make_session(limit: int = 10, keepalive_timeout: float = 60) -> aiohttp.ClientSession:
+    """ Session with a persistent pool of keep-alive connections to the indexer """
+    connector = aiohttp.TCPConnector(limit=limit, keepalive_timeout=keepalive_timeout)
+    return aiohttp.ClientSession(connector=connector)
+
+
+class AsyncDataStream:
+    def __init__(self, universe: Optional[SimpleUniverse], query_params: QueryParams,
+                 next_token: Optional[str] = None,
+                 session: Optional[aiohttp.ClientSession] = None,
+                 priority: RequestPriority = RequestPriority.LIVE):
         if universe:
             self.universe = universe
             self.pools = {x.address for x in universe.pools}
-        self.url = f'https://algoindexer.algoexplorerapi.io/v2/transactions'
+        self.url = transactions_url()
         self.params = query_params.make_params()
         if next_token:
             self.params['next'] = next_token
+        self.priority = priority
+
+        # Round and time of the last transaction received, from any address
+        self.last_round: Optional[int] = None
+        self.last_time: Optional[int] = None
+        # Consecutive requests rejected because of throttling
+        self.n_throttled = 0
+
+        # If no session is passed we open our own on first use, and keep it alive across calls
+        self.session = session
+        self.owns_session = session is None
 
         self.logger = logging.getLogger(__name__)
 
     @staticmethod
-    def from_address(address: str, query_params: QueryParams) -> DataStream:
-        datastream = DataStream(None, query_params)
+    def from_address(address: str, query_params: QueryParams,
+                     session: Optional[aiohttp.ClientSession] = None) -> AsyncDataStream:
+        datastream = AsyncDataStream(None, query_params, session=session)
         datastream.params['address'] = address
         datastream.pools = {address}
         return datastream
-    
-    def next_transaction(self):
-
-        with requests.session() as session:
-
-            while True:
-                self.logger.debug('Making new request')
 
-                try:
-                    req1 = session.get(url=self.url, params=self.params)
-                except requests.exceptions.ChunkedEncodingError as e:
-                    raise StreamException("ChunkedEncodingError")
+    async def close(self):
+        if self.owns_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def match_pool(self, tx: dict) -> Optional[str]:
+        if tx['sender'] in self.pools:
+            return tx['sender']
+        elif tx['tx-type'] == 'pay' and tx['payment-transaction']['receiver'] in self.pools:
+            return tx['payment-transaction']['receiver']
+        elif tx['tx-type'] == 'axfer' and tx['asset-transfer-transaction']['receiver'] in self.pools:
+            return tx['asset-transfer-transaction']['receiver']
+        return None
 
-                if not req1.ok:
+    async def next_page(self) -> tuple[list[tuple[str, dict]], bool]:
+        """ Query one page of transactions. Returns the (pool, transaction) pairs of the page,
+        and whether more pages are immediately available """
+        if self.session is None:
+            self.session = make_session()
+
+        self.logger.debug('Making new request')
+
+        scheduler = get_request_scheduler()
+        try:
+            async with scheduler.slot(self.priority), self.session.get(self.url, params=self.params) as resp:
+                if resp.status == 429:
+                    scheduler.throttled()
+                    self.n_throttled += 1
+                    if self.n_throttled > MAX_THROTTLED_RETRIES:
+                        raise StreamException(f'Throttled {self.n_throttled} times')
+                    return [], True
+                self.n_throttled = 0
+                if not resp.ok:
                     self.logger.critical("session.get response is not OK"
                                          f"\n url = {self.url}")
                     raise StreamException("Response not OK")
-
                 try:
-                    req = req1.json()
-                except json.decoder.JSONDecodeError as e:
-                    self.logger.critical(f"req1.json() failed: "
-                                         f"\n req1 = {req1}"
-                                         f"\n {e.msg}"
+                    req = await resp.json()
+                except (json.decoder.JSONDecodeError, aiohttp.ContentTypeError) as e:
+                    self.logger.critical(f"resp.json() failed: "
+                                         f"\n resp = {resp}"
+                                         f"\n {e}"
                                          f"\n url = {self.url}"
                                          )
                     raise StreamException("json.decoder.JSONDecodeError")
+        except aiohttp.ClientPayloadError as e:
+            raise StreamException("ClientPayloadError")
+
+        first_time = None
+        if req['transactions']:
+            first_time = datetime.datetime.fromtimestamp(req['transactions'][0]['round-time'])
+            self.last_round = req['transactions'][-1]['confirmed-round']
+            self.last_time = req['transactions'][-1]['round-time']
+        self.logger.debug(f'Queried transaction group, time={first_time}')
+
+        page = []
+        for tx in req['transactions']:
+            pool = self.match_pool(tx)
+            if pool:
+                page.append((pool, tx))
+
+        if 'next-token' not in req:
+            return page, False
+        self.params['next'] = req['next-token']
+        return page, True
+
+    async def next_transaction(self) -> AsyncGenerator[tuple[str, dict], Any]:
+        while True:
+            page, has_more = await self.next_page()
+            for x in page:
+                yield x
+            if not has_more:
+                break
+
+
+_background_loop: Optional[asyncio.AbstractEventLoop] = None
+_background_loop_lock = threading.Lock()
+
+
+def background_loop() -> asyncio.AbstractEventLoop:
+    """ Event loop running in a daemon thread, used to drive async streams from synchronous code,
+    also when the caller is itself running inside an event loop """
+    global _background_loop
+    with _background_loop_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(target=_background_loop.run_forever, daemon=True, name='DataStreamLoop').start()
+    return _background_loop
+
+
+# Items an async generator iterated from synchronous code runs ahead of its consumer
+BACKGROUND_CHUNK_SIZE = 1000
+
+
+class _BackgroundPump:
+    """ Consumes an async generator on the background loop into a bounded queue """
+
+    def __init__(self, agen: AsyncGenerator[Any, Any], depth: int):
+        self.source = SourceQueue(agen, depth)
+        self.error: Optional[BaseException] = None
+
+    async def next_chunk(self, max_items: int) -> tuple[list, bool]:
+        """ Waits for the next item and returns it with the items already queued after it, and whether the
+        generator is exhausted """
+        if self.error is not None:
+            raise self.error
+        chunk = []
+        x = await self.source.get()
+        while x is not DONE:
+            chunk.append(x)
+            if len(chunk) == max_items or self.source.empty():
+                return chunk, False
+            try:
+                x = self.source.get_nowait()
+            except Exception as e:
+                # Raised on the next call, after the items before it are consumed
+                self.error = e
+                return chunk, False
+        return chunk, True
+
+    async def stop(self):
+        await self.source.stop()
+
+
+def iterate_in_background(agen: AsyncGenerator[Any, Any],
+                          chunk_size: int = BACKGROUND_CHUNK_SIZE) -> Generator[Any, Any, Any]:
+    """ Iterates an async generator from synchronous code. The generator runs ahead on the background loop and the
+    items ready are handed over in chunks of up to chunk_size, one cross-thread round trip per chunk """
+    loop = background_loop()
+
+    async def start() -> _BackgroundPump:
+        return _BackgroundPump(agen, chunk_size)
+
+    pump = asyncio.run_coroutine_threadsafe(start(), loop).result()
+    try:
+        while True:
+            chunk, done = asyncio.run_coroutine_threadsafe(pump.next_chunk(chunk_size), loop).result()
+            yield from chunk
+            if done:
+                return
+    finally:
+        asyncio.run_coroutine_threadsafe(pump.stop(), loop).result()
+
+
+class DataStream:
+    """ Synchronous adapter of AsyncDataStream for the existing callers """
+
+    def __init__(self, universe: Optional[SimpleUniverse], query_params: QueryParams, next_token: Optional[str] = None):
+        self.async_stream = AsyncDataStream(universe, query_params, next_token)
+
+    @staticmethod
+    def from_address(address: str, query_params: QueryParams) -> DataStream:
+        datastream = DataStream(None, query_params)
+        datastream.async_stream.params['address'] = address
+        datastream.async_stream.pools = {address}
+        return datastream
+
+    @property
+    def universe(self) -> SimpleUniverse:
+        return self.async_stream.universe
+
+    @property
+    def pools(self) -> set[str]:
+        return self.async_stream.pools
+
+    @property
+    def params(self) -> dict:
+        return self.async_stream.params
+
+    def close(self):
+        """ Closes the session opened on the background loop """
+        asyncio.run_coroutine_threadsafe(self.async_stream.close(), background_loop()).result()
 
-                first_time = None
-                if req['transactions']:
-                    first_time = datetime.datetime.fromtimestamp(req['transactions'][0]['round-time'])
-                self.logger.debug(f'Queried transaction group, time={first_time}')
-
-                for tx in req['transactions']:
-                    pool = None
-                    if tx['sender'] in self.pools:
-                        pool = tx['sender']
-                    elif tx['tx-type'] == 'pay' and tx['payment-transaction']['receiver'] in self.pools:
-                        pool = tx['payment-transaction']['receiver']
-                    elif tx['tx-type'] == 'axfer' and tx['asset-transfer-transaction']['receiver'] in self.pools:
-                        pool = tx['asset-transfer-transaction']['receiver']
-                    if pool:
-                        yield pool, tx
-                if 'next-token' not in req:
-                    break
-                self.params['next'] = req['next-token']
+    def __enter__(self) -> DataStream:
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def next_transaction(self):
+        loop = background_loop()
+        while True:
+            page, has_more = asyncio.run_coroutine_threadsafe(self.async_stream.next_page(), loop).result()
+            yield from page
+            if not has_more:
+                break
 
 
 @dataclass
@@ -117,31 +283,110 @@ class PriceUpdate:
     price_update: PoolState
 
 
-def stream_from_price_df(df: pd.DataFrame, start_time: datetime.datetime) -> Generator[PriceUpdate, Any, Any]:
-    assert np.all(
-        df.columns == ['time', 'asset1_reserves', 'asset2_reserves', 'block', 'reverse_order_in_block', 'asset1',
-                       'asset2']), f'df.columns = {df.columns}'
-    df = df.sort_values(by='time')
+@dataclass
+class PriceUpdateBatch:
+    """ Consecutive price updates as arrays, one entry per update in chain order. Missing issued liquidity is nan.
+    The pool states are only materialised on demand, so that replaying a history allocates no object per update """
+    asset1: np.ndarray
+    asset2: np.ndarray
+    time: np.ndarray
+    block: np.ndarray
+    asset1_reserves: np.ndarray
+    asset2_reserves: np.ndarray
+    issued_liquidity: np.ndarray
+    reverse_order_in_block: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.time)
+
+    def __iter__(self) -> Generator[PriceUpdate, Any, Any]:
+        for i in range(len(self)):
+            yield PriceUpdate((int(self.asset1[i]), int(self.asset2[i])), self.pool_state(i))
+
+    def pool_state(self, i: int) -> PoolState:
+        issued_liquidity = self.issued_liquidity[i]
+        return PoolState(time=int(self.time[i]),
+                         asset1_reserves=int(self.asset1_reserves[i]),
+                         asset2_reserves=int(self.asset2_reserves[i]),
+                         issued_liquidity=None if np.isnan(issued_liquidity) else int(issued_liquidity),
+                         block=int(self.block[i]),
+                         reverse_order_in_block=int(self.reverse_order_in_block[i]))
+
+    def last_indices(self) -> dict[tuple[int, int], int]:
+        """ Index of the last update of each pool """
+        n = len(self)
+        keys = np.stack([self.asset1[::-1], self.asset2[::-1]], axis=1)
+        _, first = np.unique(keys, axis=0, return_index=True)
+        last = n - 1 - first
+        return {(int(self.asset1[i]), int(self.asset2[i])): int(i) for i in last}
+
+    @staticmethod
+    def from_frame(df: pd.DataFrame) -> PriceUpdateBatch:
+        """ Batch of the rows of a price DataFrame with the columns of the caches, in the order of the rows """
+        columns = {key: np.asarray(df[key], dtype=dtype) if key in df.columns else np.full(len(df), np.nan)
+                   for key, dtype in PRICE_COLUMNS.items()}
+        return PriceUpdateBatch(**columns)
 
+    @staticmethod
+    def from_updates(updates: list[PriceUpdate]) -> PriceUpdateBatch:
+        ps = [x.price_update for x in updates]
+        return PriceUpdateBatch(
+            asset1=np.array([x.asset_ids[0] for x in updates], dtype=np.int64),
+            asset2=np.array([x.asset_ids[1] for x in updates], dtype=np.int64),
+            time=np.array([x.time for x in ps], dtype=np.int64),
+            block=np.array([x.block for x in ps], dtype=np.int64),
+            asset1_reserves=np.array([x.asset1_reserves for x in ps], dtype=np.int64),
+            asset2_reserves=np.array([x.asset2_reserves for x in ps], dtype=np.int64),
+            issued_liquidity=np.array([np.nan if x.issued_liquidity is None else x.issued_liquidity for x in ps],
+                                      dtype=np.float64),
+            reverse_order_in_block=np.array([x.reverse_order_in_block for x in ps], dtype=np.int64))
+
+
+def batches_from_price_df(df: pd.DataFrame, start_time: datetime.datetime,
+                          batch_size: int = 10000) -> Generator[PriceUpdateBatch, Any, Any]:
+    """ Batched counterpart of stream_from_price_df """
+    required_columns = {'time', 'asset1_reserves', 'asset2_reserves', 'block', 'reverse_order_in_block', 'asset1',
+                        'asset2'}
+    assert required_columns <= set(df.columns), f'df.columns = {df.columns}'
     assert start_time.tzinfo == timezone.utc
 
-    def row_to_update(row):
-        return PriceUpdate(
-            asset_ids=(row['asset1'], row['asset2']),
-            price_update=PoolState(
-                time=row['time'],
-                asset1_reserves=row['asset1_reserves'],
-                asset2_reserves=row['asset2_reserves'],
-                block=row['block'],
-                reverse_order_in_block=None
-            )
-        )
+    # Chain order within each pool, the order across pools in the same block is not recorded in the caches
+    df = df.sort_values(by=['block', 'reverse_order_in_block', 'asset1', 'asset2'],
+                        ascending=[True, False, True, True], kind='stable')
+    df = df[df['time'].to_numpy() >= start_time.timestamp()]
+    for i in range(0, len(df), batch_size):
+        yield PriceUpdateBatch.from_frame(df.iloc[i:i + batch_size])
+
+
+def stream_from_price_df(df: pd.DataFrame, start_time: datetime.datetime) -> Generator[PriceUpdate, Any, Any]:
+    for batch in batches_from_price_df(df, start_time):
+        yield from batch
 
-    for _, row in df.iterrows():
-        time = int_to_tzaware_utc_datetime(row['time'])
 
-        if time >= start_time:
-            yield row_to_update(row)
+def batch_updates(gen: Generator[PriceUpdate, Any, Any],
+                  batch_size: int = 1000) -> Generator[PriceUpdateBatch, Any, Any]:
+    """ Groups the updates of a stream into batches of up to batch_size updates """
+    batch = []
+    for x in gen:
+        batch.append(x)
+        if len(batch) == batch_size:
+            yield PriceUpdateBatch.from_updates(batch)
+            batch = []
+    if batch:
+        yield PriceUpdateBatch.from_updates(batch)
+
+
+async def abatch_updates(gen: AsyncGenerator[PriceUpdate, Any],
+                         batch_size: int = 1000) -> AsyncGenerator[PriceUpdateBatch, Any]:
+    """ Same as batch_updates for an async stream """
+    batch = []
+    async for x in gen:
+        batch.append(x)
+        if len(batch) == batch_size:
+            yield PriceUpdateBatch.from_updates(batch)
+            batch = []
+    if batch:
+        yield PriceUpdateBatch.from_updates(batch)
 
 
 def only_price(gen: Generator[PriceOrVolumeUpdate, Any, Any]) -> Generator[PriceUpdate, Any, Any]:
@@ -150,25 +395,38 @@ def only_price(gen: Generator[PriceOrVolumeUpdate, Any, Any]) -> Generator[Price
             yield PriceUpdate(x.asset_ids, x.market_update)
 
 
-# FIXME this does not preserve chronological across different pools
+async def aonly_price(gen: AsyncGenerator[PriceOrVolumeUpdate, Any]) -> AsyncGenerator[PriceUpdate, Any]:
+    async for x in gen:
+        if isinstance(x.market_update, PoolState):
+            yield PriceUpdate(x.asset_ids, x.market_update)
+
+
 def filter_last_prices(gen: Generator[PriceOrVolumeUpdate, Any, Any]) -> Generator[PriceOrVolumeUpdate, Any, Any]:
+    """ Keeps the last price update of each pool at each time, and all the swaps. The updates must be in
+    chronological order across the pools, as merged by merge_sorted, and the output keeps that order """
     last_time: Optional[int] = None
-    last_price: Optional[PriceOrVolumeUpdate] = None
+    pending: list[Optional[PriceOrVolumeUpdate]] = []
+    last_price_idx: dict[tuple[int, int], int] = {}
     for update in gen:
-        if isinstance(update.market_update, Swap):
-            yield update
-        elif isinstance(update.market_update, PoolState):
-            time = update.market_update.time
-            if last_price:
-                assert time >= last_time
-                if time > last_time:
-                    yield last_price
-            last_price = update
-            last_time = time
-        else:
+        time = update.market_update.time
+        if last_time is not None:
+            assert time >= last_time
+            if time > last_time:
+                yield from (x for x in pending if x is not None)
+                pending = []
+                last_price_idx = {}
+        last_time = time
+
+        if isinstance(update.market_update, PoolState):
+            prev_idx = last_price_idx.get(update.asset_ids)
+            if prev_idx is not None:
+                pending[prev_idx] = None
+            last_price_idx[update.asset_ids] = len(pending)
+        elif not isinstance(update.market_update, Swap):
             raise ValueError
-    if last_price:
-        yield last_price
+        pending.append(update)
+
+    yield from (x for x in pending if x is not None)
 
 
 class PoolStateQueue:
@@ -180,7 +438,9 @@ class PoolStateQueue:
     def flush(self):
         reverse_block_order = len(self.app_tx_current_block) - 1
         for prev_asset_ids, prev_block_ps in self.app_tx_current_block:
-            yield PriceOrVolumeUpdate(prev_asset_ids, prev_block_ps.with_reverse_order(reverse_block_order))
+            # The queue owns the pool states pushed, so they are updated in place rather than copied
+            prev_block_ps.reverse_order_in_block = reverse_block_order
+            yield PriceOrVolumeUpdate(prev_asset_ids, prev_block_ps)
             reverse_block_order -= 1
         self.app_tx_current_block = []
 
@@ -194,79 +454,92 @@ class PoolStateQueue:
 
 
 class PriceVolumeStream:
-    def __init__(self, data_stream: DataStream):
+    def __init__(self, data_stream: Union[DataStream, AsyncDataStream]):
         self.data_stream = data_stream
 
         self.address_ids_map = {x.address: (x.asset1_id, x.asset2_id) for x in data_stream.universe.pools}
 
-        self.transaction_in_ = {pool: None for pool in self.address_ids_map.keys()}
-        self.transaction_fee_ = {pool: False for pool in self.address_ids_map.keys()}
+        # Transfers of the current group of each pool, in chain order
+        self.group_transfers_ = {pool: [] for pool in self.address_ids_map.keys()}
+        self.last_block = None
+
+    def _match_group(self, address: str) -> Generator[PriceOrVolumeUpdate, Any, Any]:
+        transfers = self.group_transfers_[address]
+        if transfers:
+            self.group_transfers_[address] = []
+            swap = match_swap_group(transfers, *self.address_ids_map[address])
+            if swap:
+                yield PriceOrVolumeUpdate(self.address_ids_map[address], swap)
+
+    def flush_swaps(self) -> Generator[PriceOrVolumeUpdate, Any, Any]:
+        """ Swaps of the groups still pending, which are complete at the end of the stream or of the last round """
+        for address in self.group_transfers_:
+            yield from self._match_group(address)
+
+    def process(self, address: str, tx: dict,
+                price_queue: PoolStateQueue) -> Generator[PriceOrVolumeUpdate, Any, Any]:
+        """ Updates completed by a transaction of a pool of the stream. The pool states are pushed to price_queue,
+        which yields them once their block is complete. The transfers of a group are matched together into a swap,
+        as in swaps_frame, once a later group of the pool or a later round is received """
+        if self.last_block is not None and tx['confirmed-round'] > self.last_block:
+            yield from self.flush_swaps()
+        self.last_block = tx['confirmed-round']
+
+        pt = None
+        asset_ids = self.address_ids_map[address]
+
+        if tx['tx-type'] == 'appl':
+            ps = get_pool_state_txn(tx)
+            if ps:
+                yield from price_queue.push_and_yield(ps, asset_ids)
+
+        elif tx['tx-type'] == 'pay':
+            key = 'payment-transaction'
+            pt = get_pool_transaction_txn(tx, address, key, 0)
+        elif tx['tx-type'] == 'axfer':
+            key = 'asset-transfer-transaction'
+            pt = get_pool_transaction_txn(tx, address, key, tx[key]['asset-id'])
+        if pt:
+            transfers = self.group_transfers_[address]
+            if transfers and pt.group != transfers[0].group:
+                yield from self._match_group(address)
+            if pt.group is not None:
+                self.group_transfers_[address].append(pt)
 
     def scrape(self) -> Generator[PriceOrVolumeUpdate, Any, Any]:
-
-        def is_transaction_out(tx: PoolTransaction, transaction_in: PoolTransaction,
-                               asset1_id: int, asset2_id: int):
-            return tx.amount < 0 and tx.counterparty == transaction_in.counterparty \
-                   and tx.asset_id != transaction_in.asset_id \
-                   and tx.asset_id in [asset1_id, asset2_id] \
-                   and not is_fee_payment(tx)
-
         price_queue = PoolStateQueue()
 
         for address, tx in self.data_stream.next_transaction():
-            pt = None
-            asset_ids = self.address_ids_map[address]
-
-            if tx['tx-type'] == 'appl':
-                ps = get_pool_state_txn(tx)
-                if ps:
-                    yield from price_queue.push_and_yield(ps, asset_ids)
-
-            elif tx['tx-type'] == 'pay':
-                key = 'payment-transaction'
-                pt = get_pool_transaction_txn(tx, address, key, 0)
-            elif tx['tx-type'] == 'axfer':
-                key = 'asset-transfer-transaction'
-                pt = get_pool_transaction_txn(tx, address, key, tx[key]['asset-id'])
-            if pt:
-                asset1_id = asset_ids[0]
-                asset2_id = asset_ids[1]
-                # adapted from algo.blockchain.process_volumes.SwapScraper.scrape
-                if self.transaction_fee_[address]:
-                    if self.transaction_in_[address]:
-                        if is_transaction_out(pt, self.transaction_in_[address], asset1_id, asset2_id):
-                            if self.transaction_in_[address].asset_id == asset1_id and pt.asset_id == asset2_id:
-                                asset1_amount = self.transaction_in_[address].amount
-                                asset2_amount = pt.amount
-                            elif self.transaction_in_[address].asset_id == asset2_id and pt.asset_id == asset1_id:
-                                asset2_amount = self.transaction_in_[address].amount
-                                asset1_amount = pt.amount
-                            else:
-                                raise ValueError
-                            assert self.transaction_in_[address].amount > 0 > pt.amount
-                            swap = Swap(asset1_amount=asset1_amount,
-                                        asset2_amount=asset2_amount,
-                                        counterparty=pt.counterparty,
-                                        block=pt.block,
-                                        time=pt.time)
-                            yield PriceOrVolumeUpdate(asset_ids, swap)
-                        self.transaction_fee_[address] = False
-                        self.transaction_in_[address] = None
-                    else:
-                        if pt.amount > 0 and not is_fee_payment(pt) and pt.asset_id in [asset1_id, asset2_id]:
-                            self.transaction_in_[address] = pt
-                        else:
-                            self.transaction_in_[address] = None
-                elif is_fee_payment(pt):
-                    self.transaction_fee_[address] = True
+            yield from self.process(address, tx, price_queue)
 
+        yield from self.flush_swaps()
         yield from price_queue.flush()
 
+    async def ascrape(self) -> AsyncGenerator[PriceOrVolumeUpdate, Any]:
+        """ Same as scrape, requires the underlying stream to be an AsyncDataStream """
+        price_queue = PoolStateQueue()
+
+        async for address, tx in self.data_stream.next_transaction():
+            for x in self.process(address, tx, price_queue):
+                yield x
+
+        for x in self.flush_swaps():
+            yield x
+        for x in price_queue.flush():
+            yield x
 
 
+# Columns of the price and volume frames, as the cached DataFrames
+PRICE_COLUMNS = {'time': np.int64, 'asset1_reserves': np.int64, 'asset2_reserves': np.int64,
+                 'issued_liquidity': np.float64, 'block': np.int64, 'reverse_order_in_block': np.int64,
+                 'asset1': np.int64, 'asset2': np.int64}
+VOLUME_COLUMNS = {'asset1_amount': np.int64, 'asset2_amount': np.int64, 'counterparty': object,
+                  'block': np.int64, 'time': np.int64, 'asset1': np.int64, 'asset2': np.int64}
 
 
 class PriceVolumeDataStore:
+    """ Accumulates the prices and volumes of a stream into columnar buffers, so that the frames returned are
+    views of the buffers and each update only costs the new rows """
 
     def __init__(self, price_volume_stream: PriceVolumeStream):
 
@@ -275,34 +548,36 @@ class PriceVolumeDataStore:
         self.address_ids_map = self.price_volume_stream.address_ids_map
         self._reset()
 
-    def _gen_df(self, data_map):
-        for ids, data in data_map.items():
-            df = pd.DataFrame(data)
-            df['asset1'] = ids[0]
-            df['asset2'] = ids[1]
-            yield df
-
     def _reset(self):
-        self.prices_ = {ids: list() for ids in self.address_ids_map.values()}
-        self.volumes_ = {ids: list() for ids in self.address_ids_map.values()}
+        self.prices_ = ColumnarBuffer(PRICE_COLUMNS)
+        self.volumes_ = ColumnarBuffer(VOLUME_COLUMNS)
+        self._returned = (None, None)
 
-    def volumes(self):
-        return pd.concat(self._gen_df(self.volumes_))
+    def volumes(self) -> pd.DataFrame:
+        return self.volumes_.frame()
 
-    def prices(self):
-        return pd.concat(self._gen_df(self.prices_))
+    def prices(self) -> pd.DataFrame:
+        return self.prices_.frame()
 
     def scrape(self):
         for update in self.price_volume_stream.scrape():
             if isinstance(update.market_update, Swap):
-                update_arr = self.volumes_
+                buffer = self.volumes_
             elif isinstance(update.market_update, PoolState):
-                update_arr = self.prices_
+                buffer = self.prices_
             else:
                 raise ValueError
-            update_arr[update.asset_ids].append(update.market_update)
-
-    def update(self, prices, volumes):
-        self._reset()
+            buffer.append({**update.market_update.__dict__,
+                           'asset1': update.asset_ids[0], 'asset2': update.asset_ids[1]})
+
+    def update(self, prices: pd.DataFrame, volumes: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """ prices and volumes with the new updates of the stream appended. The buffers are seeded with the
+        frames unless they are the ones returned by the previous call, so that they are only copied once.
+        The frames returned are read-only views of the buffers, and the columns added to them are not carried
+        over to the next update: copy them to modify them """
+        if self._returned[0] is not prices or self._returned[1] is not volumes:
+            self.prices_ = ColumnarBuffer.from_frame(prices, PRICE_COLUMNS)
+            self.volumes_ = ColumnarBuffer.from_frame(volumes, VOLUME_COLUMNS)
         self.scrape()
-        return prices.append(self.prices()), volumes.append(self.volumes())
+        self._returned = (self.prices(), self.volumes())
+        return self._returned
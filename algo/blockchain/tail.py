@@ -0,0 +1,202 @@
+import asyncio
+import datetime
+import glob
+import json
+import logging
+import os
+import time
+from typing import Optional
+import pandas as pd
+from algo.blockchain.algo_requests import QueryParams, RequestPriority, aget_current_round
+from algo.blockchain.cache import DateValidator, write_parquet_file, write_day_file
+from algo.blockchain.compaction import INTRADAY_FILE_RE
+from algo.blockchain.process_prices import PoolState, PRICE_CACHES_BASEDIR
+from algo.blockchain.process_volumes import Swap, VOLUME_CACHES_BASEDIR
+from algo.blockchain.stream import make_session, AsyncDataStream, PriceVolumeStream, PoolStateQueue, PriceOrVolumeUpdate
+from algo.universe.universe import SimpleUniverse
+
+TAIL_STATE_FNAME = '_tail.json'
+
+
+def utc_date(timestamp: int) -> datetime.date:
+    return datetime.datetime.utcfromtimestamp(timestamp).date()
+
+
+def utc_midnight(date: datetime.date) -> int:
+    return int(datetime.datetime(date.year, date.month, date.day, tzinfo=datetime.timezone.utc).timestamp())
+
+
+def intraday_files(pool_dir: str, date: Optional[datetime.date] = None) -> list[tuple[int, str]]:
+    """ Intraday partitions of a pool, as (last round, file name) sorted by round """
+    pattern = f'{date}.*.parquet' if date is not None else '*.parquet'
+    files = []
+    for fname in glob.glob(os.path.join(pool_dir, pattern)):
+        m = INTRADAY_FILE_RE.match(os.path.basename(fname))
+        if m:
+            files.append((int(m.group(3)), fname))
+    return sorted(files)
+
+
+class TailCacher:
+    """ Follows the new rounds for all the pools of a universe in one stream, appending the pool states and the
+    swaps to intraday partitions of the price and volume caches. The partitions of a day are rolled up into the
+    daily file once the stream has passed midnight UTC. Days followed from their start are also marked in the
+    manifest, so that the backfill skips them. """
+
+    def __init__(self, universe: SimpleUniverse, cache_name: str,
+                 flush_seconds: float = 60.0, poll_seconds: float = 4.0):
+        self.universe = universe
+        self.cache_name = cache_name
+        self.flush_seconds = flush_seconds
+        self.poll_seconds = poll_seconds
+
+        # Cache directories are named after the assets in decreasing order, as in DataCacher
+        self.pool_assets = [tuple(sorted((x.asset1_id, x.asset2_id), reverse=True)) for x in universe.pools]
+        self.record_basedirs = {PoolState: PRICE_CACHES_BASEDIR, Swap: VOLUME_CACHES_BASEDIR}
+
+        self.state_file = os.path.join(PRICE_CACHES_BASEDIR, cache_name, TAIL_STATE_FNAME)
+        self.logger = logging.getLogger(__name__)
+
+    def pool_dir(self, cache_basedir: str, assets: tuple[int, int]) -> str:
+        return os.path.join(cache_basedir, self.cache_name, "_".join(str(x) for x in assets))
+
+    def load_state(self) -> Optional[dict]:
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save_state(self, state: dict):
+        os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+        tmp = f'{self.state_file}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.state_file)
+
+    def remove_partitions_after(self, last_round: int):
+        """ Partitions written after the last saved state, by an interrupted run """
+        for cache_basedir in self.record_basedirs.values():
+            for assets in self.pool_assets:
+                for part_round, fname in intraday_files(self.pool_dir(cache_basedir, assets)):
+                    if part_round > last_round:
+                        os.remove(fname)
+
+    def records_df(self, updates: list[PriceOrVolumeUpdate], record_type: type) -> pd.DataFrame:
+        """ Records of one pool in chain order, as a DataFrame latest first as in the daily files """
+        df = pd.DataFrame([x.market_update for x in updates])
+        if record_type is PoolState:
+            # Order of the pool states of the same pool with the same time, counted from the last one
+            df['reverse_order_in_block'] = df.groupby('time').cumcount(ascending=False)
+        return df.iloc[::-1].reset_index(drop=True)
+
+    def write_partitions(self, updates: list[PriceOrVolumeUpdate], last_round: int):
+        grouped: dict[tuple, list[PriceOrVolumeUpdate]] = {}
+        for x in updates:
+            assets = tuple(sorted(x.asset_ids, reverse=True))
+            record_type = type(x.market_update)
+            if record_type is Swap and assets != tuple(x.asset_ids):
+                x = PriceOrVolumeUpdate(assets, Swap(asset1_amount=x.market_update.asset2_amount,
+                                                     asset2_amount=x.market_update.asset1_amount,
+                                                     counterparty=x.market_update.counterparty,
+                                                     block=x.market_update.block,
+                                                     time=x.market_update.time))
+            key = (record_type, assets, utc_date(x.market_update.time))
+            grouped.setdefault(key, []).append(x)
+
+        for (record_type, assets, date), group in grouped.items():
+            pool_dir = self.pool_dir(self.record_basedirs[record_type], assets)
+            os.makedirs(pool_dir, exist_ok=True)
+            write_parquet_file(self.records_df(group, record_type),
+                               os.path.join(pool_dir, f'{date}.{last_round:010d}.parquet'))
+
+    def rollup(self, date: datetime.date, covered: bool):
+        """ Rolls the intraday partitions of date into the daily files, marking the day if covered """
+        for record_type, cache_basedir in self.record_basedirs.items():
+            for assets in self.pool_assets:
+                pool_dir = self.pool_dir(cache_basedir, assets)
+                parts = intraday_files(pool_dir, date)
+                if not parts and os.path.exists(os.path.join(pool_dir, f'{date}.parquet')):
+                    # Already rolled up by an interrupted run
+                    continue
+                day_file = None
+                if parts:
+                    # Partitions are latest first, as the daily files
+                    df = pd.concat([pd.read_parquet(fname) for _, fname in reversed(parts)], ignore_index=True)
+                    day_file = write_day_file(df, date, os.path.join(pool_dir, f'{date}.parquet'))
+                if covered:
+                    DateValidator(cache_basedir, self.cache_name, self.cache_name, assets) \
+                        .add_fetched_date(date, day_file)
+                for _, fname in parts:
+                    os.remove(fname)
+        self.logger.info(f'Rolled up the intraday partitions of {date}, covered = {covered}')
+
+    async def run(self):
+        session = make_session()
+
+        state = self.load_state()
+        if state is None:
+            current_round = await aget_current_round(session, RequestPriority.TAIL)
+            state = {'round': current_round - 1, 'covered_from': None, 'day': None}
+        else:
+            self.remove_partitions_after(state['round'])
+
+        self.logger.info(f'Tailing {len(self.pool_assets)} pools from round {state["round"] + 1}')
+
+        stream = AsyncDataStream(self.universe, QueryParams(min_block=state['round'] + 1), session=session,
+                                 priority=RequestPriority.TAIL)
+        price_volume_stream = PriceVolumeStream(stream)
+        price_queue = PoolStateQueue()
+
+        updates: list[PriceOrVolumeUpdate] = []
+        last_flush = time.monotonic()
+        try:
+            while True:
+                page, has_more = await stream.next_page()
+                for address, tx in page:
+                    updates.extend(price_volume_stream.process(address, tx, price_queue))
+                if not has_more:
+                    # At the tip the last round is complete
+                    updates.extend(price_volume_stream.flush_swaps())
+                updates.extend(price_queue.flush())
+
+                if stream.last_round is None or time.monotonic() - last_flush < self.flush_seconds:
+                    if not has_more:
+                        await asyncio.sleep(self.poll_seconds)
+                    continue
+
+                # While catching up the last round may continue on the next page, keep it for the next flush
+                flush_round = stream.last_round if not has_more else stream.last_round - 1
+                if flush_round <= state['round']:
+                    # No new round for the pools yet
+                    last_flush = time.monotonic()
+                    if not has_more:
+                        await asyncio.sleep(self.poll_seconds)
+                    continue
+                flushed = [x for x in updates if x.market_update.block <= flush_round]
+                updates = [x for x in updates if x.market_update.block > flush_round]
+
+                if flushed:
+                    self.write_partitions(flushed, flush_round)
+
+                if state['covered_from'] is None:
+                    state['covered_from'] = min([x.market_update.time for x in flushed], default=stream.last_time)
+                flushed_time = stream.last_time if not has_more \
+                    else max([x.market_update.time for x in flushed], default=None)
+
+                state['round'] = flush_round
+                self.save_state(state)
+
+                if flushed_time is not None:
+                    today = utc_date(flushed_time)
+                    day = datetime.date.fromisoformat(state['day']) if state['day'] else today
+                    while day < today:
+                        self.rollup(day, covered=state['covered_from'] <= utc_midnight(day))
+                        day = day + datetime.timedelta(days=1)
+                    state['day'] = str(today)
+                    self.save_state(state)
+
+                last_flush = time.monotonic()
+                self.logger.debug(f'Flushed {len(flushed)} updates up to round {flush_round}')
+        finally:
+            await session.close()
@@ -127,6 +127,7 @@ class TestStream(unittest.TestCase):
 
         market_data = process_market_df(prices, volumes)
         self.logger.debug(market_data)
+        ds.close()
 
     def test_stream2(self):
         universe = SimpleUniverse.from_cache('liquid_algo_pools_nousd_prehack')
@@ -139,5 +140,6 @@ class TestStream(unittest.TestCase):
         for tx in pvs.scrape():
             pass
         seconds = time.time() - ti
+        ds.close()
 
         self.logger.info(f'Seconds = {seconds}')
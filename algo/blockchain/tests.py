@@ -0,0 +1,899 @@
+import asyncio
+import base64
+import datetime
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from contextlib import ExitStack
+from dataclasses import asdict
+from types import SimpleNamespace
+from typing import Optional
+from unittest import mock
+import aiohttp
+import numpy as np
+import pandas as pd
+from algosdk.encoding import encode_address
+from algo.blockchain.algo_requests import QueryParams, query_transactions, set_indexer_url, get_indexer_url, \
+    set_request_scheduler, RequestScheduler, RequestPriority, query_transaction_pages, PageJournal, QueryError, \
+    get_body, transactions_url
+from algo.blockchain.indexer_replay import IndexerStandIn, run_against, STANDIN_PORT
+from algo.blockchain.manifest import CacheManifest, DayFile
+from algo.blockchain.merge import merge_sorted, prefetched
+from algo.blockchain.columnar import ColumnarBuffer
+from algo.blockchain.compaction import compact_cache, read_pool_day, read_pool_cache
+from algo.blockchain.archive import rederive_caches
+from algo.blockchain.tail import TailCacher, intraday_files
+from algo.blockchain.rounds import RoundIndex, split_rounds, sample_transactions
+from algo.blockchain.blocks import write_block_files, read_block_file, block_transactions, ingest_blocks, \
+    compare_caches
+from algo.blockchain.stream import PriceUpdateBatch, batches_from_price_df, stream_from_price_df, background_loop, \
+    PriceVolumeStream, PriceVolumeDataStore, PriceOrVolumeUpdate, PRICE_COLUMNS, VOLUME_COLUMNS
+from algo.blockchain.wallets import wallet_ledger_columns, positions_on_grid
+from algo.blockchain.cache import DataCacher, DateValidator, write_day_file, write_parquet_file, make_shards, shard_query_params
+from algo.blockchain.process_prices import AppPriceScraper, PriceScraper, PoolState, S1_KEY, S2_KEY, ILT_KEY
+from algo.blockchain.process_pricevolumes import PriceVolumeCacher
+from algo.blockchain.process_volumes import PoolTransaction, Swap, SwapMatcher, get_pool_transaction, \
+    pool_transfer_columns, swaps_frame
+from algo.universe.pools import PoolId
+from algo.universe.universe import SimpleUniverse
+
+POOL = 'POOL'
+APP_ID = 552635992
+
+
+def make_transactions(n_rounds: int, first_round: int = 1000, first_time: int = 1640995200):
+    """ Synthetic transactions, one fee payment into POOL and one payment between other addresses per round """
+    txs = []
+    for i in range(n_rounds):
+        for offset, (sender, receiver) in enumerate([('USER', POOL), ('USER', 'OTHER')]):
+            txs.append({
+                'id': f'{i}_{offset}',
+                'tx-type': 'pay',
+                'sender': sender,
+                'confirmed-round': first_round + i,
+                'intra-round-offset': offset,
+                'round-time': first_time + 4 * i,
+                'fee': 1000,
+                'payment-transaction': {'receiver': receiver, 'amount': 2000, 'close-to': None}
+            })
+    return txs
+
+
+class TestIndexerStandIn(unittest.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        logging.basicConfig(level=logging.INFO)
+        super().__init__(*args, **kwargs)
+
+    def test_pagination(self):
+        standin = IndexerStandIn(make_transactions(25))
+
+        async def query(session):
+            return [tx async for tx in query_transactions(session, {'address': POOL, 'limit': 10}, None,
+                                                          QueryParams(min_block=1005))]
+
+        txs = run_against(standin, query)
+        # Queries by address are returned latest first
+        self.assertEqual([tx['confirmed-round'] for tx in txs], list(range(1024, 1004, -1)))
+        self.assertEqual(standin.n_requests, 3)
+
+    def test_time_filters(self):
+        standin = IndexerStandIn(make_transactions(25))
+        first_time = datetime.datetime.utcfromtimestamp(1640995200)
+
+        async def query(session):
+            query_params = QueryParams(after_time=first_time, before_time=first_time + datetime.timedelta(seconds=20))
+            return [tx async for tx in query_transactions(session, {}, None, query_params)]
+
+        txs = run_against(standin, query)
+        self.assertEqual([tx['id'] for tx in txs], [f'{i}_{offset}' for i in range(1, 5) for offset in range(2)])
+
+    def test_time_shards(self):
+        standin = IndexerStandIn(make_transactions(25))
+        first_time = datetime.datetime.utcfromtimestamp(1640995200)
+        # Shards starting exactly on the time of a transaction
+        shards = make_shards(first_time, first_time + datetime.timedelta(seconds=100), datetime.timedelta(seconds=8))
+
+        async def query(session):
+            return [tx for shard in shards
+                    async for tx in query_transactions(session, {}, None, shard_query_params(*shard))]
+
+        txs = run_against(standin, query)
+        self.assertEqual([tx['id'] for tx in txs], [f'{i}_{offset}' for i in range(25) for offset in range(2)])
+
+    def test_throttling(self):
+        standin = IndexerStandIn(make_transactions(50), max_requests_per_second=20)
+        set_request_scheduler(RequestScheduler(requests_per_second=100, burst=100))
+
+        async def query(session):
+            return [tx async for tx in query_transactions(session, {'address': POOL, 'limit': 2}, None,
+                                                          QueryParams())]
+
+        txs = run_against(standin, query)
+        self.assertEqual(len(txs), 50)
+        self.assertGreater(standin.n_throttled, 0)
+
+    def test_cancelled_after_grant(self):
+        scheduler = RequestScheduler(max_in_flight=1)
+
+        async def main():
+            task = asyncio.ensure_future(scheduler.acquire(RequestPriority.LIVE))
+            # The slot is granted, but the task has not resumed yet when it is cancelled
+            for _ in range(2):
+                await asyncio.sleep(0)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            await asyncio.wait_for(scheduler.acquire(RequestPriority.LIVE), 1)
+
+        asyncio.run(main())
+
+    def test_round_index(self):
+        standin = IndexerStandIn(make_transactions(100))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            round_index = RoundIndex(os.path.join(tmpdir, 'rounds.sqlite'))
+
+            async def query(session):
+                first_rounds = [await round_index.first_round_at(session, 1640995200 + dt) for dt in (10, 12, 400)]
+                n_requests = standin.n_requests
+                # Repeated searches are answered from the persisted samples
+                first_rounds.append(await RoundIndex(round_index.dbfile).first_round_at(session, 1640995200 + 10))
+                self.assertEqual(standin.n_requests, n_requests)
+                # One transaction of POOL per round
+                self.assertEqual(await sample_transactions(session, POOL, 1010, 1090, limit=20), 80)
+                self.assertEqual(await sample_transactions(session, POOL, 1090, 1200, limit=20), 10)
+                return first_rounds
+
+            self.assertEqual(run_against(standin, query), [1003, 1003, 1100, 1003])
+
+        self.assertEqual(split_rounds(1000, 1010, 25, 10), [(1000, 1003), (1003, 1006), (1006, 1010)])
+        self.assertEqual(split_rounds(1000, 1010, None, 10), [(1000, 1010)])
+
+
+class FailingStandIn(IndexerStandIn):
+    """ Stand-in answering the first n_failures requests with a server error """
+
+    def __init__(self, transactions: list[dict], n_failures: int, **kwargs):
+        super().__init__(transactions, **kwargs)
+        self.n_failures = n_failures
+
+    async def handle_transactions(self, request):
+        if self.n_requests < self.n_failures:
+            self.n_requests += 1
+            return aiohttp.web.json_response({'message': 'Internal error'}, status=500)
+        return await super().handle_transactions(request)
+
+
+class TestQueryRetries(unittest.TestCase):
+
+    def test_transient_failures(self):
+        async def query(session):
+            return [tx async for tx in query_transactions(session, {}, None, QueryParams())]
+
+        clean_standin = IndexerStandIn(make_transactions(10))
+        expected = run_against(clean_standin, query)
+
+        standin = FailingStandIn(make_transactions(10), n_failures=2)
+        with mock.patch('algo.blockchain.algo_requests.RETRY_BACKOFF_SECONDS', 0.05):
+            self.assertEqual(run_against(standin, query), expected)
+        self.assertEqual(standin.n_requests, clean_standin.n_requests + 2)
+
+    def test_failures_bound(self):
+        standin = FailingStandIn(make_transactions(10), n_failures=100)
+
+        async def query(session):
+            start = time.monotonic()
+            with self.assertRaises(QueryError):
+                await get_body(session, transactions_url(), {}, RequestPriority.BACKFILL, max_retries=3)
+            return time.monotonic() - start
+
+        with mock.patch('algo.blockchain.algo_requests.RETRY_BACKOFF_SECONDS', 0.05):
+            elapsed = run_against(standin, query)
+        self.assertEqual(standin.n_requests, 4)
+        # Backoffs of 0.05, 0.1 and 0.2 seconds between the attempts
+        self.assertGreaterEqual(elapsed, 0.35)
+
+    def test_throttled_bound(self):
+        # Rejects every request with 429
+        standin = IndexerStandIn(make_transactions(10), max_requests_per_second=10 ** -6)
+        set_request_scheduler(RequestScheduler(requests_per_second=100, burst=100))
+
+        async def query(session):
+            with self.assertRaises(QueryError):
+                await get_body(session, transactions_url(), {}, RequestPriority.BACKFILL)
+
+        with mock.patch('algo.blockchain.algo_requests.MAX_THROTTLED_RETRIES', 2):
+            run_against(standin, query)
+        self.assertEqual(standin.n_throttled, 3)
+
+
+class TestPageJournal(unittest.TestCase):
+
+    def test_resume(self):
+        standin = IndexerStandIn(make_transactions(25))
+        params = {'limit': 8}
+
+        async def query_all(session):
+            return [page async for page in query_transaction_pages(session, params, None, QueryParams())]
+
+        expected = run_against(standin, query_all)
+        n_pages = standin.n_requests
+        self.assertGreater(n_pages, 4)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            journal = PageJournal(os.path.join(tmpdir, 'journal'))
+
+            async def interrupted(session):
+                pages = []
+                with self.assertRaises(KeyboardInterrupt):
+                    async for page in query_transaction_pages(session, params, None, QueryParams(),
+                                                              journal=journal):
+                        pages.append(page)
+                        if len(pages) == 3:
+                            raise KeyboardInterrupt
+                return pages
+
+            async def resumed(session):
+                return [page async for page in query_transaction_pages(session, params, None, QueryParams(),
+                                                                       journal=journal)]
+
+            standin.n_requests = 0
+            self.assertEqual(run_against(standin, interrupted), expected[:3])
+            self.assertEqual(standin.n_requests, 3)
+
+            # The journaled pages are replayed and the query continues from the last next-token
+            standin.n_requests = 0
+            self.assertEqual(run_against(standin, resumed), expected)
+            self.assertEqual(standin.n_requests, n_pages - 3)
+
+            # A complete journal is replayed without requests
+            standin.n_requests = 0
+            self.assertEqual(run_against(standin, resumed), expected)
+            self.assertEqual(standin.n_requests, 0)
+
+
+def pool_address(asset1_id: int, asset2_id: int) -> str:
+    return encode_address(asset1_id.to_bytes(16, 'big') + asset2_id.to_bytes(16, 'big'))
+
+
+class StandInTinymanClient:
+    """ Tinyman client knowing the pools at pool_address, without network access """
+    validator_app_id = APP_ID
+
+    def fetch_pool(self, asset1_id: int, asset2_id: int):
+        return SimpleNamespace(exists=True, address=pool_address(asset1_id, asset2_id),
+                               liquidity_asset=SimpleNamespace(id=asset1_id + asset2_id))
+
+
+def make_app_calls(pools: list[tuple[int, int]], n_rounds: int, first_round: int = 1000,
+                   first_time: int = 1640995200):
+    """ Synthetic calls to the validator app updating the local state of the pools, some of them in the same round
+    and some without reserves """
+    txs = []
+    for i in range(n_rounds):
+        calls = [(j, asset1_id, asset2_id) for j, (asset1_id, asset2_id) in enumerate(pools) if (i + j) % 2 == 0]
+        if i % 5 == 0:
+            calls.append(calls[0])
+        for offset, (j, asset1_id, asset2_id) in enumerate(calls):
+            address = pool_address(asset1_id, asset2_id)
+            delta = [{'key': S1_KEY, 'value': {'action': 2, 'uint': 10 ** 6 + 7 * i + offset}},
+                     {'key': S2_KEY, 'value': {'action': 2, 'uint': 10 ** 7 - 3 * i + j}},
+                     {'key': ILT_KEY, 'value': {'action': 2, 'uint': 5 * i}}]
+            if i % 7 == 3:
+                delta = delta[2:]
+            txs.append({
+                'id': f'{i}_{offset}',
+                'tx-type': 'appl',
+                'sender': 'USER',
+                'confirmed-round': first_round + i,
+                'intra-round-offset': offset,
+                'round-time': first_time + 4 * i,
+                'application-transaction': {'application-id': APP_ID, 'accounts': [address]},
+                'local-state-delta': [{'address': address, 'delta': delta}]
+            })
+    return txs
+
+
+class TestAppPriceScraper(unittest.TestCase):
+
+    def test_same_states_as_pool_streams(self):
+        pools = [(31566704, 0), (226701642, 0), (31566704, 226701642)]
+        standin = IndexerStandIn(make_app_calls(pools, 60))
+        client = StandInTinymanClient()
+        first_time = datetime.datetime.utcfromtimestamp(1640995200)
+        query_params = shard_query_params(first_time + datetime.timedelta(seconds=20),
+                                          first_time + datetime.timedelta(seconds=200))
+
+        async def query(session):
+            app_states = await AppPriceScraper(client, pools).scrape(session, query_params)
+            pool_states = {}
+            for asset1_id, asset2_id in pools:
+                scraper = PriceScraper(client, asset1_id, asset2_id)
+                pool_states[(asset1_id, asset2_id)] = [ps async for ps in scraper.scrape(session, None, query_params)]
+            return app_states, pool_states
+
+        app_states, pool_states = run_against(standin, query)
+        self.assertEqual(app_states, pool_states)
+        self.assertTrue(all(len(states) > 10 for states in app_states.values()))
+        self.assertTrue(any(ps.reverse_order_in_block > 0 for ps in app_states[pools[0]]))
+
+
+class TestCacheManifest(unittest.TestCase):
+
+    def test_gaps_and_legacy_import(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            date = datetime.date(2022, 1, 1)
+            with open(os.path.join(cache_dir, '5_0.json'), 'w') as f:
+                json.dump({date, date + datetime.timedelta(days=1)}, f, default=str)
+
+            manifest = CacheManifest(cache_dir)
+            manifest.add_days('7_0', [DayFile(date, 10, 100), DayFile(date + datetime.timedelta(days=3), 5, 50)])
+
+            self.assertEqual(manifest.existing_dates('5_0'), {date, date + datetime.timedelta(days=1)})
+            gaps = manifest.gaps()
+            self.assertEqual(list(gaps['pool']), ['7_0'])
+            self.assertEqual(list(gaps['n_missing']), [2])
+            coverage = manifest.coverage().set_index('pool')
+            self.assertEqual(coverage.loc['7_0', 'rows'], 15)
+            self.assertEqual(coverage.loc['5_0', 'n_days'], 2)
+
+
+class TestCompaction(unittest.TestCase):
+
+    def test_recompact_rewritten_days(self):
+        with tempfile.TemporaryDirectory() as basedir:
+            pool_dir = os.path.join(basedir, 'cache', '5_0')
+            os.makedirs(pool_dir)
+            manifest = CacheManifest(os.path.join(basedir, 'cache'))
+            dates = [datetime.date(2022, 1, 1) + datetime.timedelta(days=i) for i in range(31)]
+
+            def write_day(date, values):
+                time = int(datetime.datetime(date.year, date.month, date.day, tzinfo=datetime.timezone.utc).timestamp())
+                df = pd.DataFrame({'time': [time + 60, time], 'block': values})
+                return write_day_file(df, date, os.path.join(pool_dir, f'{date}.parquet'))
+
+            manifest.add_days('5_0', [write_day(date, [2 * i + 1, 2 * i]) for i, date in enumerate(dates)])
+            compact_cache(basedir, 'cache', n_workers=1)
+            self.assertEqual(os.listdir(pool_dir), ['2022-01.parquet'])
+
+            # A day written again after the compaction replaces its rows in the monthly file
+            manifest.add_days('5_0', [write_day(dates[3], [100, 99])])
+            compact_cache(basedir, 'cache', n_workers=1)
+            self.assertEqual(os.listdir(pool_dir), ['2022-01.parquet'])
+            self.assertEqual(read_pool_day(pool_dir, dates[3], columns=['block'])['block'].tolist(), [99, 100])
+            self.assertEqual(read_pool_day(pool_dir, dates[4])['block'].tolist(), [8, 9])
+            self.assertEqual(len(pd.read_parquet(os.path.join(pool_dir, '2022-01.parquet'))), 62)
+            self.assertIsNone(read_pool_day(pool_dir, datetime.date(2022, 2, 1)))
+
+            # Days cached into a compacted month are visible right away
+            dv = DateValidator(basedir, 'cache', 'cache', [5, 0])
+            dv.add_fetched_date(dates[4], write_day(dates[4], [201, 200]))
+            dv.add_fetched_date(dates[5])
+            self.assertEqual(os.listdir(pool_dir), ['2022-01.parquet'])
+            self.assertEqual(read_pool_day(pool_dir, dates[4], columns=['block'])['block'].tolist(), [200, 201])
+            self.assertTrue(read_pool_day(pool_dir, dates[5]).empty)
+            self.assertEqual(read_pool_day(pool_dir, dates[3], columns=['block'])['block'].tolist(), [99, 100])
+            self.assertEqual(manifest.compacted_months('5_0')[0].rows, 60)
+            self.assertEqual(manifest.days('5_0')[5].rows, 0)
+
+
+class TestMergeSorted(unittest.TestCase):
+
+    def test_merge(self):
+        async def source(keys):
+            for key in keys:
+                await asyncio.sleep(0)
+                yield key, key
+
+        sources = [[(1, 0), (1, 2), (5, 1)], [], [(0, 3), (1, 1), (7, 0)], [(2, 0)]]
+
+        async def main():
+            return [x async for x in merge_sorted([source(keys) for keys in sources], lookahead=1)]
+
+        self.assertEqual(asyncio.run(main()), sorted(key for keys in sources for key in keys))
+
+
+class TestPrefetched(unittest.TestCase):
+
+    @staticmethod
+    async def source(n: Optional[int], produced: list, closed: list, error_at: Optional[int] = None):
+        i = 0
+        try:
+            while n is None or i < n:
+                if i == error_at:
+                    raise ValueError(i)
+                await asyncio.sleep(0)
+                produced.append(i)
+                yield i
+                i += 1
+        finally:
+            closed.append(True)
+
+    def test_order_and_errors(self):
+        async def main():
+            items = {depth: [x async for x in prefetched(self.source(20, [], []), depth)] for depth in (0, 1, 3)}
+            received = []
+            with self.assertRaises(ValueError):
+                async for x in prefetched(self.source(20, [], [], error_at=5), 3):
+                    received.append(x)
+            return items, received
+
+        items, received = asyncio.run(main())
+        self.assertEqual(items, {depth: list(range(20)) for depth in (0, 1, 3)})
+        # The items before the error are all received
+        self.assertEqual(received, list(range(5)))
+
+    def test_early_stop(self):
+        async def main():
+            produced, closed = [], []
+            gen = prefetched(self.source(None, produced, closed), 2)
+            async for x in gen:
+                if x == 3:
+                    break
+            await gen.aclose()
+            await asyncio.sleep(0.01)
+            return produced, closed
+
+        produced, closed = asyncio.run(main())
+        # The producer stops at most depth items and the one being put ahead of the consumer
+        self.assertLessEqual(len(produced), 4 + 3)
+        self.assertEqual(closed, [True])
+
+    def test_query_pages(self):
+        standin = IndexerStandIn(make_transactions(50))
+
+        async def query(session):
+            n_requests = []
+            pages = [page async for page in query_transaction_pages(session, {'address': POOL, 'limit': 5}, 2,
+                                                                     QueryParams(), prefetch=3)]
+            n_requests.append(standin.n_requests)
+            async for _ in query_transaction_pages(session, {'address': POOL, 'limit': 5}, None, QueryParams()):
+                break
+            n_requests.append(standin.n_requests)
+            return len(pages), n_requests
+
+        # num_queries bounds the prefetched pages, and the queries do not prefetch by default
+        self.assertEqual(run_against(standin, query), (2, [2, 3]))
+
+
+class TestColumnarBuffer(unittest.TestCase):
+
+    def test_views_survive_growth(self):
+        buffer = ColumnarBuffer({'time': 'int64', 'issued_liquidity': 'float64', 'counterparty': object}, capacity=1)
+        buffer.append({'time': 0, 'issued_liquidity': None, 'counterparty': 'A'})
+        first = buffer.frame()
+        for i in range(1, 10):
+            buffer.append({'time': i, 'issued_liquidity': i, 'counterparty': 'B'})
+        self.assertEqual(buffer.capacity, 16)
+        self.assertEqual(list(first['time']), [0])
+        self.assertEqual(list(buffer.frame()['time']), list(range(10)))
+        self.assertEqual(buffer.table().num_rows, 10)
+
+    def test_views_read_only(self):
+        buffer = ColumnarBuffer({'time': 'int64', 'issued_liquidity': 'float64'}, capacity=4)
+        for i in range(3):
+            buffer.append({'time': i, 'issued_liquidity': i})
+        df = buffer.frame()
+        with self.assertRaises(ValueError):
+            df.loc[0, 'time'] = 10
+        with self.assertRaises(ValueError):
+            df['issued_liquidity'] += 1
+        # Appends still write into the buffer
+        buffer.append({'time': 3, 'issued_liquidity': 3})
+        self.assertEqual(list(buffer.frame()['time']), [0, 1, 2, 3])
+        self.assertEqual(list(buffer.frame()['issued_liquidity']), [0, 1, 2, 3])
+        copy = df.copy()
+        copy.loc[0, 'time'] = 10
+        self.assertEqual(list(buffer.frame()['time']), [0, 1, 2, 3])
+
+
+class TestPriceVolumeDataStore(unittest.TestCase):
+
+    def test_update(self):
+        batches = [[PriceOrVolumeUpdate((5, 0), PoolState(10 * i, 100 + i, 200, 3, i, 0)),
+                    PriceOrVolumeUpdate((5, 0), Swap(i, -i, 'A', i, 10 * i))] for i in range(4)]
+        stream = SimpleNamespace(address_ids_map={}, scrape=lambda: iter(batches.pop(0)))
+        store = PriceVolumeDataStore(stream)
+
+        prices, volumes = store.update(pd.DataFrame(columns=list(PRICE_COLUMNS)),
+                                       pd.DataFrame(columns=list(VOLUME_COLUMNS)))
+        prices, volumes = store.update(prices, volumes)
+        self.assertEqual(prices['asset1_reserves'].tolist(), [100, 101])
+        with self.assertRaises(ValueError):
+            prices.loc[0, 'asset1_reserves'] = 0
+
+        # Columns added to the returned frames are not carried over, a copy is appended to instead
+        prices['price'] = 1.0
+        new_prices, new_volumes = store.update(prices, volumes)
+        self.assertNotIn('price', new_prices.columns)
+        copy = new_prices.copy()
+        copy.loc[0, 'asset1_reserves'] = 0
+        new_prices, new_volumes = store.update(copy, new_volumes)
+        self.assertEqual(new_prices['asset1_reserves'].tolist(), [0, 101, 102, 103])
+        self.assertEqual(new_volumes['asset1_amount'].tolist(), [0, 1, 2, 3])
+        self.assertEqual(prices['asset1_reserves'].tolist(), [100, 101])
+
+
+class TestBlockFiles(unittest.TestCase):
+
+    def test_round_trip(self):
+        pool, user = encode_address(bytes(32)), encode_address(bytes([1] * 32))
+        txs = [{'tx-type': 'pay', 'sender': user, 'fee': 1000, 'confirmed-round': 7, 'intra-round-offset': 0,
+                'round-time': 1640995200, 'group': 'AQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQE=', 'payment-transaction': {'receiver': pool, 'amount': 2000, 'close-to': None}},
+               {'tx-type': 'appl', 'sender': pool, 'fee': 1000, 'confirmed-round': 7, 'intra-round-offset': 1,
+                'round-time': 1640995200, 'application-transaction': {'application-id': 1, 'accounts': [user]},
+                'local-state-delta': [{'address': pool,
+                                       'delta': [{'key': 'czE=', 'value': {'action': 2, 'uint': 5}}]}]}]
+
+        with tempfile.TemporaryDirectory() as block_dir:
+            write_block_files(txs, block_dir)
+            blocks = [block for fname in sorted(os.listdir(block_dir))
+                      for block in read_block_file(os.path.join(block_dir, fname))]
+        self.assertEqual([tx for block in blocks for tx in block_transactions(block)], txs)
+
+
+def make_swaps(pools: list[tuple[int, int]], n_rounds: int, first_round: int = 1000, first_time: int = 1640995200):
+    """ Synthetic swap groups of Tinyman: fee payment, call to the validator app updating the state of the pool,
+    transfer into and out of the pool. One round per hour, with one swap per pool """
+    txs = []
+    for i in range(n_rounds):
+        user = encode_address(bytes([1 + i % 3] * 32))
+        offset = 0
+        for j, (asset1_id, asset2_id) in enumerate(pools):
+            address = pool_address(asset1_id, asset2_id)
+            asset_in, asset_out = (asset1_id, asset2_id) if i % 2 else (asset2_id, asset1_id)
+            group = base64.b64encode(bytes([j] * 16) + i.to_bytes(16, 'big')).decode()
+
+            def transfer(sender, receiver, asset_id, amount):
+                if asset_id == 0:
+                    return {'tx-type': 'pay',
+                            'payment-transaction': {'receiver': receiver, 'amount': amount, 'close-to': None}}
+                return {'tx-type': 'axfer',
+                        'asset-transfer-transaction': {'asset-id': asset_id, 'receiver': receiver, 'amount': amount,
+                                                       'close-to': None}}
+
+            delta = [{'key': S1_KEY, 'value': {'action': 2, 'uint': 10 ** 6 + 7 * i}},
+                     {'key': S2_KEY, 'value': {'action': 2, 'uint': 10 ** 7 - 3 * i + j}},
+                     {'key': ILT_KEY, 'value': {'action': 2, 'uint': 5 * i}}]
+            call = {'tx-type': 'appl',
+                    'application-transaction': {'application-id': APP_ID, 'accounts': [user]},
+                    'local-state-delta': [{'address': address, 'delta': delta}]}
+            for sender, tx in [(user, transfer(user, address, 0, 2000)), (address, call),
+                               (user, transfer(user, address, asset_in, 100 + i)),
+                               (address, transfer(address, user, asset_out, 50 + i))]:
+                txs.append({'id': f'{i}_{offset}', 'sender': sender, 'fee': 1000, 'group': group,
+                            'confirmed-round': first_round + i, 'intra-round-offset': offset,
+                            'round-time': first_time + 3600 * i, **tx})
+                offset += 1
+    return txs
+
+
+def cache_against(standin: IndexerStandIn, cacher: DataCacher, cache_name: str):
+    """ Runs cacher into cache_name, with standin serving as the indexer on the background loop """
+    runner = asyncio.run_coroutine_threadsafe(standin.start(port=STANDIN_PORT), background_loop()).result()
+    url = get_indexer_url()
+    set_indexer_url(f'http://127.0.0.1:{STANDIN_PORT}')
+    set_request_scheduler(RequestScheduler())
+    try:
+        cacher.cache(cache_name, cache_name)
+    finally:
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), background_loop()).result()
+        set_indexer_url(url)
+        set_request_scheduler(RequestScheduler())
+
+
+class TestIngestBlocks(unittest.TestCase):
+
+    def test_same_caches_as_indexer(self):
+        pools = [(9, 7), (7, 0)]
+        pool_id_store = SimpleNamespace(pools=[SimpleNamespace(asset1_id=asset1_id, asset2_id=asset2_id,
+                                                               address=pool_address(asset1_id, asset2_id))
+                                               for asset1_id, asset2_id in pools])
+        # Five days of swaps, the first and the last day are not derived from the blocks
+        txs = make_swaps(pools, 5 * 24)
+        first_day = datetime.date(2022, 1, 1)
+        days = [first_day + datetime.timedelta(days=i) for i in range(5)]
+
+        with tempfile.TemporaryDirectory() as tmpdir, ExitStack() as stack:
+            price_basedir, volume_basedir = os.path.join(tmpdir, 'prices'), os.path.join(tmpdir, 'volumes')
+            for module in ('process_prices', 'process_pricevolumes', 'blocks'):
+                stack.enter_context(mock.patch(f'algo.blockchain.{module}.PRICE_CACHES_BASEDIR', price_basedir))
+            for module in ('process_pricevolumes', 'blocks'):
+                stack.enter_context(mock.patch(f'algo.blockchain.{module}.VOLUME_CACHES_BASEDIR', volume_basedir))
+
+            # Reference caches from the indexer
+            cache_against(IndexerStandIn(txs), PriceVolumeCacher(StandInTinymanClient(), pool_id_store,
+                                                                 datetime.datetime(2022, 1, 1),
+                                                                 datetime.datetime(2022, 1, 6), dry_run=False,
+                                                                 shard_hours=6), 'indexer')
+
+            block_dir = os.path.join(tmpdir, 'blocks')
+            write_block_files(txs, block_dir, rounds_per_file=6)
+            ingest_blocks(block_dir, 'blocks', pool_id_store, n_workers=2)
+
+            # Rounds missing from the second day
+            gap_block_dir = os.path.join(tmpdir, 'gap_blocks')
+            write_block_files(txs, gap_block_dir, rounds_per_file=6)
+            os.remove(os.path.join(gap_block_dir, f'{1038:012d}.msgpack'))
+            ingest_blocks(gap_block_dir, 'gap_blocks', pool_id_store, n_workers=2)
+
+            for cache_name, cached_days in (('indexer', days), ('blocks', days[1:4]), ('gap_blocks', days[2:4])):
+                for basedir in (price_basedir, volume_basedir):
+                    manifest = CacheManifest(os.path.join(basedir, cache_name))
+                    for asset1_id, asset2_id in pools:
+                        self.assertEqual(manifest.existing_dates(f'{asset1_id}_{asset2_id}'), set(cached_days))
+            self.assertEqual(compare_caches('blocks', 'indexer', pool_id_store), [])
+            self.assertEqual(compare_caches('gap_blocks', 'indexer', pool_id_store), [])
+            self.assertEqual(len(read_pool_day(os.path.join(volume_basedir, 'blocks', '9_7'), days[1])), 24)
+
+
+class TestRederive(unittest.TestCase):
+
+    def test_same_caches_as_scraped(self):
+        pools = [(9, 7), (7, 0)]
+        pool_id_store = SimpleNamespace(pools=[SimpleNamespace(asset1_id=asset1_id, asset2_id=asset2_id,
+                                                               address=pool_address(asset1_id, asset2_id))
+                                               for asset1_id, asset2_id in pools])
+        txs = make_swaps(pools, 3 * 24)
+
+        with tempfile.TemporaryDirectory() as tmpdir, ExitStack() as stack:
+            basedirs = {key: os.path.join(tmpdir, key.lower()) for key in ('PRICE', 'VOLUME', 'RAW')}
+            for module, keys in (('process_prices', ['PRICE']), ('process_pricevolumes', ['PRICE', 'VOLUME', 'RAW']),
+                                 ('archive', ['PRICE', 'VOLUME', 'RAW'])):
+                for key in keys:
+                    stack.enter_context(mock.patch(f'algo.blockchain.{module}.{key}_CACHES_BASEDIR', basedirs[key]))
+
+            cache_against(IndexerStandIn(txs), PriceVolumeCacher(StandInTinymanClient(), pool_id_store,
+                                                                 datetime.datetime(2022, 1, 1),
+                                                                 datetime.datetime(2022, 1, 4), dry_run=False,
+                                                                 shard_hours=6, archive_raw=True), 'scraped')
+
+            def derived_caches():
+                caches = {}
+                for key in ('PRICE', 'VOLUME'):
+                    cache_dir = os.path.join(basedirs[key], 'scraped')
+                    for asset1_id, asset2_id in pools:
+                        pool = f'{asset1_id}_{asset2_id}'
+                        caches[(key, pool)] = (CacheManifest(cache_dir).existing_dates(pool),
+                                               read_pool_cache(os.path.join(cache_dir, pool)))
+                return caches
+
+            scraped = derived_caches()
+            for key in ('PRICE', 'VOLUME'):
+                shutil.rmtree(os.path.join(basedirs[key], 'scraped'))
+            rederive_caches('scraped', 'scraped', pool_id_store, n_workers=2)
+            rederived = derived_caches()
+
+            self.assertEqual(rederived.keys(), scraped.keys())
+            for key, (dates, df) in scraped.items():
+                self.assertEqual(len(dates), 3)
+                self.assertGreater(len(df), 0)
+                self.assertEqual(rederived[key][0], dates)
+                pd.testing.assert_frame_equal(rederived[key][1], df)
+
+
+class TestTailCacher(unittest.TestCase):
+
+    def test_same_days_as_cacher(self):
+        pools = [(9, 7), (7, 0)]
+        pool_id_store = SimpleNamespace(pools=[SimpleNamespace(asset1_id=asset1_id, asset2_id=asset2_id,
+                                                               address=pool_address(asset1_id, asset2_id))
+                                               for asset1_id, asset2_id in pools])
+        universe = SimpleUniverse(pools=[PoolId(asset1_id, asset2_id, pool_address(asset1_id, asset2_id))
+                                         for asset1_id, asset2_id in pools])
+        # Two days and a half of swaps, one round per hour
+        txs = make_swaps(pools, 60)
+        days = [datetime.date(2022, 1, 1), datetime.date(2022, 1, 2)]
+
+        with tempfile.TemporaryDirectory() as tmpdir, ExitStack() as stack:
+            basedirs = {PoolState: os.path.join(tmpdir, 'prices'), Swap: os.path.join(tmpdir, 'volumes')}
+            for module in ('process_prices', 'process_pricevolumes', 'tail'):
+                stack.enter_context(mock.patch(f'algo.blockchain.{module}.PRICE_CACHES_BASEDIR', basedirs[PoolState]))
+            for module in ('process_pricevolumes', 'tail'):
+                stack.enter_context(mock.patch(f'algo.blockchain.{module}.VOLUME_CACHES_BASEDIR', basedirs[Swap]))
+
+            cache_against(IndexerStandIn(txs), PriceVolumeCacher(StandInTinymanClient(), pool_id_store,
+                                                                 datetime.datetime(2022, 1, 1),
+                                                                 datetime.datetime(2022, 1, 3), dry_run=False,
+                                                                 shard_hours=6), 'indexer')
+
+            def make_tailer():
+                return TailCacher(universe, 'tail', flush_seconds=0.05, poll_seconds=0.02)
+
+            async def run_until(tailer: TailCacher, day: str):
+                task = asyncio.ensure_future(tailer.run())
+                while (tailer.load_state() or {}).get('day') != day:
+                    self.assertFalse(task.done())
+                    await asyncio.sleep(0.02)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+
+            async def query(session):
+                # Interrupted once the first midnight has been crossed
+                await run_until(make_tailer(), '2022-01-02')
+                # Partition written after the last saved state, as by a run interrupted before saving it
+                state = make_tailer().load_state()
+                stray_dir = os.path.join(basedirs[PoolState], 'tail', '9_7')
+                write_parquet_file(pd.DataFrame({'time': [1]}),
+                                   os.path.join(stray_dir, f'2022-01-02.{state["round"] + 1:010d}.parquet'))
+                # Restarted from the saved state
+                await run_until(make_tailer(), '2022-01-03')
+
+            run_against(IndexerStandIn(txs, rounds_per_second=20), query)
+
+            for record_type, basedir in basedirs.items():
+                for asset1_id, asset2_id in pools:
+                    pool = f'{asset1_id}_{asset2_id}'
+                    tail_dir = os.path.join(basedir, 'tail', pool)
+                    self.assertEqual(CacheManifest(os.path.join(basedir, 'tail')).existing_dates(pool), set(days))
+                    # Only the partitions of the day not rolled up yet are left
+                    self.assertEqual({os.path.basename(fname)[:10] for _, fname in intraday_files(tail_dir)},
+                                     {'2022-01-03'})
+                    for day in days:
+                        ref_df = pd.read_parquet(os.path.join(basedir, 'indexer', pool, f'{day}.parquet'))
+                        df = pd.read_parquet(os.path.join(tail_dir, f'{day}.parquet'))
+                        pd.testing.assert_frame_equal(df[ref_df.columns], ref_df)
+
+
+def baseline_swaps(transactions: list[PoolTransaction], asset1_id: int, asset2_id: int) -> list[Swap]:
+    """ Swaps of the state machine of SwapScraper.scrape before the swaps were matched by atomic group, from the
+    transfers of a pool latest first. Kept as the reference of the swaps cached before swaps_frame """
+
+    def is_fee_payment(tx: PoolTransaction):
+        return tx.asset_id == 0 and tx.amount == 2000 and tx.tx_type == 'pay'
+
+    def is_transaction_in(tx: PoolTransaction, transaction_out: PoolTransaction):
+        return tx.counterparty == transaction_out.counterparty \
+               and tx.asset_id != transaction_out.asset_id \
+               and tx.asset_id in [asset1_id, asset2_id] \
+               and not is_fee_payment(tx)
+
+    swaps = []
+    transaction_out: Optional[PoolTransaction] = None
+    transaction_in: Optional[PoolTransaction] = None
+    for tx in transactions:
+        if transaction_out:
+            if transaction_in:
+                if is_fee_payment(tx) and tx.counterparty == transaction_in.counterparty:
+                    if transaction_in.asset_id == asset1_id and transaction_out.asset_id == asset2_id:
+                        asset1_amount, asset2_amount = transaction_in.amount, transaction_out.amount
+                    elif transaction_in.asset_id == asset2_id and transaction_out.asset_id == asset1_id:
+                        asset1_amount, asset2_amount = transaction_out.amount, transaction_in.amount
+                    else:
+                        raise ValueError
+                    assert transaction_in.amount > 0 > transaction_out.amount
+                    swaps.append(Swap(asset1_amount=asset1_amount, asset2_amount=asset2_amount,
+                                      counterparty=tx.counterparty, block=tx.block, time=tx.time))
+                transaction_out = None
+                transaction_in = None
+            elif is_transaction_in(tx, transaction_out):
+                transaction_in = tx
+            else:
+                transaction_out = None
+        elif tx.amount < 0 and tx.asset_id in [asset1_id, asset2_id]:
+            transaction_out = tx
+    return swaps
+
+
+class TestSwapsFrame(unittest.TestCase):
+
+    def test_same_swaps_as_matcher(self):
+        pool, asset1_id, asset2_id = 'POOL', 5, 0
+
+        def transfer(group, rnd, offset, user, asset_id, amount):
+            sender, receiver = (user, pool) if amount > 0 else (pool, user)
+            tx = {'sender': sender, 'group': group, 'confirmed-round': rnd, 'intra-round-offset': offset,
+                  'round-time': 1640995200 + rnd}
+            if asset_id == 0:
+                tx.update({'tx-type': 'pay', 'payment-transaction': {'receiver': receiver, 'amount': abs(amount)}})
+            else:
+                tx.update({'tx-type': 'axfer', 'asset-transfer-transaction': {'asset-id': asset_id,
+                                                                              'receiver': receiver,
+                                                                              'amount': abs(amount)}})
+            return tx
+
+        # Chain order: two swaps in opposite directions around a mint, a lone payment and a burn
+        txs = [transfer('a', 1, 0, 'u1', 0, 2000), transfer('a', 1, 2, 'u1', 5, 300), transfer('a', 1, 3, 'u1', 0, -70),
+               transfer('b', 1, 4, 'u2', 0, 2000), transfer('b', 1, 6, 'u2', 5, 10), transfer('b', 1, 7, 'u2', 0, 20),
+               transfer('b', 1, 8, 'u2', 9, -3),
+               transfer(None, 2, 0, 'u3', 0, 500),
+               transfer('c', 3, 0, 'u2', 0, 2000), transfer('c', 3, 2, 'u2', 0, 40), transfer('c', 3, 3, 'u2', 5, -150),
+               transfer('d', 4, 0, 'u1', 0, 2000), transfer('d', 4, 2, 'u1', 9, 3), transfer('d', 4, 3, 'u1', 5, -10),
+               transfer('d', 4, 4, 'u1', 0, -20),
+               # A redeem of excess Algo followed by a swap in the same round
+               transfer('e', 5, 0, 'u1', 0, 2000), transfer('e', 5, 2, 'u1', 0, -15),
+               transfer('f', 5, 3, 'u1', 0, 2000), transfer('f', 5, 5, 'u1', 0, 30), transfer('f', 5, 6, 'u1', 5, -12)]
+        latest_first = txs[::-1]
+
+        matcher = SwapMatcher(asset1_id, asset2_id)
+        swaps = [x for x in [*(matcher.push(get_pool_transaction(tx, pool)) for tx in latest_first), matcher.flush()]
+                 if x]
+        df = swaps_frame([pool_transfer_columns(latest_first[:6], pool),
+                          pool_transfer_columns(latest_first[6:], pool)], asset1_id, asset2_id)
+        self.assertEqual(len(swaps), 3)
+        self.assertEqual(df.to_dict('records'), [asdict(x) for x in swaps])
+
+        # The live stream matches the same swaps in chain order
+        universe = SimpleNamespace(pools=[SimpleNamespace(address=pool, asset1_id=asset1_id, asset2_id=asset2_id)])
+        stream = SimpleNamespace(universe=universe, next_transaction=lambda: ((pool, tx) for tx in txs))
+        live_swaps = [x.market_update for x in PriceVolumeStream(stream).scrape()]
+        self.assertEqual(live_swaps, swaps[::-1])
+
+    def test_same_swaps_as_baseline_scraper(self):
+        pools = [(9, 7), (7, 0)]
+        txs = make_swaps(pools, 48)
+
+        def transfer(tx: dict) -> dict:
+            return tx.get('payment-transaction') or tx['asset-transfer-transaction']
+
+        # Edge cases on the Algo pool: a swap of exactly 2000 microalgo into the pool, and a fee payment of another
+        # amount than 2000 microalgo
+        algo_pool = pool_address(7, 0)
+        algo_in, fee = [[tx for tx in txs if tx['tx-type'] == 'pay' and tx['sender'] != algo_pool
+                         and transfer(tx)['receiver'] == algo_pool and tx['confirmed-round'] == rnd][-1]
+                        for rnd in (1002, 1005)]
+        self.assertNotEqual(algo_in['intra-round-offset'], fee['intra-round-offset'])
+        transfer(algo_in)['amount'] = 2000
+        transfer(fee)['amount'] = 3000
+
+        for asset1_id, asset2_id in pools:
+            address = pool_address(asset1_id, asset2_id)
+            latest_first = [tx for tx in txs[::-1] if tx['tx-type'] in ('pay', 'axfer')
+                            and address in (tx['sender'], transfer(tx)['receiver'])]
+            expected = baseline_swaps([get_pool_transaction(tx, address) for tx in latest_first], asset1_id, asset2_id)
+            half = len(latest_first) // 2
+            df = swaps_frame([pool_transfer_columns(latest_first[:half], address),
+                              pool_transfer_columns(latest_first[half:], address)], asset1_id, asset2_id)
+            self.assertEqual(len(df), 48)
+            if asset2_id == 0:
+                # The baseline takes the swap of 2000 microalgo for a fee payment, and skips the swap whose fee
+                # payment is not 2000 microalgo. swaps_frame keeps both
+                edge_cases = df['block'].isin([1002, 1005])
+                self.assertEqual(edge_cases.sum(), 2)
+                df = df[~edge_cases]
+            self.assertEqual(df.to_dict('records'), [asdict(x) for x in expected])
+
+
+class TestPriceUpdateBatch(unittest.TestCase):
+
+    def test_batches_from_price_df(self):
+        df = pd.DataFrame({'time': [10, 10, 14, 18], 'block': [1, 1, 2, 3], 'asset1_reserves': [5, 6, 7, 8],
+                           'asset2_reserves': [50, 60, 70, 80], 'issued_liquidity': [None, 3, None, 4],
+                           'reverse_order_in_block': [0, 0, 0, 0], 'asset1': [2, 1, 2, 1], 'asset2': [0, 0, 0, 0]})
+        start_time = datetime.datetime.fromtimestamp(10, datetime.timezone.utc)
+
+        batches = list(batches_from_price_df(df, start_time, batch_size=3))
+        self.assertEqual([len(x) for x in batches], [3, 1])
+        self.assertEqual(batches[0].last_indices(), {(1, 0): 0, (2, 0): 2})
+
+        updates = list(stream_from_price_df(df, start_time))
+        self.assertEqual([x for batch in batches for x in batch], updates)
+        self.assertEqual(list(PriceUpdateBatch.from_updates(updates)), updates)
+        self.assertIsNone(updates[1].price_update.issued_liquidity)
+
+
+class TestWalletLedger(unittest.TestCase):
+
+    def test_positions_on_grid(self):
+        address = 'ME'
+        txs = [{'tx-type': 'pay', 'sender': 'X', 'fee': 1000, 'round-time': 100,
+                'payment-transaction': {'receiver': address, 'amount': 50000}},
+               {'tx-type': 'axfer', 'sender': address, 'fee': 1000, 'round-time': 300,
+                'asset-transfer-transaction': {'asset-id': 5, 'receiver': 'X', 'amount': 7}},
+               {'tx-type': 'appl', 'sender': address, 'fee': 2000, 'round-time': 301},
+               {'tx-type': 'axfer', 'sender': 'X', 'fee': 1000, 'round-time': 900,
+                'asset-transfer-transaction': {'asset-id': 5, 'receiver': address, 'amount': 3}}]
+
+        ledger = wallet_ledger_columns(txs, address)
+        positions = positions_on_grid(ledger, np.array([0, 300, 600]), [0, 5])
+        self.assertEqual(positions.tolist(), [[0, 0], [49000, -7], [47000, -7]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,15 @@
 from __future__ import annotations
+import asyncio
 import time, datetime, warnings
+import logging
+import aiohttp
+import numpy as np
+import orjson
 import pandas as pd
+from functools import partial
 from typing import Dict, Iterable, Tuple, Optional
-from algo.blockchain.algo_requests import QueryParams
-from algo.blockchain.stream import DataStream
+from algo.blockchain.algo_requests import QueryParams, RequestPriority, query_transaction_pages, DEFAULT_PREFETCH
+from algo.blockchain.stream import background_loop
 from algo.strategy.analytics import ffill_cols, timestamp_to_5min
 from algo.tools.wallets import get_account_data
 from tinyman.v1.client import TinymanMainnetClient
@@ -11,6 +17,66 @@ from algo.blockchain.mixedstream import TotalDataLoader
 from tinyman.v1.pools import Asset
 
 
+LEDGER_COLUMNS = {'time': np.int64, 'asset_id': np.int64, 'amount': np.int64}
+
+
+def wallet_ledger_columns(transactions: list[dict], address: str) -> dict[str, np.ndarray]:
+    """ Changes of the holdings of an address from the transactions of a page, as columns: the amounts are positive
+    when received, and the fees paid by the address are changes of its Algo holdings """
+    rows = []
+    for txn in transactions:
+        time = txn['round-time']
+        sender = txn['sender']
+        if txn['tx-type'] == 'pay':
+            pay = txn['payment-transaction']
+            if pay['receiver'] == address:
+                rows.append((time, 0, pay['amount']))
+            elif sender == address:
+                rows.append((time, 0, -pay['amount'] - txn['fee']))
+        elif txn['tx-type'] == 'axfer':
+            axfer = txn['asset-transfer-transaction']
+            if axfer['receiver'] == address:
+                rows.append((time, axfer['asset-id'], axfer['amount']))
+            elif sender == address:
+                rows.append((time, 0, -txn['fee']))
+                rows.append((time, axfer['asset-id'], -axfer['amount']))
+        elif sender == address:
+            rows.append((time, 0, -txn['fee']))
+
+    columns = list(zip(*rows)) if rows else [()] * len(LEDGER_COLUMNS)
+    return {key: np.array(col, dtype=dtype) for (key, dtype), col in zip(LEDGER_COLUMNS.items(), columns)}
+
+
+def decode_wallet_page(body: bytes, address: str) -> tuple[Optional[str], dict[str, np.ndarray]]:
+    resp = orjson.loads(body)
+    return resp.get('next-token'), wallet_ledger_columns(resp['transactions'], address)
+
+
+async def query_wallet_ledger(session: aiohttp.ClientSession, address: str, query_params: QueryParams,
+                              priority: RequestPriority = RequestPriority.BACKFILL) -> dict[str, np.ndarray]:
+    """ Ledger of the changes of the holdings of an address, latest first """
+    pages = [page async for page in query_transaction_pages(session=session,
+                                                            params={'address': address},
+                                                            num_queries=None,
+                                                            query_params=query_params,
+                                                            decode=partial(decode_wallet_page, address=address),
+                                                            priority=priority,
+                                                            prefetch=DEFAULT_PREFETCH)]
+    return {key: np.concatenate([page[key] for page in pages]) if pages else np.empty(0, dtype=dtype)
+            for key, dtype in LEDGER_COLUMNS.items()}
+
+
+def positions_on_grid(ledger: dict[str, np.ndarray], grid: np.ndarray, asset_ids: list[int]) -> np.ndarray:
+    """ Holdings of each asset at each time of a sorted grid, as a (time, asset) matrix summing the changes of the
+    ledger up to that time. Changes of assets missing from asset_ids or after the grid are ignored """
+    col = pd.Index(asset_ids).get_indexer(ledger['asset_id'])
+    row = np.searchsorted(grid, ledger['time'], side='left')
+    keep = (col >= 0) & (row < len(grid))
+    positions = np.zeros((len(grid), len(asset_ids)), dtype=np.int64)
+    np.add.at(positions, (row[keep], col[keep]), ledger['amount'][keep])
+    return np.cumsum(positions, axis=0)
+
+
 class WalletValue:
 
     def __init__(self, cache_name, address):
@@ -31,67 +97,49 @@ class WalletValue:
             pool = client.fetch_pool(Asset(aid), Asset(0))
             self.liquidity_tokens[pool.asset1.id] = pool.liquidity_asset.id
 
-        prices_table = self.price_df.copy()
-        prices_table['time_5min'] = prices_table['time'] // (5 * 60) * (5 * 60)
+        prices_table = pd.DataFrame({'asset1': self.price_df['asset1'],
+                                     'time_5min': self.price_df['time'] // (5 * 60) * (5 * 60),
+                                     'liquidity_price': 2 * self.price_df['asset2_reserves']
+                                                        / self.price_df['issued_liquidity'].astype(float),
+                                     'price': self.price_df['asset2_reserves'] / self.price_df['asset1_reserves']})
 
-        prices_table['liquidity_price'] = 2 * prices_table['asset2_reserves'] / prices_table['issued_liquidity']
-        prices_table['price'] = prices_table['asset2_reserves'] / prices_table['asset1_reserves']
+        # Both the asset and the liquidity prices in a single pass, one column per asset
+        tables = prices_table.groupby(['time_5min', 'asset1'])[['price', 'liquidity_price']].mean() \
+            .unstack(level=1).ffill()
 
-        liq_prices_table = prices_table.groupby(['asset1', 'time_5min'])['liquidity_price'].mean()
-        liq_prices_table = liq_prices_table.unstack(level=0).fillna(method='ffill')
-        liq_prices_table.columns = [self.liquidity_tokens[col] for col in liq_prices_table.columns]
-
-        asset_prices_table = prices_table.groupby(['asset1', 'time_5min'])['price'].mean()
-        asset_prices_table = asset_prices_table.unstack(level=0).fillna(method='ffill')
+        asset_prices_table = tables['price']
         asset_prices_table[0] = 1
 
-        self.price_table = pd.concat([asset_prices_table, liq_prices_table], axis=1)
+        liq_prices_table = tables['liquidity_price']
+        liq_prices_table.columns = [self.liquidity_tokens[col] for col in liq_prices_table.columns]
 
-    def hist_params(self, query_params):
-        datastream = DataStream.from_address(self.address, query_params)
-
-        txns = []
-
-        for _, txn in datastream.next_transaction():
-            time = txn['round-time']
-
-            if txn['tx-type'] == 'pay':
-                if txn['payment-transaction']['receiver'] == self.address:
-                    txns.append((0, - txn['payment-transaction']['amount'], time))
-                elif txn['sender'] == self.address:
-                    txns.append((0, txn['payment-transaction']['amount'] + txn['fee'], time))
-                else:
-                    raise ValueError('encountered invalid transaction')
-            elif txn['tx-type'] == 'axfer':
-                assetid = txn['asset-transfer-transaction']['asset-id']
-                if txn['asset-transfer-transaction']['receiver'] == self.address:
-                    txns.append((assetid, - txn['asset-transfer-transaction']['amount'], time))
-                elif txn['sender'] == self.address:
-                    txns.append((0, txn['fee'], time))
-                    txns.append((assetid, txn['asset-transfer-transaction']['amount'], time))
-                else:
-                    raise ValueError('encountered invalid transaction')
-            else:
-                if txn['sender'] == self.address:
-                    txns.append((0, txn['fee'], time))
-
-        return txns
+        self.price_table = pd.concat([asset_prices_table, liq_prices_table], axis=1)
+        self.price_table.columns.name = None
 
-    def historical_wealth(self):
+    async def ahistorical_wealth(self, session: Optional[aiohttp.ClientSession] = None):
         after_time = datetime.datetime.fromtimestamp(self.price_df['time'].min())
         query_params = QueryParams(after_time=after_time)
-        txns = self.hist_params(query_params)
+        if session is None:
+            async with aiohttp.ClientSession() as session:
+                ledger = await query_wallet_ledger(session, self.address, query_params)
+        else:
+            ledger = await query_wallet_ledger(session, self.address, query_params)
 
         price_table = self.price_table.copy()
 
-        positions_table = pd.DataFrame(0, index=price_table.index, columns=price_table.columns)
-        for asset, amount, time in txns:
-            positions_table.loc[positions_table.index >= time, asset] -= amount
+        unknown = ~np.isin(ledger['asset_id'], price_table.columns)
+        if unknown.any():
+            logging.getLogger(__name__).warning(f'Ignoring the transfers of assets without prices: '
+                                                f'{sorted(set(ledger["asset_id"][unknown].tolist()))}')
 
-        wealth_table = (positions_table * price_table) / 10 ** 6
-        wealth = wealth_table.sum(axis=1)
-        wealth.index = pd.to_datetime(wealth.index, unit='s', utc=True)
+        positions = positions_on_grid(ledger, price_table.index.to_numpy(), list(price_table.columns))
+        wealth = pd.Series(np.nansum(positions * price_table.to_numpy(), axis=1) / 10 ** 6,
+                           index=pd.to_datetime(price_table.index, unit='s', utc=True))
 
         price_table.index = pd.to_datetime(price_table.index, unit='s', utc=True)
 
         return price_table, wealth[wealth > 0]
+
+    def historical_wealth(self):
+        """ Same as ahistorical_wealth, from synchronous code """
+        return asyncio.run_coroutine_threadsafe(self.ahistorical_wealth(), background_loop()).result()
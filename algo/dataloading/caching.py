@@ -1,73 +1,208 @@
 import datetime
 import glob
+import os
 import re
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
 from pathlib import Path
 
 from algo.universe.universe import SimpleUniverse
 from definitions import ROOT_DIR
 from typing import Optional, Callable
-from algo.blockchain.cache import DateValidator
-
-
-def load_algo_pools(cache_name: str, data_type: str, filter_pair: Optional[Callable]):
+from algo.blockchain.manifest import CacheManifest
+from algo.blockchain.compaction import pool_cache_files
+from algo.blockchain.utils import datetime_to_int
+
+
+def utc_date(timestamp: int) -> str:
+    return str(datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).date())
+
+
+def gap_overlaps(gaps: pd.DataFrame, time_min: Optional[datetime.datetime],
+                 time_max: Optional[datetime.datetime]) -> pd.DataFrame:
+    """ Gaps of a manifest with missing days within [time_min, time_max) """
+    overlaps = pd.Series(True, index=gaps.index)
+    if time_min is not None:
+        overlaps &= gaps['date_after'] > utc_date(datetime_to_int(time_min))
+    if time_max is not None:
+        overlaps &= gaps['date_before'] < utc_date(datetime_to_int(time_max) - 1)
+    return gaps[overlaps]
+
+
+def pool_dirs(cache_dir: str, filter_pair: Optional[Callable]) -> dict[tuple[int, int], str]:
+    pools = {}
+    for base_dir in sorted(glob.glob(os.path.join(cache_dir, '*'))):
+        name = Path(base_dir).name
+        if re.match('[0-9]+_[0-9]+$', name):
+            a0, a1 = tuple(int(x) for x in name.split('_'))
+            if filter_pair is None or filter_pair(a0, a1):
+                pools[(a0, a1)] = base_dir
+    return pools
+
+
+def read_pool_table(pool_dir: str, assets: tuple[int, int], time_filter: Optional[ds.Expression],
+                    columns: Optional[list[str]]) -> Optional[pa.Table]:
+    """ Rows of the cache of a pool sorted by time, filtered while scanning the files """
+    files = pool_cache_files(pool_dir)
+    if not files:
+        return None
+    dataset = ds.dataset(files, format='parquet')
+    # Columns of days without some values are stored with a null type
+    schema = pa.unify_schemas([fragment.physical_schema for fragment in dataset.get_fragments()])
+    dataset = ds.dataset(files, schema=schema, format='parquet')
+
+    read_columns = None if columns is None else list(dict.fromkeys(['time'] + columns))
+    table = dataset.to_table(columns=read_columns, filter=time_filter).sort_by('time')
+    if columns is not None:
+        table = table.select(columns)
+
+    n = table.num_rows
+    for key, asset_id in zip(('asset1', 'asset2'), assets):
+        table = table.append_column(key, pa.DictionaryArray.from_arrays(pa.array(np.zeros(n, dtype=np.int32)),
+                                                                        pa.array([asset_id], type=pa.int64())))
+    return table
+
+
+def read_cache_table(cache_dir: str, filter_pair: Optional[Callable] = None,
+                     time_min: Optional[datetime.datetime] = None, time_max: Optional[datetime.datetime] = None,
+                     columns: Optional[list[str]] = None, max_workers: Optional[int] = None,
+                     check_gaps: bool = True) -> Optional[pa.Table]:
+    """ Rows of the pools of a cache with times in [time_min, time_max), with the given columns and the asset ids
+    of the pool as dictionary-encoded asset1 and asset2 columns, sorted by time within each pool. The pools are read
+    concurrently, and the time range is pushed down to the parquet scans. None if no pool has any file """
+    pools = pool_dirs(cache_dir, filter_pair)
+
+    if check_gaps:
+        gaps = gap_overlaps(CacheManifest(cache_dir).gaps(), time_min, time_max)
+        gap_pools = gaps[gaps['pool'].isin([Path(x).name for x in pools.values()])]
+        assert gap_pools.empty, f'{gap_pools}'
+
+    time_filter = None
+    if time_min is not None:
+        time_filter = ds.field('time') >= datetime_to_int(time_min)
+    if time_max is not None:
+        below_max = ds.field('time') < datetime_to_int(time_max)
+        time_filter = below_max if time_filter is None else time_filter & below_max
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        tables = list(executor.map(lambda x: read_pool_table(x[1], x[0], time_filter, columns), pools.items()))
+    tables = [x for x in tables if x is not None]
+    if not tables:
+        return None
+    # Without the pandas metadata of the files, which describes their own index
+    schema = pa.unify_schemas([x.schema for x in tables]).remove_metadata()
+    return pa.concat_tables([x.cast(schema) for x in tables])
+
+
+def table_to_frame(table: pa.Table) -> pd.DataFrame:
+    """ DataFrame of a table of read_cache_table, with integer asset ids """
+    for key in ('asset1', 'asset2'):
+        table = table.set_column(table.schema.get_field_index(key), key, table[key].cast(pa.int64()))
+    return table.to_pandas()
+
+
+def load_algo_pools(cache_name: str, data_type: str, filter_pair: Optional[Callable],
+                    time_min: Optional[datetime.datetime] = None, time_max: Optional[datetime.datetime] = None,
+                    columns: Optional[list[str]] = None) -> pd.DataFrame:
+    """ DataFrame of read_cache_table, with integer asset ids """
     assert data_type in ['prices', 'volumes']
 
-    pattern = f'{ROOT_DIR}/caches/{data_type}/{cache_name}/*'
-
-    def gen_data():
-        for base_dir in glob.glob(pattern):
-            name = Path(base_dir).name
-
-            if re.match('[0-9]+_[0-9]+$', name):
-                a0, a1 = tuple(int(x) for x in name.split('_'))
-
-                if filter_pair is None or filter_pair(a0, a1):
-                    dv = DateValidator(f'{ROOT_DIR}/caches/{data_type}', cache_name, None, (a0, a1))
-                    assert not dv.has_gaps()
-                    df = pd.read_parquet(base_dir)
-                    if not df.empty:
-                        df = df.sort_values(by='time')
-                        df['asset1'] = a0
-                        df['asset2'] = a1
-                    yield df
-
-    return pd.concat(gen_data())
+    table = read_cache_table(f'{ROOT_DIR}/caches/{data_type}/{cache_name}', filter_pair, time_min, time_max, columns)
+    if table is None:
+        raise ValueError(f'No data in cache {cache_name} of {data_type}')
+    return table_to_frame(table)
 
 
 def validate_missing_days(df):
-    def validate(subdf, name):
-        days = pd.to_datetime(subdf['time'], unit='s', utc=True).dt.date.unique()
-        day = min(days)
-        while day < max(days):
-            assert day in days, f"day {day} missing for id {name}"
-            day += datetime.timedelta(days=1)
-
-    df.groupby('asset1').apply(lambda x: validate(x, x.name))
-
-
-def join_caches_with_priority(caches: list[str], data_type: str, filter_pair: Optional[Callable]):
-    data = []
-
-    if len(caches) > 1:
-        raise NotImplementedError("Need to guarantee the gaps are dealt with properly")
-
-    for cache_priority, cachename in enumerate(caches):
-        subdf = load_algo_pools(cachename, data_type, filter_pair=filter_pair)
-        subdf['cache_priority'] = cache_priority
-        data.append(subdf)
-    df = pd.concat(data)
-    time_maxes = df.groupby(['asset1', 'cache_priority'])['time'].max()
-
-    filt_idx = pd.Series(True, index=df.index)
-
-    for x, time_max in time_maxes.items():
-        aid, priority = x[0], x[1]
-        filt_idx &= (df['cache_priority'] <= priority) | (df['asset1'] != aid) | (df['time'] > time_max)
-
-    ret = df[filt_idx].drop(columns='cache_priority').sort_values(by='time')
+    days = pd.to_datetime(df['time'], unit='s', utc=True).dt.floor('D')
+    stats = days.groupby(df['asset1']).agg(['min', 'max', 'nunique'])
+    n_days = (stats['max'] - stats['min']).dt.days + 1
+    missing = stats.index[n_days != stats['nunique']]
+    assert len(missing) == 0, f"days missing for ids {list(missing)}"
+
+
+def merge_intervals(starts: np.ndarray, ends: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """ Union of [start, end) intervals, as sorted disjoint intervals """
+    order = np.argsort(starts, kind='stable')
+    starts, ends = starts[order], ends[order]
+    if not len(starts):
+        return starts, ends
+    max_end = np.maximum.accumulate(ends)
+    new = np.ones(len(starts), dtype=bool)
+    new[1:] = starts[1:] > max_end[:-1]
+    return starts[new], np.maximum.reduceat(ends, np.flatnonzero(new))
+
+
+def cache_coverage(cache_dir: str) -> dict[tuple[int, int], tuple[np.ndarray, np.ndarray]]:
+    """ Times covered by the cached days of each pool of a cache, as sorted disjoint [start, end) intervals """
+    dates = CacheManifest(cache_dir).covered_dates()
+    coverage = {}
+    for pool, pool_dates in dates.groupby('pool'):
+        days = pd.to_datetime(pool_dates['date']).to_numpy().astype('datetime64[D]').astype(np.int64)
+        assets = tuple(int(x) for x in pool.split('_'))
+        coverage[assets] = merge_intervals(days * 86400, (days + 1) * 86400)
+    return coverage
+
+
+def drop_covered(table: pa.Table, coverage: dict[tuple[int, int], tuple[np.ndarray, np.ndarray]]) -> pa.Table:
+    """ Rows of a table of read_cache_table whose times are outside the coverage of their pool. The rows of each
+    pool are contiguous and sorted by time, so the covered rows are found by cutting them at the interval bounds """
+    asset1 = table['asset1'].cast(pa.int64()).to_numpy()
+    asset2 = table['asset2'].cast(pa.int64()).to_numpy()
+    times = table['time'].to_numpy()
+
+    n = table.num_rows
+    bounds = np.flatnonzero((asset1[1:] != asset1[:-1]) | (asset2[1:] != asset2[:-1])) + 1
+    covered = np.zeros(n + 1, dtype=np.int64)
+    for start, end in zip(np.concatenate([[0], bounds]), np.concatenate([bounds, [n]])):
+        if start == end or (asset1[start], asset2[start]) not in coverage:
+            continue
+        interval_starts, interval_ends = coverage[(asset1[start], asset2[start])]
+        pool_times = times[start:end]
+        np.add.at(covered, start + np.searchsorted(pool_times, interval_starts, side='left'), 1)
+        np.add.at(covered, start + np.searchsorted(pool_times, interval_ends, side='left'), -1)
+    return table.filter(pa.array(np.cumsum(covered[:-1]) == 0))
+
+
+def join_caches_with_priority(caches: list[str], data_type: str, filter_pair: Optional[Callable],
+                              time_min: Optional[datetime.datetime] = None,
+                              time_max: Optional[datetime.datetime] = None) -> pd.DataFrame:
+    """ Joins caches of the same data type into one timeline sorted by time. On the days covered by a cache
+    according to its manifest, including the cached days without data, its rows replace those of the caches after
+    it in the list, so that each cache only fills the days missing from the caches before it """
+    assert data_type in ['prices', 'volumes']
 
-    return ret
+    tables = []
+    coverage: dict[tuple[int, int], tuple[np.ndarray, np.ndarray]] = {}
+    for cache_name in caches:
+        cache_dir = f'{ROOT_DIR}/caches/{data_type}/{cache_name}'
+        table = read_cache_table(cache_dir, filter_pair, time_min, time_max, check_gaps=False)
+        if table is not None:
+            tables.append(drop_covered(table, coverage))
+
+        for assets, (starts, ends) in cache_coverage(cache_dir).items():
+            if assets in coverage:
+                starts = np.concatenate([coverage[assets][0], starts])
+                ends = np.concatenate([coverage[assets][1], ends])
+            coverage[assets] = merge_intervals(starts, ends)
+
+    # The gaps of a cache may be filled by the others, only the gaps left by all of them are missing data
+    time_min_int = -np.inf if time_min is None else datetime_to_int(time_min)
+    time_max_int = np.inf if time_max is None else datetime_to_int(time_max)
+    gaps = {assets: [(int(end), int(start)) for end, start in zip(ends[:-1], starts[1:])
+                     if start > time_min_int and end < time_max_int]
+            for assets, (starts, ends) in coverage.items() if filter_pair is None or filter_pair(*assets)}
+    gaps = {assets: x for assets, x in gaps.items() if x}
+    assert not gaps, f'Missing times of the pools {gaps}'
+
+    if not tables:
+        raise ValueError(f'No data in caches {caches} of {data_type}')
+    schema = pa.unify_schemas([x.schema for x in tables])
+    df = table_to_frame(pa.concat_tables([x.cast(schema) for x in tables]))
+    return df.sort_values(by='time', kind='stable', ignore_index=True)
 
 
 def make_filter_from_universe(universe: SimpleUniverse):
@@ -0,0 +1,84 @@
+import datetime
+import os
+import tempfile
+import unittest
+from unittest import mock
+import pandas as pd
+from algo.blockchain.cache import write_day_file
+from algo.blockchain.manifest import CacheManifest, DayFile
+from algo.dataloading.caching import read_cache_table, join_caches_with_priority
+
+
+class TestReadCacheTable(unittest.TestCase):
+
+    def test_filters_and_columns(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            manifest = CacheManifest(cache_dir)
+            for pool, issued_liquidity in (('5_0', [None, None]), ('7_0', [3, 4])):
+                os.makedirs(os.path.join(cache_dir, pool))
+                days = []
+                for i, date in enumerate([datetime.date(2022, 1, 1), datetime.date(2022, 1, 2)]):
+                    time = int(datetime.datetime(2022, 1, 1 + i, tzinfo=datetime.timezone.utc).timestamp())
+                    # Latest first, as the daily files
+                    df = pd.DataFrame({'time': [time + 60, time], 'asset1_reserves': [1, 2],
+                                       'issued_liquidity': issued_liquidity})
+                    days.append(write_day_file(df, date, os.path.join(cache_dir, pool, f'{date}.parquet')))
+                manifest.add_days(pool, days)
+
+            table = read_cache_table(cache_dir, lambda a1, a2: a1 == 5,
+                                     time_min=datetime.datetime(2022, 1, 1, 0, 1, tzinfo=datetime.timezone.utc),
+                                     columns=['time', 'issued_liquidity'])
+            df = table.to_pandas()
+            self.assertEqual(df['time'].diff().dropna().min(), 60)
+            self.assertEqual(len(df), 3)
+            self.assertEqual(list(df['asset1']), [5, 5, 5])
+            self.assertTrue(df['issued_liquidity'].isna().all())
+
+
+
+def write_cache(cache_dir: str, days: dict[str, dict[datetime.date, int]]):
+    """ Cache with two rows a day on the days of each pool, with the given reserves. Days with zero reserves are
+    cached without data """
+    manifest = CacheManifest(cache_dir)
+    for pool, pool_days in days.items():
+        os.makedirs(os.path.join(cache_dir, pool))
+        day_files = []
+        for date, reserves in pool_days.items():
+            if not reserves:
+                day_files.append(DayFile(date))
+                continue
+            time = int(datetime.datetime(date.year, date.month, date.day, tzinfo=datetime.timezone.utc).timestamp())
+            df = pd.DataFrame({'time': [time + 120, time + 60], 'asset1_reserves': reserves})
+            day_files.append(write_day_file(df, date, os.path.join(cache_dir, pool, f'{date}.parquet')))
+        manifest.add_days(pool, day_files)
+
+
+class TestJoinCaches(unittest.TestCase):
+
+    def test_priority_and_gaps(self):
+        jan = [datetime.date(2022, 1, day) for day in range(1, 5)]
+        with tempfile.TemporaryDirectory() as root_dir, mock.patch('algo.dataloading.caching.ROOT_DIR', root_dir):
+            prices_dir = os.path.join(root_dir, 'caches', 'prices')
+            # Covers the second day without data, and misses the third day
+            write_cache(os.path.join(prices_dir, 'first'), {'5_0': {jan[0]: 1, jan[1]: 0, jan[3]: 1}})
+            write_cache(os.path.join(prices_dir, 'second'), {'5_0': {date: 2 for date in jan},
+                                                             '7_0': {date: 2 for date in jan}})
+            write_cache(os.path.join(prices_dir, 'short'), {'5_0': {date: 2 for date in jan[:2]}})
+
+            df = join_caches_with_priority(['first', 'second'], 'prices', None)
+            self.assertTrue((df['time'].diff().dropna() >= 0).all())
+            pool_df = df[df['asset1'] == 5]
+            self.assertEqual(pd.to_datetime(pool_df['time'], unit='s').dt.date.tolist(),
+                             [jan[0], jan[0], jan[2], jan[2], jan[3], jan[3]])
+            self.assertEqual(pool_df['asset1_reserves'].tolist(), [1, 1, 2, 2, 1, 1])
+            self.assertEqual(df.loc[df['asset1'] == 7, 'asset1_reserves'].tolist(), [2] * 8)
+
+            # The third day is missing from both caches
+            with self.assertRaisesRegex(AssertionError, 'Missing times'):
+                join_caches_with_priority(['first', 'short'], 'prices', None)
+            time_max = datetime.datetime(2022, 1, 3, tzinfo=datetime.timezone.utc)
+            df = join_caches_with_priority(['first', 'short'], 'prices', None, time_max=time_max)
+            self.assertEqual(df['asset1_reserves'].tolist(), [1, 1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,15 +5,18 @@ from algo.trading.impact import GlobalPositionAndImpactState, StateLog, Position
     ASAPosition
 from algo.optimizer.base import BaseOptimizer
 from algo.trading.signalprovider import PriceSignalProvider
-from algo.blockchain.stream import PoolState, PriceUpdate, StreamException
+from algo.blockchain.stream import PoolState, PriceUpdate, PriceUpdateBatch, StreamException
+from algo.blockchain.mixedstream import MixedPriceStreamer
 from algo.universe.universe import SimpleUniverse
-from typing import Callable, Generator, Any, Type, Optional
+from typing import Callable, Generator, AsyncGenerator, Iterable, Any, Type, Optional, Union
 from algo.trading.swapper import Swapper
 from algo.engine.base import BaseEngine, lag_ms
 import asyncio
 import datetime
 from algo.tools.wallets import get_account_data
 import requests
+import aiohttp
+import numpy as np
 
 
 class Engine(BaseEngine):
@@ -23,7 +26,8 @@ class Engine(BaseEngine):
 
     def __init__(self,
                  universe: SimpleUniverse,
-                 price_scraper: Callable[[], Generator[PriceUpdate, Any, Any]],
+                 price_scraper: Callable[[], Union[Generator[Union[PriceUpdate, PriceUpdateBatch], Any, Any],
+                                                   AsyncGenerator[Union[PriceUpdate, PriceUpdateBatch], Any]]],
                  trading_step_seconds: int,
                  marketupdate_step_seconds: int,
                  syncpositions_step_seconds: int,
@@ -63,71 +67,174 @@ class Engine(BaseEngine):
 
         self.redeem_step_seconds = redeem_step_seconds
 
+        # Streamer behind price_scraper, closed when the engine stops
+        self.streamer: Optional[MixedPriceStreamer] = None
+
+    @staticmethod
+    def from_streamer(streamer: MixedPriceStreamer, batch_size: int = 1000, **kwargs) -> Engine:
+        """ Engine following the market of streamer on its own event loop, without blocking the other loops of the
+        engine on the indexer requests. The updates are applied in batches of up to batch_size """
+        engine = Engine(universe=streamer.universe,
+                        price_scraper=lambda: streamer.ascrape_batches(batch_size), **kwargs)
+        engine.streamer = streamer
+        return engine
+
+    def _apply_price_update(self, x: PriceUpdate) -> datetime.datetime:
+        assert x.asset_ids[1] == 0
+        assert x.asset_ids[0] in self.asset_ids
+        asset_id, price_update = x.asset_ids[0], x.price_update
+
+        # Time of the price update
+        # time = int_to_tzaware_utc_datetime(x.price_update.time)
+        time = datetime.datetime.utcfromtimestamp(x.price_update.time)
+
+        if asset_id in self.last_update_times:
+            assert time >= self.last_update_times[asset_id]
+        self.last_update_times[asset_id] = time
+        self.prices[asset_id] = price_update
+        self.signal_providers[asset_id].update(time,
+                                               price_update.asset2_reserves / price_update.asset1_reserves)
+        return time
+
+    def _apply_price_batch(self, batch: PriceUpdateBatch) -> tuple[datetime.datetime, datetime.datetime]:
+        """ Applies the updates of a batch, returning the times of the first and the last one. The signals see
+        every update, the prices are only set to the last state of each pool """
+        assert (batch.asset2 == 0).all()
+        assert np.isin(batch.asset1, self.asset_ids).all()
+        assert (np.diff(batch.time) >= 0).all()
+
+        times = batch.time.astype('datetime64[s]').tolist()
+        assets, first = np.unique(batch.asset1, return_index=True)
+        for asset_id, i in zip(assets.tolist(), first.tolist()):
+            if asset_id in self.last_update_times:
+                assert times[i] >= self.last_update_times[asset_id]
+
+        prices = batch.asset2_reserves / batch.asset1_reserves
+        for asset_id, time, price in zip(batch.asset1.tolist(), times, prices.tolist()):
+            self.signal_providers[asset_id].update(time, price)
+
+        for (asset_id, _), i in batch.last_indices().items():
+            self.last_update_times[asset_id] = times[i]
+            self.prices[asset_id] = batch.pool_state(i)
+        return times[0], times[-1]
+
+    def _apply_market_update(self, x: Union[PriceUpdate, PriceUpdateBatch]) \
+            -> Optional[tuple[datetime.datetime, datetime.datetime]]:
+        """ Times of the first and the last update applied, None for an empty batch """
+        if isinstance(x, PriceUpdateBatch):
+            return self._apply_price_batch(x) if len(x) else None
+        time = self._apply_price_update(x)
+        return time, time
+
+    def _log_market_sync(self, start_time: datetime.datetime,
+                         min_market_time: Optional[datetime.datetime],
+                         max_market_time: Optional[datetime.datetime]) -> None:
+        end_time = datetime.datetime.utcnow()
+        self.last_market_state_update = end_time
+
+        dt_run = lag_ms(end_time - start_time)
+        if max_market_time is not None:
+            dt_market = lag_ms(max_market_time - min_market_time)
+        else:
+            dt_market = 0
+        self.logger.debug(f'Scraped {dt_market} ms worth of market data in {dt_run} ms')
+
     def sync_market_state(self) -> None:
+        self._sync_market_state(self.price_scraper())
+
+    def _sync_market_state(self, updates: Iterable[Union[PriceUpdate, PriceUpdateBatch]]) -> None:
         start_time = datetime.datetime.utcnow()
         min_market_time = None
         max_market_time = None
 
         try:
-            for x in self.price_scraper():
-                assert x.asset_ids[1] == 0
-                assert x.asset_ids[0] in self.asset_ids
-                asset_id, price_update = x.asset_ids[0], x.price_update
-
-                # Time of the price update
-                # time = int_to_tzaware_utc_datetime(x.price_update.time)
-                time = datetime.datetime.utcfromtimestamp(x.price_update.time)
+            for x in updates:
+                times = self._apply_market_update(x)
+                if times is None:
+                    continue
 
                 if min_market_time is None:
-                    min_market_time = time
+                    min_market_time = times[0]
                 else:
-                    assert time >= max_market_time
-                max_market_time = time
-
-                if asset_id in self.last_update_times:
-                    assert time >= self.last_update_times[asset_id]
-                self.last_update_times[asset_id] = time
-                self.prices[asset_id] = price_update
-                self.signal_providers[asset_id].update(time,
-                                                       price_update.asset2_reserves / price_update.asset1_reserves)
-
-            end_time = datetime.datetime.utcnow()
-            self.last_market_state_update = end_time
-
-            dt_run = lag_ms(end_time - start_time)
-            if max_market_time is not None:
-                dt_market = lag_ms(max_market_time - min_market_time)
-            else:
-                dt_market = 0
-            self.logger.debug(f'Scraped {dt_market} ms worth of market data in {dt_run} ms')
+                    assert times[0] >= max_market_time
+                max_market_time = times[1]
+
+            self._log_market_sync(start_time, min_market_time, max_market_time)
 
         except requests.exceptions.ConnectionError as e:
             self.logger.error(f'Price scraping in sync_market_state failed with ConnectionError: {e}')
         except StreamException as e:
             self.logger.error(f'Price scraping in sync_market_state failed with StreamException: {e}')
 
-    def redeem_amounts(self) -> None:
+    async def async_sync_market_state(self) -> None:
+        """ Same as sync_market_state for a price scraper returning an async generator, so that the other
+        engine loops keep running while we wait for the indexer """
+        updates = self.price_scraper()
+        if not hasattr(updates, '__aiter__'):
+            self._sync_market_state(updates)
+            return
 
-        time = self.current_time_prov()
-        self.logger.info(f'Entering redeem loop.')
+        start_time = datetime.datetime.utcnow()
+        min_market_time = None
+        max_market_time = None
+
+        try:
+            async for x in updates:
+                times = self._apply_market_update(x)
+                if times is None:
+                    continue
 
+                if min_market_time is None:
+                    min_market_time = times[0]
+                else:
+                    assert times[0] >= max_market_time
+                max_market_time = times[1]
+
+            self._log_market_sync(start_time, min_market_time, max_market_time)
+
+        except aiohttp.ClientConnectionError as e:
+            self.logger.error(f'Price scraping in sync_market_state failed with ClientConnectionError: {e}')
+        except StreamException as e:
+            self.logger.error(f'Price scraping in sync_market_state failed with StreamException: {e}')
+
+    def _redeem_prices(self, time: datetime.datetime) -> dict[int, float]:
+        prices = {}
         for aid in self.asset_ids:
             if aid not in self.prices:
                 self.logger.warning(f'price for {aid} not present at time {time}. Skipping redeem amount')
             else:
-                asa_price = self.prices[aid].asset2_reserves / self.prices[aid].asset1_reserves
-                redeemed_amount = self.swapper[aid].fetch_excess_amounts(asa_price)
-                if self.pos_impact_state is not None:
-                    self.pos_impact_state.update_redeem(aid, redeemed_amount)
+                prices[aid] = self.prices[aid].asset2_reserves / self.prices[aid].asset1_reserves
+        return prices
+
+    def _apply_redeem(self, aid: int, redeemed_amount) -> None:
+        if self.pos_impact_state is not None:
+            self.pos_impact_state.update_redeem(aid, redeemed_amount)
+
+    def redeem_amounts(self) -> None:
+
+        time = self.current_time_prov()
+        self.logger.info(f'Entering redeem loop.')
+
+        for aid, asa_price in self._redeem_prices(time).items():
+            self._apply_redeem(aid, self.swapper[aid].fetch_excess_amounts(asa_price))
 
         dt = lag_ms(self.current_time_prov() - time)
         self.logger.info(f'Exiting redeem_amounts after {dt} ms')
 
-    def sync_state(self) -> None:
-
+    async def async_redeem_amounts(self) -> None:
+        """ Same as redeem_amounts, the redeem transactions run in a thread so that the other engine loops keep
+        running meanwhile """
         time = self.current_time_prov()
-        self.logger.info(f'Entering sync_state loop.')
+        self.logger.info(f'Entering redeem loop.')
 
+        for aid, asa_price in self._redeem_prices(time).items():
+            self._apply_redeem(aid, await asyncio.to_thread(self.swapper[aid].fetch_excess_amounts, asa_price))
+
+        dt = lag_ms(self.current_time_prov() - time)
+        self.logger.info(f'Exiting redeem_amounts after {dt} ms')
+
+    def _apply_account_data(self, account_data: dict[int, int]) -> None:
+        """ Sets the tracked positions to the amounts of the account """
         check_diff = True
         if self.pos_impact_state is None:
             check_diff = False
@@ -137,7 +244,7 @@ class Engine(BaseEngine):
                 mualgo_position=0
             )
 
-        for aid, amount in get_account_data(self.address).items():
+        for aid, amount in account_data.items():
             if aid == 0:
                 if check_diff and self.pos_impact_state.mualgo_position != amount:
                     self.logger.warning(
@@ -152,6 +259,24 @@ class Engine(BaseEngine):
             else:
                 self.logger.debug(f'aid {aid} in our portfolio but not in this universe')
 
+    def sync_state(self) -> None:
+
+        time = self.current_time_prov()
+        self.logger.info(f'Entering sync_state loop.')
+
+        self._apply_account_data(get_account_data(self.address))
+
+        dt = lag_ms(self.current_time_prov() - time)
+        self.logger.info(f'Exiting sync_state after {dt} ms')
+
+    async def async_sync_state(self) -> None:
+        """ Same as sync_state, the account is queried in a thread so that the other engine loops keep running
+        meanwhile """
+        time = self.current_time_prov()
+        self.logger.info(f'Entering sync_state loop.')
+
+        self._apply_account_data(await asyncio.to_thread(get_account_data, self.address))
+
         dt = lag_ms(self.current_time_prov() - time)
         self.logger.info(f'Exiting sync_state after {dt} ms')
 
@@ -159,10 +284,6 @@ class Engine(BaseEngine):
             log_trade: Callable[[TradeInfo], None],
             log_state: Callable[[StateLog], None]):
 
-        self.sync_market_state()
-        self.redeem_amounts()
-        self.sync_state()
-
         async def trade():
             while True:
                 self.trade_loop(log_trade, log_state)
@@ -170,20 +291,27 @@ class Engine(BaseEngine):
 
         async def market_update():
             while True:
-                self.sync_market_state()
+                await self.async_sync_market_state()
                 await asyncio.sleep(self.marketupdate_step_seconds)
 
         async def sync_positions():
             while True:
-                self.sync_state()
+                await self.async_sync_state()
                 await asyncio.sleep(self.syncpositions_step_seconds)
 
         async def redeem():
             while True:
-                self.redeem_amounts()
+                await self.async_redeem_amounts()
                 await asyncio.sleep(self.redeem_step_seconds)
 
         async def run():
-            await asyncio.gather(market_update(), sync_positions(), trade(), redeem())
+            try:
+                await self.async_sync_market_state()
+                await self.async_redeem_amounts()
+                await self.async_sync_state()
+                await asyncio.gather(market_update(), sync_positions(), trade(), redeem())
+            finally:
+                if self.streamer is not None:
+                    await self.streamer.aclose()
 
         asyncio.run(run())
@@ -0,0 +1,106 @@
+import asyncio
+import datetime
+import threading
+import unittest
+from datetime import timezone
+from types import SimpleNamespace
+from unittest import mock
+import numpy as np
+import pandas as pd
+from algo.blockchain.stream import stream_from_price_df, batches_from_price_df
+from algo.blockchain.utils import datetime_to_int
+from algo.engine.engine import Engine
+from algo.trading.signalprovider import DummySignalProvider
+from algo.universe.pools import PoolId
+from algo.universe.universe import SimpleUniverse
+
+
+class TestEngine(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.asset_ids = [1, 2, 3]
+        self.universe = SimpleUniverse(pools=[PoolId(asset1_id, 0, "dummy") for asset1_id in self.asset_ids])
+        self.initial_time = datetime.datetime(year=2021, month=11, day=10, tzinfo=timezone.utc)
+
+        rng = np.random.default_rng(0)
+        n = 5000
+        self.dfp = pd.DataFrame({'time': datetime_to_int(self.initial_time) + np.cumsum(rng.integers(0, 10, n)),
+                                 'asset1': rng.choice(self.asset_ids, n), 'asset2': 0,
+                                 'asset1_reserves': (10 ** 10 * np.exp(np.cumsum(rng.normal(0, 0.002, n)))).astype(
+                                     np.int64),
+                                 'asset2_reserves': 10 ** 12, 'issued_liquidity': 10 ** 9,
+                                 'block': 1000 + np.arange(n), 'reverse_order_in_block': 0})
+
+    @staticmethod
+    def engine_kwargs() -> dict:
+        return dict(trading_step_seconds=5,
+                    marketupdate_step_seconds=5,
+                    syncpositions_step_seconds=60,
+                    redeem_step_seconds=60,
+                    make_optimizer=lambda aid: None,
+                    make_swapper=lambda aid: None,
+                    # Alternates at each update, so that a skipped update changes the signal
+                    make_signal_provider=lambda aid: DummySignalProvider(0.005, True),
+                    slippage=0,
+                    address='',
+                    decay_impact_seconds=60)
+
+    def make_engine(self, price_scraper) -> Engine:
+        return Engine(universe=self.universe, price_scraper=price_scraper, **self.engine_kwargs())
+
+    def assertSameMarketState(self, engine: Engine, expected: Engine):
+        self.assertEqual(engine.prices, expected.prices)
+        self.assertEqual(engine.last_update_times, expected.last_update_times)
+        for aid in self.asset_ids:
+            self.assertEqual(engine.signal_providers[aid].value, expected.signal_providers[aid].value)
+
+    def test_batches_same_as_updates(self):
+        engine = self.make_engine(lambda: stream_from_price_df(self.dfp, self.initial_time))
+        engine.sync_market_state()
+        self.assertEqual(set(engine.prices), set(self.asset_ids))
+
+        batch_engine = self.make_engine(lambda: batches_from_price_df(self.dfp, self.initial_time, batch_size=700))
+        batch_engine.sync_market_state()
+        self.assertSameMarketState(batch_engine, engine)
+
+        async def ascrape_batches(batch_size: int):
+            for x in batches_from_price_df(self.dfp, self.initial_time, batch_size=batch_size):
+                yield x
+
+        streamer = SimpleNamespace(universe=self.universe, ascrape_batches=ascrape_batches)
+        async_engine = Engine.from_streamer(streamer, batch_size=700, **self.engine_kwargs())
+        asyncio.run(async_engine.async_sync_market_state())
+        self.assertSameMarketState(async_engine, engine)
+
+    def test_slow_position_sync(self):
+        account_queried = threading.Event()
+        market_synced = threading.Event()
+
+        def get_account_data(address):
+            # Blocks until the market has been synced, as a request to a slow endpoint would
+            account_queried.set()
+            self.assertTrue(market_synced.wait(timeout=10))
+            return {0: 10 ** 6, 1: 5}
+
+        async def price_scraper():
+            for x in batches_from_price_df(self.dfp, self.initial_time, batch_size=700):
+                yield x
+
+        engine = self.make_engine(price_scraper)
+
+        async def main():
+            sync_positions = asyncio.create_task(engine.async_sync_state())
+            while not account_queried.is_set():
+                await asyncio.sleep(0.01)
+            await engine.async_sync_market_state()
+            self.assertFalse(sync_positions.done())
+            market_synced.set()
+            await sync_positions
+
+        with mock.patch('algo.engine.engine.get_account_data', get_account_data):
+            asyncio.run(asyncio.wait_for(main(), timeout=20))
+
+        self.assertEqual(set(engine.prices), set(self.asset_ids))
+        self.assertEqual(engine.pos_impact_state.mualgo_position, 10 ** 6)
+        self.assertEqual(engine.pos_impact_state.asa_states[1].asa_position.value, 5)
+
@@ -63,7 +63,10 @@ class AnalysisDataStore:
                  ffill_price_minutes: Optional[Union[int, str]],
                  market_lag_seconds: int,
                  volume_aggregators: list[Callable[[pd.DataFrame], pd.DataFrame]],
-                 make_df_lagged: bool = True):
+                 make_df_lagged: bool = True,
+                 time_min: Optional[datetime.datetime] = None,
+                 time_max: Optional[datetime.datetime] = None):
+        """ Only the market data with times in [time_min, time_max) is loaded from the caches """
 
         self.features_lag_seconds = market_lag_seconds
 
@@ -75,12 +78,12 @@ class AnalysisDataStore:
 
         filter_ = make_filter_from_universe(universe)
 
-        dfp = join_caches_with_priority(price_caches, 'prices', filter_)
+        dfp = join_caches_with_priority(price_caches, 'prices', filter_, time_min, time_max)
         if make_df_lagged:
             dfp_lagged = lag_market_data(dfp, self.features_lag_seconds)
 
         if volume_caches:
-            dfv = join_caches_with_priority(volume_caches, 'volumes', filter_)
+            dfv = join_caches_with_priority(volume_caches, 'volumes', filter_, time_min, time_max)
             if make_df_lagged:
                 dfv_lagged = lag_market_data(dfv, self.features_lag_seconds)
         else:
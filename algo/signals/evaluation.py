@@ -10,8 +10,7 @@ from sklearn.metrics import r2_score, explained_variance_score
 from algo.signals.constants import ASSET_INDEX_NAME, TIME_INDEX_NAME
 from algo.signals.responses import ComputedLookaheadResponse
 from sklearn.decomposition import PCA
-from algo.tools.asset_data_store import AssetDataStore, get_asset_datastore
-from tinyman.v1.client import TinymanMainnetClient
+from algo.tools.asset_data_store import get_asset_datastore
 
 
 def any_axis_1(x):
@@ -209,8 +208,7 @@ class FittableDataStore:
 
     def __init__(self, features: pd.DataFrame, response: ComputedLookaheadResponse, weights: pd.Series,
                  oos_time: datetime.datetime, splitting_strategy: str = 'normal'):
-        client = TinymanMainnetClient()
-        self.ads = AssetDataStore(client)
+        self.ads = get_asset_datastore()
 
         assert np.all(features.index == response.index)
         assert np.all(features.index == weights.index)
@@ -3,14 +3,15 @@ from __future__ import annotations
 import copy
 import datetime
 import logging
+import numpy as np
 from algo.trading.trades import TradeInfo
 from algo.trading.impact import GlobalPositionAndImpactState, StateLog
 from algo.optimizer.base import BaseOptimizer
 from algo.trading.signalprovider import PriceSignalProvider
-from algo.blockchain.stream import PoolState, PriceUpdate
+from algo.blockchain.stream import PoolState, PriceUpdate, PriceUpdateBatch
 from algo.universe.universe import SimpleUniverse
-from typing import Callable, Generator, Any, Optional, Type
-from algo.blockchain.utils import int_to_tzaware_utc_datetime
+from typing import Callable, Generator, Any, Optional, Type, Union
+from algo.blockchain.utils import int_to_tzaware_utc_datetime, datetime_to_int
 from algo.trading.swapper import SimulationSwapper
 from algo.engine.base import BaseEngine, LAG_TRADE_LIMIT_SECONDS
 
@@ -22,7 +23,7 @@ class Simulator(BaseEngine):
                  pos_impact_state: GlobalPositionAndImpactState,
                  universe: SimpleUniverse,
                  seed_time: datetime.timedelta,
-                 price_stream: Generator[PriceUpdate, Any, Any],
+                 price_stream: Generator[Union[PriceUpdate, PriceUpdateBatch], Any, Any],
                  simulation_step_seconds: int,
                  make_optimizer: Callable[[int], BaseOptimizer],
                  slippage: float = 0
@@ -57,6 +58,65 @@ class Simulator(BaseEngine):
         asa_price_mualgo = price_update.asset2_reserves / price_update.asset1_reserves
         self.signal_providers[asset_id].update(time, asa_price_mualgo)
 
+    def _advance(self, time: datetime.datetime,
+                 log_trade: Callable[[TradeInfo], None],
+                 log_state: Callable[[StateLog], None]):
+        """ Runs the trading loops due before a market update at time """
+        if self._initial_time is None:
+            self._initial_time = time
+            self._sim_time = time
+
+        assert time+datetime.timedelta(seconds=LAG_TRADE_LIMIT_SECONDS) >= self._sim_time, f"{time}, {self._sim_time}"
+
+        while self._sim_time + self.simulation_step < time + datetime.timedelta(seconds=LAG_TRADE_LIMIT_SECONDS):
+
+            self._sim_time = self._sim_time + self.simulation_step
+            self.last_market_state_update = self._sim_time - datetime.timedelta(seconds=LAG_TRADE_LIMIT_SECONDS)
+
+            # Trade only if we are not seeding
+            if self._sim_time - self._initial_time > self.seed_time:
+                self.logger.debug(f'Entering trading loop at sim time {self._sim_time}')
+                self.trade_loop(log_trade, log_state)
+            else:
+                self.logger.debug(f'Still seeding at sim time {self._sim_time}')
+
+    def _run_batch(self, batch: PriceUpdateBatch, end_time: datetime.datetime,
+                   log_trade: Callable[[TradeInfo], None],
+                   log_state: Callable[[StateLog], None]) -> bool:
+        """ Applies the updates of a batch, returns True once past end_time. The updates between two trading loops
+        are applied together: the signals see every update, the prices only the last state of each pool """
+        assert (batch.asset2 == 0).all()
+        assert (np.diff(batch.time) >= 0).all()
+        end_timestamp = datetime_to_int(end_time)
+        prices = (batch.asset2_reserves / batch.asset1_reserves).tolist()
+        asset_ids = batch.asset1.tolist()
+
+        i = 0
+        while i < len(batch):
+            time = int_to_tzaware_utc_datetime(int(batch.time[i]))
+            self._advance(time, log_trade, log_state)
+
+            # End the simulation
+            if time > end_time:
+                return True
+
+            # Updates up to the next trading loop
+            next_timestamp = datetime_to_int(self._sim_time + self.simulation_step
+                                             - datetime.timedelta(seconds=LAG_TRADE_LIMIT_SECONDS))
+            j = int(np.searchsorted(batch.time, min(next_timestamp, end_timestamp), side='right'))
+
+            last = {}
+            for k in range(i, j):
+                time = int_to_tzaware_utc_datetime(int(batch.time[k]))
+                self.signal_providers[asset_ids[k]].update(time, prices[k])
+                last[asset_ids[k]] = (k, time)
+            for asset_id, (k, time) in last.items():
+                self.last_update_times[asset_id] = time
+                self.prices[asset_id] = batch.pool_state(k)
+            i = j
+
+        return False
+
     def run(self, end_time: datetime.datetime,
             log_trade: Callable[[TradeInfo], None],
             log_state: Callable[[StateLog], None]):
@@ -64,32 +124,21 @@ class Simulator(BaseEngine):
         # Takes values on the times where we run the trading loop
         self._sim_time: Optional[datetime.datetime] = None
 
-        initial_time: Optional[datetime.datetime] = None
+        self._initial_time: Optional[datetime.datetime] = None
 
         for x in self.price_stream:
+            if isinstance(x, PriceUpdateBatch):
+                if self._run_batch(x, end_time, log_trade, log_state):
+                    break
+                continue
+
             self.logger.debug(f'{x}')
             assert x.asset_ids[1] == 0
             asset_id, price_update = x.asset_ids[0], x.price_update
             # Time of the price update
             time = int_to_tzaware_utc_datetime(x.price_update.time)
 
-            if initial_time is None:
-                initial_time = time
-                self._sim_time = time
-
-            assert time+datetime.timedelta(seconds=LAG_TRADE_LIMIT_SECONDS) >= self._sim_time, f"{time}, {self._sim_time}"
-
-            while self._sim_time + self.simulation_step < time + datetime.timedelta(seconds=LAG_TRADE_LIMIT_SECONDS):
-
-                self._sim_time = self._sim_time + self.simulation_step
-                self.last_market_state_update = self._sim_time - datetime.timedelta(seconds=LAG_TRADE_LIMIT_SECONDS)
-
-                # Trade only if we are not seeding
-                if self._sim_time - initial_time > self.seed_time:
-                    self.logger.debug(f'Entering trading loop at sim time {self._sim_time}')
-                    self.trade_loop(log_trade, log_state)
-                else:
-                    self.logger.debug(f'Still seeding at sim time {self._sim_time}')
+            self._advance(time, log_trade, log_state)
 
             # End the simulation
             if time > end_time:
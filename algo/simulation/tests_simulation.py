@@ -5,7 +5,7 @@ from algo.trading.impact import ASAImpactState, PositionAndImpactState, GlobalPo
     ASAPosition
 from algo.trading.signalprovider import DummySignalProvider, EmaSignalProvider, \
     EmaSignalParam, PriceSignalProvider, RandomSignalProvider
-from algo.blockchain.stream import stream_from_price_df
+from algo.blockchain.stream import batches_from_price_df
 from datetime import timezone
 from algo.universe.universe import SimpleUniverse
 from algo.dataloading.caching import load_algo_pools
@@ -38,9 +38,9 @@ def make_signal_results(make_signal: Callable[[], PriceSignalProvider],
     universe = SimpleUniverse.from_cache(universe_cache_name)
 
     filter_pair = make_filter_from_universe(universe)
-    dfp = load_algo_pools(price_cache_name, 'prices', filter_pair)
+    dfp = load_algo_pools(price_cache_name, 'prices', filter_pair, time_min=initial_time)
 
-    price_stream = stream_from_price_df(dfp, initial_time)
+    price_stream = batches_from_price_df(dfp, initial_time)
     asset_ids = [pool.asset1_id for pool in universe.pools]
     assert all(pool.asset2_id == 0 for pool in universe.pools)
 
@@ -127,7 +127,7 @@ class TestReports(unittest.TestCase):
         # Just choose some starting positions
         initial_positions = (dfp.groupby('asset1')['asset1_reserves'].mean() * initial_position_multiplier).astype(int)
 
-        price_stream = stream_from_price_df(dfp, initial_time)
+        price_stream = batches_from_price_df(dfp, initial_time)
         asset_ids = [pool.asset1_id for pool in universe.pools]
         assert all(pool.asset2_id == 0 for pool in universe.pools)
 
@@ -5,17 +5,19 @@ import logging
 from algo.trading.impact import ASAImpactState, PositionAndImpactState, GlobalPositionAndImpactState, \
     ASAPosition
 from algo.trading.signalprovider import DummySignalProvider
-from algo.blockchain.stream import PoolState, PriceUpdate, stream_from_price_df
+from algo.blockchain.stream import PoolState, PriceUpdate, stream_from_price_df, batches_from_price_df
 from algo.universe.universe import SimpleUniverse
 from dataclasses import dataclass
 from datetime import timezone
-from algo.blockchain.utils import load_algo_pools
-from algo.dataloading.caching import make_filter_from_universe
+from algo.dataloading.caching import load_algo_pools, make_filter_from_universe
 from algo.simulation.simulator import Simulator
 from algo.universe.pools import PoolId
 from algo.blockchain.utils import datetime_to_int
 from algo.trading.trades import TradeInfo
 from algo.optimizer.optimizerV2 import OptimizerV2
+from tinyman.v1.pools import Asset
+import numpy as np
+import pandas as pd
 import json
 
 @dataclass
@@ -97,6 +99,47 @@ class TestSimulator(unittest.TestCase):
 
         return logged_trades
 
+    def test_batches_same_as_updates(self):
+        asset_ids = [1, 2, 3]
+        universe = SimpleUniverse(pools=[PoolId(asset1_id, 0, "dummy") for asset1_id in asset_ids])
+        initial_time = datetime.datetime(year=2021, month=11, day=10, tzinfo=timezone.utc)
+        end_time = initial_time + datetime.timedelta(hours=5)
+
+        # Random walk of the prices of the pools, updated every few seconds over six hours
+        rng = np.random.default_rng(0)
+        n = 5000
+        asset1 = rng.choice(asset_ids, n)
+        asset1_reserves = (10 ** 10 * np.exp(np.cumsum(rng.normal(0, 0.002, n)))).astype(np.int64)
+        dfp = pd.DataFrame({'time': datetime_to_int(initial_time) - 600 + np.cumsum(rng.integers(0, 10, n)),
+                            'asset1': asset1, 'asset2': 0, 'asset1_reserves': asset1_reserves,
+                            'asset2_reserves': 10 ** 12, 'issued_liquidity': 10 ** 9, 'block': 1000 + np.arange(n),
+                            'reverse_order_in_block': 0})
+
+        def run_simulation(price_stream):
+            pos_impact_states = {
+                asset_id: PositionAndImpactState(ASAImpactState(5 * 60), ASAPosition(10 ** 8))
+                for asset_id in asset_ids
+            }
+            simulator = Simulator(universe=universe,
+                                  pos_impact_state=GlobalPositionAndImpactState(pos_impact_states, 10 ** 12),
+                                  signal_providers={asset_id: DummySignalProvider(0.005, True)
+                                                    for asset_id in asset_ids},
+                                  simulation_step_seconds=5 * 60,
+                                  seed_time=datetime.timedelta(minutes=30),
+                                  price_stream=price_stream,
+                                  make_optimizer=lambda aid: OptimizerV2(asset1=Asset(aid), asset2=Asset(0),
+                                                                         risk_coef=10 ** -12)
+                                  )
+            trades, states = [], []
+            simulator.run(end_time, trades.append, states.append)
+            return trades, states
+
+        trades, states = run_simulation(stream_from_price_df(dfp, initial_time))
+        batch_trades, batch_states = run_simulation(batches_from_price_df(dfp, initial_time, batch_size=700))
+        self.assertGreater(len(trades), 0)
+        self.assertEqual(batch_trades, trades)
+        self.assertEqual(batch_states, states)
+
     def test_liquidation(self):
 
         initial_position_multiplier = 1 / 100
@@ -2,9 +2,11 @@ import logging
 import pandas as pd
 import datetime
 import numpy as np
-from algo.universe.assets import get_decimals
+from algo.tools.asset_data_store import get_asset_datastore
 from typing import Optional, Union, Callable
 
+FIVE_MINUTES = pd.Timedelta(minutes=5)
+
 
 def make_algo_pricevolume(df, make_algo_columns=True):
 
@@ -14,17 +16,13 @@ def make_algo_pricevolume(df, make_algo_columns=True):
 
     # df['mualgo_price'] = df['asset2_reserves'] / df['asset1_reserves']
 
-    def foo(subdf, asset_id):
-        assert np.all(df['asset2'] == 0)
-        decimals = get_decimals(asset_id)
-        subdf['algo_price'] = subdf['asset2_reserves'] / subdf['asset1_reserves'] * 10 ** (decimals - 6)
-        subdf['algo_reserves'] = subdf['asset2_reserves'] / (10 ** 6)
-        if 'asset2_amount' in subdf.columns:
-            subdf['algo_volume'] = subdf['asset2_amount'] / (10 ** 6)
-        return subdf
-
     if make_algo_columns:
-        df = df.groupby('asset1').apply(lambda x: foo(x, x.name))
+        assert np.all(df['asset2'] == 0)
+        decimals = get_asset_datastore().decimals(df['asset1'])
+        df['algo_price'] = df['asset2_reserves'] / df['asset1_reserves'] * 10.0 ** (decimals - 6)
+        df['algo_reserves'] = df['asset2_reserves'] / (10 ** 6)
+        if 'asset2_amount' in df.columns:
+            df['algo_volume'] = df['asset2_amount'] / (10 ** 6)
 
     return df
 
@@ -67,8 +65,18 @@ def ffill_cols(df: pd.DataFrame, cols: list[str], minutes_limit: Union[int, str]
 
 
 def ffill_prices(df: pd.DataFrame, minutes_limit: Union[int, str]):
+    """ Reindexes the prices of each pair onto the 5 minute bars between its first and last row, forward filling
+    the bars without data. All pairs are filled at once: rows are mapped to integer bar ids within their pair and
+    each bar takes the last row of its pair at or before it """
     cols = ['asset1_reserves', 'asset2_reserves', 'issued_liquidity']
 
+    # The limit is checked against the time of the bar itself, which is always known on the grid, so that no bar is
+    # ever left unfilled
+    if isinstance(minutes_limit, int):
+        assert (minutes_limit % 5 == 0)
+    elif minutes_limit != 'all':
+        raise ValueError
+
     subdf = df[~df[cols].isna().any(axis=1)]
 
     # assert ~df[cols].isna().any().any()
@@ -77,10 +85,45 @@ def ffill_prices(df: pd.DataFrame, minutes_limit: Union[int, str]):
         logger = logging.getLogger(__name__)
         logger.warning(f'Dropping {df.shape[0] - subdf.shape[0]} rows because htere are nans in cols {cols}')
 
-    ret: pd.DataFrame = subdf.groupby(['asset1', 'asset2']).apply(
-        lambda x: ffill_cols(x.drop(columns=['asset1', 'asset2']), cols, minutes_limit)).reset_index()
-    ret = ret.dropna(subset=cols)
-    return ret
+    # Rows keep the position they had within their pair, the bars added after them, as in an outer merge
+    row_in_pair = subdf.groupby(['asset1', 'asset2']).cumcount().to_numpy()
+    order = np.lexsort((subdf['time_5min'].to_numpy(), subdf['asset2'].to_numpy(), subdf['asset1'].to_numpy()))
+    subdf = subdf.iloc[order].reset_index(drop=True)
+    row_in_pair = row_in_pair[order]
+    n = subdf.shape[0]
+
+    pairs = subdf[['asset1', 'asset2']].to_numpy()
+    new_pair = np.ones(n, dtype=bool)
+    new_pair[1:] = (pairs[1:] != pairs[:-1]).any(axis=1)
+    pair = np.cumsum(new_pair) - 1
+    starts = np.flatnonzero(new_pair)
+    ends = np.append(starts[1:], n)[:len(starts)] - 1
+
+    bar = ((subdf['time_5min'] - subdf['time_5min'].min()) // FIVE_MINUTES).to_numpy(dtype=np.int64)
+    n_bars = bar[ends] - bar[starts] + 1
+    offsets = np.cumsum(n_bars) - n_bars
+
+    # Every pair starts with a row, so the running maximum of the row index never crosses pairs
+    src = np.zeros(n_bars.sum(), dtype=np.int64)
+    has_row = np.zeros(len(src), dtype=bool)
+    row_pos = offsets[pair] + bar - bar[starts][pair]
+    src[row_pos] = np.arange(n)
+    has_row[row_pos] = True
+    src = np.maximum.accumulate(src)
+
+    bar_pair = np.repeat(np.arange(len(starts)), n_bars)
+    bar_in_pair = np.arange(len(src)) - offsets[bar_pair]
+    filled_in_pair = np.cumsum(~has_row) - 1 - (offsets - starts)[bar_pair]
+
+    ret = subdf.iloc[src].reset_index(drop=True)
+    for col in ret.columns.difference(cols + ['asset1', 'asset2', 'time_5min']):
+        ret[col] = ret[col].where(has_row)
+    ret['time_5min'] = (subdf['time_5min'].iloc[starts[bar_pair]].reset_index(drop=True)
+                        + pd.to_timedelta(bar_in_pair, unit='m') * 5)
+    ret['level_2'] = np.where(has_row, row_in_pair[src], (ends - starts + 1)[bar_pair] + filled_in_pair)
+    ret['time_5min_ffilled'] = ret['time_5min']
+    other_cols = [col for col in subdf.columns if col not in ('asset1', 'asset2')]
+    return ret[['asset1', 'asset2', 'level_2'] + other_cols + ['time_5min_ffilled']]
 
 
 def process_market_df(price_df: pd.DataFrame, volume_df: Optional[pd.DataFrame],
@@ -0,0 +1,20 @@
+import unittest
+import pandas as pd
+from algo.strategy.analytics import ffill_prices
+
+
+class TestFfillPrices(unittest.TestCase):
+
+    def test_pairs_on_grid(self):
+        df = pd.DataFrame({'time_5min': pd.to_datetime([600, 0, 900, 300], unit='s', utc=True),
+                           'asset1': [1, 1, 2, 2], 'asset2': 0,
+                           'asset1_reserves': [3., 1., 5., 4.], 'asset2_reserves': 1., 'issued_liquidity': 1.})
+        ret = ffill_prices(df, 5)
+        self.assertEqual(ret['asset1'].tolist(), [1, 1, 1, 2, 2, 2])
+        self.assertEqual(ret['level_2'].tolist(), [1, 2, 0, 1, 2, 0])
+        self.assertEqual((ret['time_5min'].astype('int64') // 10 ** 9).tolist(), [0, 300, 600, 300, 600, 900])
+        self.assertEqual(ret['asset1_reserves'].tolist(), [1., 1., 3., 4., 4., 5.])
+
+
+if __name__ == '__main__':
+    unittest.main()
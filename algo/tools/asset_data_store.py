@@ -1,35 +1,171 @@
+from __future__ import annotations
+import asyncio
+import json
+import logging
 import os
+import sqlite3
+import threading
 import unittest
+from contextlib import closing
+from dataclasses import dataclass
+from typing import Optional, Iterable
+import aiohttp
+import numpy as np
 from definitions import ROOT_DIR
-from tinyman.v1.client import TinymanClient, TinymanMainnetClient
 from tinyman.v1.pools import Asset
-from dataclasses import asdict
-import json
-from pathlib import Path
+from algo.blockchain.algo_requests import RequestPriority, QueryError, get_json, get_indexer_url
+from algo.universe.hardcoded import ALGO_DECIMALS, verified_assets
 
+ASSET_STORE_FILE = os.path.join(ROOT_DIR, 'caches', 'assets.sqlite')
+# Json cache written before the store, imported into it on creation
 ASSET_CACHE_FILE = os.path.join(ROOT_DIR, 'caches', 'assets.json')
 
+VERIFIED_ASSETS = set(verified_assets)
+
+
+@dataclass
+class AssetMetadata:
+    id: int
+    name: str
+    unit_name: str
+    decimals: int
+    is_verified: bool
+
+    def to_asset(self) -> Asset:
+        return Asset(id=self.id, name=self.name, unit_name=self.unit_name, decimals=self.decimals)
+
+
+ALGO_METADATA = AssetMetadata(0, 'Algorand', 'ALGO', ALGO_DECIMALS, True)
+
+
+def parse_indexer_asset(resp: dict) -> AssetMetadata:
+    """ Metadata from the response of the indexer to /v2/assets/{id} """
+    asset = resp['asset']
+    params = asset['params']
+    return AssetMetadata(id=int(asset['index']), name=params.get('name', ''), unit_name=params.get('unit-name', ''),
+                         decimals=int(params['decimals']), is_verified=int(asset['index']) in VERIFIED_ASSETS)
+
 
 class AssetDataStore:
-    def __init__(self, client: TinymanClient):
-        self.client = client
-        os.makedirs(Path(ASSET_CACHE_FILE).parent, exist_ok=True)
+    """ Metadata of the assets, persisted in SQLite and indexed in memory, so that lookups of known assets never
+    touch the network. Missing assets are fetched from the indexer concurrently and written in a single transaction """
 
-    def fetch_asset(self, asset_id: int) -> Asset:
+    def __init__(self, dbfile: str = ASSET_STORE_FILE, legacy_file: Optional[str] = ASSET_CACHE_FILE):
+        self.dbfile = dbfile
+        self.logger = logging.getLogger(__name__)
+        os.makedirs(os.path.dirname(dbfile), exist_ok=True)
+        with closing(self._connect()) as con, con:
+            con.execute("""
+                create table if not exists assets
+                (id INTEGER PRIMARY KEY, name TEXT NOT NULL, unit_name TEXT NOT NULL, decimals INTEGER NOT NULL,
+                 is_verified INTEGER NOT NULL)
+                """)
+            rows = con.execute("select id, name, unit_name, decimals, is_verified from assets").fetchall()
+        self._assets: dict[int, AssetMetadata] = {ALGO_METADATA.id: ALGO_METADATA}
+        self._assets.update({row[0]: AssetMetadata(row[0], row[1], row[2], row[3], bool(row[4])) for row in rows})
+        # Assets the indexer could not serve in this session, not requested again
+        self._failed: set[int] = set()
+        self._lock = threading.Lock()
+        if not rows and legacy_file is not None:
+            self._import_legacy(legacy_file)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.dbfile, timeout=60)
 
-        if os.path.exists(ASSET_CACHE_FILE):
-            with open(ASSET_CACHE_FILE, 'r') as f:
+    def _import_legacy(self, legacy_file: str):
+        try:
+            with open(legacy_file) as f:
                 data = json.load(f)
-        else:
-            data = {}
-        if str(asset_id) not in data:
-            asset = self.client.fetch_asset(asset_id)
-            data[str(asset_id)] = asdict(asset)
-            with open(ASSET_CACHE_FILE, 'w') as f:
-                json.dump(data, f)
-        else:
-            asset = Asset(**data[str(asset_id)])
-        return asset
+        except FileNotFoundError:
+            return
+        self.add([AssetMetadata(int(x['id']), x['name'], x['unit_name'], int(x['decimals']),
+                                int(x['id']) in VERIFIED_ASSETS) for x in data.values()])
+
+    def __contains__(self, asset_id: int) -> bool:
+        return int(asset_id) in self._assets
+
+    def get(self, asset_id: int) -> Optional[AssetMetadata]:
+        return self._assets.get(int(asset_id))
+
+    def add(self, assets: Iterable[AssetMetadata]):
+        assets = list(assets)
+        with self._lock:
+            with closing(self._connect()) as con, con:
+                con.executemany("insert or replace into assets values (?, ?, ?, ?, ?)",
+                                [(x.id, x.name, x.unit_name, x.decimals, int(x.is_verified)) for x in assets])
+            self._assets.update({x.id: x for x in assets})
+
+    async def aprefetch(self, asset_ids: Iterable[int], session: Optional[aiohttp.ClientSession] = None,
+                        priority: RequestPriority = RequestPriority.BACKFILL) -> list[int]:
+        """ Fetches the assets missing from the store, returns the ids that could not be fetched, now or earlier in
+        the session """
+        asset_ids = {int(x) for x in asset_ids}
+        missing = sorted(asset_ids - self._assets.keys() - self._failed)
+        if not missing:
+            return sorted(asset_ids & self._failed)
+        if session is None:
+            async with aiohttp.ClientSession() as session:
+                return await self.aprefetch(asset_ids, session, priority)
+
+        self.logger.info(f'Fetching the metadata of {len(missing)} assets')
+        url = f'{get_indexer_url()}/v2/assets'
+        resps = await asyncio.gather(*[get_json(session, f'{url}/{asset_id}', {}, priority) for asset_id in missing],
+                                     return_exceptions=True)
+        fetched = []
+        for asset_id, resp in zip(missing, resps):
+            if isinstance(resp, QueryError):
+                self.logger.warning(f'Could not fetch the metadata of asset {asset_id}: {resp}')
+                self._failed.add(asset_id)
+            elif isinstance(resp, BaseException):
+                raise resp
+            else:
+                fetched.append(parse_indexer_asset(resp))
+        self.add(fetched)
+        return sorted(asset_ids & self._failed)
+
+    def prefetch(self, asset_ids: Iterable[int]) -> list[int]:
+        """ Same as aprefetch, from synchronous code. Blocks until the assets are fetched on the background loop,
+        async code should await aprefetch instead """
+        from algo.blockchain.stream import background_loop
+        asset_ids = {int(x) for x in asset_ids}
+        if not asset_ids - self._assets.keys() - self._failed:
+            return sorted(asset_ids & self._failed)
+
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is background_loop():
+            raise RuntimeError('prefetch would wait on the loop it runs on, await aprefetch instead')
+        if running_loop is not None:
+            self.logger.warning('prefetch is blocking a running event loop, await aprefetch instead')
+        return asyncio.run_coroutine_threadsafe(self.aprefetch(asset_ids), background_loop()).result()
+
+    def _known_metadata(self, asset_id: int) -> AssetMetadata:
+        if asset_id not in self:
+            raise KeyError(f'Unknown asset {asset_id}')
+        return self._assets[int(asset_id)]
+
+    def metadata(self, asset_id: int) -> AssetMetadata:
+        if asset_id not in self:
+            self.prefetch([asset_id])
+        return self._known_metadata(asset_id)
+
+    async def ametadata(self, asset_id: int, session: Optional[aiohttp.ClientSession] = None) -> AssetMetadata:
+        """ Same as metadata, from async code """
+        if asset_id not in self:
+            await self.aprefetch([asset_id], session)
+        return self._known_metadata(asset_id)
+
+    def fetch_asset(self, asset_id: int) -> Asset:
+        return self.metadata(asset_id).to_asset()
+
+    def decimals(self, asset_ids: Iterable[int]) -> np.ndarray:
+        """ Decimals of each of asset_ids, fetching the unknown assets once """
+        asset_ids = np.asarray(asset_ids, dtype=np.int64)
+        unique_ids, inverse = np.unique(asset_ids, return_inverse=True)
+        self.prefetch(unique_ids)
+        return np.array([self.metadata(x).decimals for x in unique_ids], dtype=np.int64)[inverse]
 
 
 asset_data_store = None
@@ -38,7 +174,7 @@ asset_data_store = None
 def get_asset_datastore() -> AssetDataStore:
     global asset_data_store
     if not asset_data_store:
-        asset_data_store = AssetDataStore(client=TinymanMainnetClient())
+        asset_data_store = AssetDataStore()
     return asset_data_store
 
 
@@ -46,7 +182,5 @@ class TestAssetDataStore(unittest.TestCase):
 
     def test_data(self):
         aid = 226701642
-        from tinyman.v1.client import TinymanMainnetClient
-        client = TinymanMainnetClient()
-        asset: Asset = AssetDataStore(client).fetch_asset(aid)
+        asset: Asset = get_asset_datastore().fetch_asset(aid)
         print(asset)
@@ -0,0 +1,50 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from algo.blockchain.indexer_replay import IndexerStandIn, run_against
+from algo.blockchain.stream import background_loop
+from algo.tools.asset_data_store import AssetDataStore
+
+
+class TestAssetDataStore(unittest.TestCase):
+
+    def test_prefetch(self):
+        assets = {aid: {'index': aid, 'params': {'decimals': aid % 7, 'name': f'A{aid}', 'unit-name': f'U{aid}'}}
+                  for aid in (31566704, 5, 6, 7)}
+        standin = IndexerStandIn([], assets=assets)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = AssetDataStore(os.path.join(tmpdir, 'assets.sqlite'), legacy_file=None)
+
+            async def query(session):
+                failed = await store.aprefetch([5, 6, 31566704, 404, 0], session)
+                n_requests = standin.n_requests
+                self.assertEqual(await store.aprefetch([5, 6, 0], session), [])
+                # The assets the indexer could not serve are not requested again
+                self.assertEqual(await store.aprefetch([404, 5], session), [404])
+                with self.assertRaises(KeyError):
+                    store.metadata(404)
+                self.assertEqual(standin.n_requests, n_requests)
+
+                self.assertEqual((await store.ametadata(7, session)).unit_name, 'U7')
+                self.assertEqual(standin.n_requests, n_requests + 1)
+                return failed
+
+            self.assertEqual(run_against(standin, query), [404])
+            # The assets fetched are persisted and the store answers without requests
+            reloaded = AssetDataStore(store.dbfile, legacy_file=None)
+            self.assertEqual(reloaded.decimals([6, 0, 5, 6]).tolist(), [6, 6, 5, 6])
+            self.assertTrue(reloaded.metadata(31566704).is_verified)
+            self.assertEqual(reloaded.fetch_asset(5).unit_name, 'U5')
+
+            # Waiting on the background loop from the background loop itself would never return
+            async def prefetch_on_background_loop():
+                return reloaded.prefetch([8])
+
+            with self.assertRaises(RuntimeError):
+                asyncio.run_coroutine_threadsafe(prefetch_on_background_loop(), background_loop()).result(timeout=10)
+
+
+if __name__ == '__main__':
+    unittest.main()
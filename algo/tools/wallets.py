@@ -1,5 +1,6 @@
 from __future__ import annotations
 import requests
+from algo.tools.asset_data_store import get_asset_datastore
 
 
 def get_asset_data(asset_id, testnet=False):
@@ -12,10 +13,8 @@ def get_asset_data(asset_id, testnet=False):
 
 def get_decimal(asset_id, testnet=False):
     if testnet:
-        asset = requests.get(url=f'https://testnet.algoexplorerapi.io/idx2/v2/assets/{asset_id}').json()
-    else:
-        asset = requests.get(url=f'https://algoexplorerapi.io/idx2/v2/assets/{asset_id}').json()
-    return asset['asset']['params']['decimals']
+        return get_asset_data(asset_id, testnet)['params']['decimals']
+    return get_asset_datastore().metadata(asset_id).decimals
 
 
 def get_account_data(address=None, testnet=False):
@@ -9,7 +9,7 @@ from enum import Flag, auto
 import dataclasses
 from dataclasses import dataclass
 from algo.universe.hardcoded import ALGO_DECIMALS
-from functools import lru_cache
+from algo.tools.asset_data_store import get_asset_datastore
 
 
 def get_asset_data(asset_id: int):
@@ -17,14 +17,12 @@ def get_asset_data(asset_id: int):
     return res['asset']
 
 
-@lru_cache()
 def get_asset_name(asset_id):
-    return get_asset_data(asset_id)['params']['name']
+    return get_asset_datastore().metadata(asset_id).name
 
 
-@lru_cache()
 def get_decimals(asset_id):
-    return get_asset_data(asset_id)['params']['decimals']
+    return get_asset_datastore().metadata(asset_id).decimals
 
 
 @dataclass
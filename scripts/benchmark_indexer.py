@@ -0,0 +1,64 @@
+import asyncio
+import argparse
+import logging
+import time
+import aiohttp
+from algo.blockchain.algo_requests import QueryParams, query_transaction_pages, set_indexer_url, \
+    set_request_scheduler, RequestScheduler, DEFAULT_PREFETCH
+from algo.blockchain.indexer_replay import IndexerStandIn
+from algo.universe.universe import SimpleUniverse
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the throughput of query_transactions against '
+                                                 'a local stand-in of the indexer.')
+    parser.add_argument('-r', dest='recording_name', type=str, required=True)
+    parser.add_argument('-u', dest='universe', type=str, required=True)
+    parser.add_argument('--port', dest='port', type=int, default=8980)
+    parser.add_argument('--latency', dest='latency_seconds', type=float, default=0.05)
+    parser.add_argument('--max_rps', dest='max_requests_per_second', type=float, default=None)
+    parser.add_argument('--scheduler_rps', dest='scheduler_rps', type=float, default=1000.0)
+    parser.add_argument('--prefetch', dest='prefetch', type=int, default=DEFAULT_PREFETCH)
+    parser.add_argument('--limit', dest='limit', type=int, default=None)
+    parser.add_argument('--page_seconds', dest='page_seconds', type=float, default=0.0,
+                        help='Time spent processing each page, to model the parsing and writing of the pages')
+
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s',
+                        level=logging.INFO)
+
+    args = parser.parse_args()
+
+    universe = SimpleUniverse.from_cache(args.universe)
+    standin = IndexerStandIn.from_recording(args.recording_name,
+                                            latency_seconds=args.latency_seconds,
+                                            max_requests_per_second=args.max_requests_per_second)
+    set_indexer_url(f'http://127.0.0.1:{args.port}')
+    set_request_scheduler(RequestScheduler(requests_per_second=args.scheduler_rps, burst=int(args.scheduler_rps)))
+
+    async def main():
+        runner = await standin.start(port=args.port)
+        n_transactions = 0
+
+        params = {'limit': args.limit} if args.limit else {}
+
+        async def query_pool(address):
+            nonlocal n_transactions
+            async for page in query_transaction_pages(session, {'address': address, **params}, None, QueryParams(),
+                                                      prefetch=args.prefetch):
+                n_transactions += len(page)
+                if args.page_seconds:
+                    await asyncio.sleep(args.page_seconds)
+
+        try:
+            async with aiohttp.ClientSession() as session:
+                ti = time.time()
+                await asyncio.gather(*[query_pool(pool.address) for pool in universe.pools])
+                seconds = time.time() - ti
+        finally:
+            await runner.cleanup()
+
+        logging.info(f'Queried {n_transactions} transactions with {standin.n_requests} requests '
+                     f'({standin.n_throttled} throttled) in {seconds:.2f} seconds: '
+                     f'{n_transactions / seconds:.0f} transactions/s')
+
+    asyncio.run(main())
@@ -0,0 +1,23 @@
+from algo.blockchain.compaction import compact_cache
+from algo.blockchain.process_prices import PRICE_CACHES_BASEDIR
+from algo.blockchain.process_volumes import VOLUME_CACHES_BASEDIR
+from algo.blockchain.process_pricevolumes import RAW_CACHES_BASEDIR
+import argparse
+import logging
+
+CACHE_BASEDIRS = {'prices': PRICE_CACHES_BASEDIR, 'volumes': VOLUME_CACHES_BASEDIR, 'raw': RAW_CACHES_BASEDIR}
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Compact the daily files of the complete past months of a cache '
+                                                 'into monthly files')
+    parser.add_argument('-t', dest='data_type', type=str, required=True, choices=list(CACHE_BASEDIRS))
+    parser.add_argument('-c', dest='cache_name', type=str, required=True)
+    parser.add_argument('-j', dest='n_workers', type=int, required=False, default=None)
+    parser.add_argument('--dry_run', dest='dry_run', required=False, action='store_true')
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s',
+                        level=logging.INFO)
+
+    args = parser.parse_args()
+
+    compact_cache(CACHE_BASEDIRS[args.data_type], args.cache_name, n_workers=args.n_workers, dry_run=args.dry_run)
@@ -0,0 +1,29 @@
+from algo.blockchain.blocks import ingest_blocks, compare_caches
+from algo.universe.pools import PoolIdStore
+import argparse
+import logging
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Build the price and volume caches from msgpack block files, '
+                                                 'optionally comparing them with caches built from the indexer')
+    parser.add_argument('-p', dest='poolidstore_cache_name', type=str, required=True)
+    parser.add_argument('-b', dest='block_dir', type=str, required=True)
+    parser.add_argument('-c', dest='dest_cache', type=str, required=True)
+    parser.add_argument('-j', dest='n_workers', type=int, required=False, default=None)
+    parser.add_argument('--verify', dest='reference_cache', type=str, required=False)
+    parser.add_argument('--dry_run', dest='dry_run', required=False, action='store_true')
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s',
+                        level=logging.INFO)
+
+    args = parser.parse_args()
+
+    ps = PoolIdStore.from_cache(args.poolidstore_cache_name)
+
+    ingest_blocks(args.block_dir, args.dest_cache, ps, n_workers=args.n_workers, dry_run=args.dry_run)
+
+    if args.reference_cache:
+        differences = compare_caches(args.dest_cache, args.reference_cache, ps)
+        for difference in differences:
+            logging.warning(f'Difference with {args.reference_cache}: {difference}')
+        logging.info(f'Found {len(differences)} days differing from {args.reference_cache}')
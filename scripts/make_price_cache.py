@@ -1,5 +1,5 @@
 import datetime
-from algo.blockchain.process_prices import PriceCacher
+from algo.blockchain.process_prices import PriceCacher, AppPriceCacher
 from tinyman.v1.client import TinymanMainnetClient
 from algo.universe.pools import PoolIdStore
 import argparse
@@ -12,10 +12,16 @@ if __name__ == '__main__':
     parser.add_argument('-c', dest='cache_name', type=str, required=True)
     parser.add_argument('--dry_run', dest='dry_run', required=False, action='store_true')
     parser.add_argument('--dest_cache', dest='dest_cache', required=False, type=str)
+    parser.add_argument('--shard_hours', dest='shard_hours', required=False, type=int, default=24)
+    parser.add_argument('--max_shards_in_flight', dest='max_shards_in_flight', required=False, type=int, default=8)
+    parser.add_argument('--shard_rows', dest='shard_rows', required=False, type=int)
+    parser.add_argument('--by_app', dest='by_app', required=False, action='store_true')
     logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s',
                         level=logging.INFO)
 
     args = parser.parse_args()
+    if args.by_app and args.shard_rows is not None:
+        parser.error('--shard_rows is not supported with --by_app, the app stream is sharded by --shard_hours')
 
     dry_run = args.dry_run
     dest_cache = args.dest_cache
@@ -27,11 +33,24 @@ if __name__ == '__main__':
 
     ps = PoolIdStore.from_cache(args.poolidstore_cache_name)
 
-    pc = PriceCacher(client=TinymanMainnetClient(),
-                     pool_id_store=ps,
-                     date_min=date_min,
-                     date_max=None,
-                     dry_run=dry_run
-                     )
+    if args.by_app:
+        pc = AppPriceCacher(client=TinymanMainnetClient(),
+                            pool_id_store=ps,
+                            date_min=date_min,
+                            date_max=None,
+                            dry_run=dry_run,
+                            shard_hours=args.shard_hours,
+                            max_shards_in_flight=args.max_shards_in_flight
+                            )
+    else:
+        pc = PriceCacher(client=TinymanMainnetClient(),
+                         pool_id_store=ps,
+                         date_min=date_min,
+                         date_max=None,
+                         dry_run=dry_run,
+                         shard_hours=args.shard_hours,
+                         max_shards_in_flight=args.max_shards_in_flight,
+                         shard_rows=args.shard_rows
+                         )
     pc.cache(args.cache_name, dest_cache)
 
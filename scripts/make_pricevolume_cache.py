@@ -0,0 +1,45 @@
+import datetime
+from algo.blockchain.process_pricevolumes import PriceVolumeCacher
+from tinyman.v1.client import TinymanMainnetClient
+from algo.universe.pools import PoolIdStore
+import argparse
+import logging
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', dest='poolidstore_cache_name', type=str, required=True)
+    parser.add_argument('-c', dest='cache_name', type=str, required=True)
+    parser.add_argument('--dry_run', dest='dry_run', required=False, action='store_true')
+    parser.add_argument('--dest_cache', dest='dest_cache', required=False, type=str)
+    parser.add_argument('--shard_hours', dest='shard_hours', required=False, type=int, default=24)
+    parser.add_argument('--max_shards_in_flight', dest='max_shards_in_flight', required=False, type=int, default=8)
+    parser.add_argument('--shard_rows', dest='shard_rows', required=False, type=int)
+    parser.add_argument('--archive_raw', dest='archive_raw', required=False, action='store_true')
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s',
+                        level=logging.INFO)
+
+    args = parser.parse_args()
+
+    dry_run = args.dry_run
+    dest_cache = args.dest_cache
+
+    if dest_cache is None:
+        dest_cache = args.cache_name
+
+    date_min = datetime.datetime(year=2022, month=1, day=20)
+
+    ps = PoolIdStore.from_cache(args.poolidstore_cache_name)
+
+    pc = PriceVolumeCacher(client=TinymanMainnetClient(),
+                           pool_id_store=ps,
+                           date_min=date_min,
+                           date_max=None,
+                           dry_run=dry_run,
+                           shard_hours=args.shard_hours,
+                           max_shards_in_flight=args.max_shards_in_flight,
+                           shard_rows=args.shard_rows,
+                           archive_raw=args.archive_raw
+                           )
+    pc.cache(args.cache_name, dest_cache)
+
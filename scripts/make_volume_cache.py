@@ -12,6 +12,10 @@ if __name__ == '__main__':
         parser.add_argument('-c', dest='cache_name', type=str, required=True)
         parser.add_argument('--dry_run', dest='dry_run', required=False, action='store_true')
         parser.add_argument('--dest_cache', dest='dest_cache', required=False, type=str)
+        parser.add_argument('--shard_hours', dest='shard_hours', required=False, type=int, default=24)
+        parser.add_argument('--max_shards_in_flight', dest='max_shards_in_flight', required=False, type=int,
+                            default=8)
+        parser.add_argument('--shard_rows', dest='shard_rows', required=False, type=int)
 
         args = parser.parse_args()
 
@@ -34,7 +38,10 @@ if __name__ == '__main__':
                 pool_id_store=ps,
                 date_min=date_min,
                 date_max=None,
-                dry_run=dry_run
+                dry_run=dry_run,
+                shard_hours=args.shard_hours,
+                max_shards_in_flight=args.max_shards_in_flight,
+                shard_rows=args.shard_rows
         )
         pc.cache(args.cache_name, dest_cache)
 
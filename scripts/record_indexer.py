@@ -0,0 +1,31 @@
+import datetime
+import asyncio
+import aiohttp
+import argparse
+import logging
+from algo.blockchain.algo_requests import QueryParams
+from algo.blockchain.indexer_replay import TransactionRecorder
+from algo.universe.universe import SimpleUniverse
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Record the raw indexer transactions of a universe.')
+    parser.add_argument('-u', dest='universe', type=str, required=True)
+    parser.add_argument('-r', dest='recording_name', type=str, required=True)
+    parser.add_argument('--date_min', dest='date_min', type=datetime.datetime.fromisoformat, required=True)
+    parser.add_argument('--date_max', dest='date_max', type=datetime.datetime.fromisoformat, required=True)
+
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s',
+                        level=logging.INFO)
+
+    args = parser.parse_args()
+
+    universe = SimpleUniverse.from_cache(args.universe)
+    recorder = TransactionRecorder(args.recording_name)
+    query_params = QueryParams(after_time=args.date_min, before_time=args.date_max)
+
+    async def main():
+        async with aiohttp.ClientSession() as session:
+            await recorder.record(session, [pool.address for pool in universe.pools], query_params)
+
+    asyncio.run(main())
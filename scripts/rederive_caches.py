@@ -0,0 +1,22 @@
+from algo.blockchain.archive import rederive_caches
+from algo.universe.pools import PoolIdStore
+import argparse
+import logging
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Rebuild the price and volume caches from the raw transactions '
+                                                 'archived with make_pricevolume_cache.py --archive_raw')
+    parser.add_argument('-p', dest='poolidstore_cache_name', type=str, required=True)
+    parser.add_argument('-r', dest='raw_cache_name', type=str, required=True)
+    parser.add_argument('-c', dest='dest_cache', type=str, required=True)
+    parser.add_argument('-j', dest='n_workers', type=int, required=False, default=None)
+    parser.add_argument('--dry_run', dest='dry_run', required=False, action='store_true')
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s',
+                        level=logging.INFO)
+
+    args = parser.parse_args()
+
+    ps = PoolIdStore.from_cache(args.poolidstore_cache_name)
+
+    rederive_caches(args.raw_cache_name, args.dest_cache, ps, n_workers=args.n_workers, dry_run=args.dry_run)
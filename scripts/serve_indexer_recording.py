@@ -0,0 +1,33 @@
+import asyncio
+import argparse
+import logging
+from algo.blockchain.indexer_replay import IndexerStandIn
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Serve recorded transactions with the indexer API. '
+                                                 'Point the clients to it with ALGO_INDEXER_URL=http://host:port')
+    parser.add_argument('-r', dest='recording_name', type=str, required=True)
+    parser.add_argument('--host', dest='host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', dest='port', type=int, default=8980)
+    parser.add_argument('--latency', dest='latency_seconds', type=float, default=0.0)
+    parser.add_argument('--max_rps', dest='max_requests_per_second', type=float, default=None)
+    parser.add_argument('--rounds_per_second', dest='rounds_per_second', type=float, default=None)
+
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s',
+                        level=logging.INFO)
+
+    args = parser.parse_args()
+
+    standin = IndexerStandIn.from_recording(args.recording_name,
+                                            latency_seconds=args.latency_seconds,
+                                            max_requests_per_second=args.max_requests_per_second,
+                                            rounds_per_second=args.rounds_per_second)
+
+    async def main():
+        await standin.start(args.host, args.port)
+        logging.info(f'Serving {len(standin.transactions)} transactions on http://{args.host}:{args.port}')
+        while True:
+            await asyncio.sleep(3600)
+
+    asyncio.run(main())
@@ -0,0 +1,24 @@
+from algo.blockchain.tail import TailCacher
+from algo.universe.universe import SimpleUniverse
+import argparse
+import asyncio
+import logging
+import uvloop
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Keep the price and volume caches of a universe up to date '
+                                                 'by following the new rounds')
+    parser.add_argument('-u', dest='universe_cache_name', type=str, required=True)
+    parser.add_argument('-c', dest='cache_name', type=str, required=True)
+    parser.add_argument('--flush_seconds', dest='flush_seconds', required=False, type=float, default=60.0)
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s',
+                        level=logging.INFO)
+
+    args = parser.parse_args()
+
+    universe = SimpleUniverse.from_cache(args.universe_cache_name)
+    tail_cacher = TailCacher(universe, args.cache_name, flush_seconds=args.flush_seconds)
+
+    uvloop.install()
+    asyncio.run(tail_cacher.run())